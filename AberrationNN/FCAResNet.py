@@ -2,6 +2,8 @@ from torch import nn
 import torch.nn.functional as F
 import torch
 import math
+import contextlib
+from torch.utils.checkpoint import checkpoint
 
 
 # References: J. Hu, L. Shen and G. Sun, "Squeeze-and-Excitation Networks," 2018 IEEE/CVF Conference on Computer
@@ -10,8 +12,8 @@ import math
 # all the input first dimension should be batch
 
 def gelu(x):
-    cdf = 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
-    return x * cdf
+    """x * 0.5 * (1 + erf(x / sqrt(2))), as one fused kernel that keeps only x for the backward."""
+    return F.gelu(x)
 
 
 class FCAModule(nn.Module):
@@ -23,7 +25,18 @@ class FCAModule(nn.Module):
 
     Returns: weighed figure channels by DFT of each channel and mean of all pixels
 
+    The squeeze only needs the pixel mean of relu(cov(|FT|)), which does not depend on the pixel order, so the
+    fftshift is not applied to the spectrum, and for the real input only the half spectrum of rfft2 is computed,
+    with the columns that stand for two conjugate columns of the full spectrum counted twice.
+    The original fftshift(out) had no dim argument, so it also rolled the batch and channel dimensions by half their
+    size. The trained weights depend on this, so the channel roll is applied to the cov weights and the batch roll
+    to the pooled values, which keeps the outputs of the existing checkpoints.
+    spectrum_pool > 1 average pools the half spectrum by this factor before the 1x1 conv, an approximation that saves
+    compute at large fftsize.
+    batch_roll = False drops the batch roll, for the models whose batch mixes independent items (FCAPatchSetNet).
     """
+    spectrum_pool = 1  # class defaults, for the modules pickled before the options existed
+    batch_roll = True
 
     def __init__(self,
                  input_channels: int = 64,
@@ -49,13 +62,10 @@ class FCAModule(nn.Module):
         """
         # fft2 last two channels
         if self.if_FT:
-            out = torch.fft.fft2(x)
-            out = torch.abs(torch.fft.fftshift(out))
-            out = F.relu(self.cov(out))
+            out = self.spectrum_mean(x)
         else:
-            out = x
-        # global average pooling, get a single mean value for each channel
-        out = torch.mean(out, axis=(-2, -1), keepdims=True)  # axis [h,w] # this is a squeeze operation
+            # global average pooling, get a single mean value for each channel
+            out = torch.mean(x, axis=(-2, -1), keepdims=True)  # axis [h,w] # this is a squeeze operation
         # this is an excitation operation with optional reduction and activation
         if self.reduction != 1:
             out = F.relu(self.cov2(out))
@@ -66,11 +76,71 @@ class FCAModule(nn.Module):
 
         return torch.multiply(x, out)
 
+    def spectrum_mean(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Mean over the pixels of relu(cov(|fft2(x)|)), from the rfft2 half spectrum. Column 0 and, for even widths,
+        the last column are their own conjugates, the other columns count twice.
+        """
+        h, w = x.shape[-2:]
+        dft = getattr(self, 'dft', None)  # the matmul DFT set by export.py, for the exporters without FFT ops
+        spectrum = torch.abs(torch.fft.rfft2(x)) if dft is None else dft(x)
+        weight = torch.full((spectrum.shape[-1],), 2., dtype=spectrum.dtype, device=spectrum.device)
+        weight[0] = 1.
+        if w % 2 == 0:
+            weight[-1] = 1.
+        weight = weight.expand(spectrum.shape[-2:])
+        if self.spectrum_pool > 1:
+            # weighted average of the magnitudes in each cell, and the cell counts its summed weight
+            k = self.spectrum_pool
+            spectrum = F.avg_pool2d(spectrum * weight, k, ceil_mode=True) / F.avg_pool2d(weight[None], k, ceil_mode=True)
+            weight = F.avg_pool2d(weight[None], k, ceil_mode=True, divisor_override=1)[0]
+        # cov(roll(spectrum, C // 2, channel dim)) == cov with the input channels of the weights rolled back
+        c = x.shape[1]
+        out = F.relu(F.conv2d(spectrum, torch.roll(self.cov.weight, -(c // 2), 1), self.cov.bias))
+        out = (out * weight).sum(dim=(-2, -1), keepdim=True) / (h * w)
+        return torch.roll(out, x.shape[0] // 2, 0) if self.batch_roll else out
+
+
+def set_spectrum_pool(model: nn.Module, spectrum_pool: int) -> nn.Module:
+    """Set the spectrum pooling factor of all the FCAModules of a model, also of a model loaded from a checkpoint."""
+    for m in model.modules():
+        if isinstance(m, FCAModule):
+            m.spectrum_pool = spectrum_pool
+    return model
+
+
+def set_checkpoint_stages(model: nn.Module, stages) -> nn.Module:
+    """
+    Recompute the attention blocks of the given stages (1-4, as block1-block4, or 'all') in the backward instead of
+    keeping their activations, for all the FCAResNet backbones of a model.
+    """
+    stages = (1, 2, 3, 4) if stages in ('all', True) else tuple(stages or ())
+    for m in model.modules():
+        if isinstance(m, FCAResNetBackbone):
+            m.checkpoint_stages = stages
+    return model
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(*modules: nn.Module):
+    """Keep the BN running statistics while the checkpointed blocks are recomputed, they were updated in the forward."""
+    bns = [m for module in modules for m in module.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    state = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, (momentum, n) in zip(bns, state):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(n)
+
 
 class FCABlock(nn.Module):
     """
     Builds a Fourier channel attention block, which contains two conv layer before the FCA and concat before/after
-    FCA together. With or without BN after FCA.
+    FCA together. With or without BN after FCA. conv, conv_groups: the variant of the 3x3 conv, see conv3x3.
     """
 
     def __init__(self,
@@ -78,6 +148,8 @@ class FCABlock(nn.Module):
                  reduction: int,
                  batch_norm: bool,
                  if_FT: bool = True,
+                 conv: str = 'dense',
+                 conv_groups: int = 4,
                  ) -> None:
 
         super(FCABlock, self).__init__()
@@ -86,7 +158,7 @@ class FCABlock(nn.Module):
         self.reducton = reduction
         self.if_FT = if_FT
 
-        self.c0 = nn.Conv2d(input_channels, input_channels, kernel_size=3, stride=1, padding='same')
+        self.c0 = conv3x3(input_channels, input_channels, conv, conv_groups)
         self.fca = FCAModule(input_channels, reduction, if_FT)
         if self.batch_norm:
             self.bn = nn.BatchNorm2d(input_channels)
@@ -154,10 +226,142 @@ class CoordAttentionBlock(nn.Module):
         return out
 
 
-class FCAResNet(nn.Module):
+class LowRankLinear(nn.Module):
+    """
+    Linear layer factorized through rank features, in_features * rank + rank * out_features weights instead of
+    in_features * out_features, for dense1 whose input grows with fftsize ** 2.
+    """
+
+    def __init__(self, in_features: int, out_features: int, rank: int) -> None:
+        super(LowRankLinear, self).__init__()
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.up(self.down(x))
+
+
+HEADS = ('dense', 'pooled', 'lowrank')
+CONVS = ('dense', 'separable', 'grouped')
+
+
+class SeparableConv2d(nn.Module):
+    """
+    Depthwise kernel_size conv of each channel followed by a 1x1 conv mixing the channels, in_channels * (k * k +
+    out_channels) weights instead of in_channels * out_channels * k * k.
+    """
+
+    def __init__(self, in_channels: int, out_channels: int, kernel_size: int = 3) -> None:
+        super(SeparableConv2d, self).__init__()
+        self.in_channels, self.out_channels = in_channels, out_channels
+        self.depthwise = nn.Conv2d(in_channels, in_channels, kernel_size, padding='same', groups=in_channels,
+                                   bias=False)
+        self.pointwise = nn.Conv2d(in_channels, out_channels, kernel_size=1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.pointwise(self.depthwise(x))
+
+
+def conv3x3(in_channels: int, out_channels: int, conv: str = 'dense', groups: int = 4) -> nn.Module:
+    """
+    The 3x3 'same' convs of the FCABlocks and the stages:
+        'dense': nn.Conv2d
+        'separable': SeparableConv2d
+        'grouped': nn.Conv2d with groups channel groups, reduced to a divisor of both channel numbers
+    """
+    if conv not in CONVS:
+        raise ValueError('Unknown conv {}, one of {}'.format(conv, CONVS))
+    if conv == 'separable':
+        return SeparableConv2d(in_channels, out_channels)
+    groups = math.gcd(groups, math.gcd(in_channels, out_channels)) if conv == 'grouped' else 1
+    return nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding='same', groups=groups)
+
+
+class FCAResNetBackbone(nn.Module):
+    """
+    The four convolution stages shared by the FCAResNet models. Each stage computes gelu(covN(x)) once, for both the
+    attention blocks and the skip connection. The subclasses define cov0-cov3, cab1-cab4, block1-block4, if_CAB and
+    skip_connection, so the state_dict keys are those of the original models.
+
+    checkpoint_stages: the stages (1-4) whose attention blocks (cabN, blockN with the FFT attention) are recomputed
+    in the backward, which keeps only their input in memory, in training mode. Under torch.compile the checkpoint
+    has no context_fn (dynamo cannot trace one): the compiled backward recomputes from the graph, without the second
+    BN running statistics update that frozen_bn_stats prevents in eager mode.
+
+    conv, conv_groups select the 3x3 convs of the stages and the FCABlocks (see conv3x3), in FCAResNetC1A1Cs,
+    FCAResNetB2A2 and FCAPatchSetNet.
+
+    head selects the input of dense1, in FCAResNetC1A1Cs and FCAResNetB2A2:
+        'dense': the flattened features of the last stage, (fftsize / 8) ** 2 pixels per channel
+        'pooled': the features average pooled to head_pool x head_pool pixels per channel, independent of fftsize
+        'lowrank': the flattened features, with dense1 a LowRankLinear of rank head_rank
+    head_width sets the outputs of dense1, see dense_width.
+    """
+    head = 'dense'  # class defaults, for the models pickled before the option existed
+    head_pool = 4
+    checkpoint_stages = ()
+
+    @staticmethod
+    def dense_width(first_inputchannels, fftsize, head='dense', head_pool=4, head_width=None):
+        """
+        Outputs of dense1: head_width, or int(sqrt(first_inputchannels)) * fftsize * 2 (the * 2 is the FFT padding
+        factor 2). The pooled head counts the fftsize whose last stage has head_pool x head_pool pixels,
+        8 * head_pool, so its width does not grow with fftsize either.
+        """
+        if head_width is not None:
+            return head_width
+        return int(math.sqrt(first_inputchannels)) * (8 * head_pool if head == 'pooled' else fftsize) * 2
+
+    def build_dense1(self, channels, fftsize, out_features, extra=0, head='dense', head_pool=4, head_rank=64):
+        """dense1 for the head option, extra: the inputs concatenated to the features (the level 1 outputs)."""
+        if head not in HEADS:
+            raise ValueError('Unknown head {}, one of {}'.format(head, HEADS))
+        self.head, self.head_pool = head, head_pool
+        pixels = head_pool ** 2 if head == 'pooled' else int(fftsize / 8) ** 2
+        if head == 'lowrank':
+            return LowRankLinear(channels * pixels + extra, out_features, head_rank)
+        return nn.Linear(channels * pixels + extra, out_features)
+
+    def flat_features(self, f4: torch.Tensor) -> torch.Tensor:
+        if self.head == 'pooled':
+            f4 = F.adaptive_avg_pool2d(f4, self.head_pool)
+        return self.flatten(f4)
+
+    def attention(self, x, cab, block):
+        if self.if_CAB:
+            x = cab(x)
+        return block(x)
+
+    def stage(self, x, cov, cab, block, k=None):
+        x = gelu(cov(x))
+        keep = x
+        if k in self.checkpoint_stages and self.training and torch.is_grad_enabled():
+            if torch.compiler.is_compiling():
+                # no context_fn under dynamo, the compiled recomputation does not update the BN statistics again
+                x = checkpoint(self.attention, x, cab, block, use_reentrant=False)
+            else:
+                x = checkpoint(self.attention, x, cab, block, use_reentrant=False,
+                               context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(cab, block)))
+        else:
+            x = self.attention(x, cab, block)
+        if self.skip_connection:
+            x = x + keep
+        return x
+
+    def features(self, x: torch.Tensor) -> torch.Tensor:
+        c1 = self.stage(x, self.cov0, self.cab1, self.block1, 1)
+        c2 = F.max_pool2d(c1, kernel_size=2, stride=2)
+        d2 = self.stage(c2, self.cov1, self.cab2, self.block2, 2)
+        c3 = F.max_pool2d(d2, kernel_size=2, stride=2)
+        e3 = self.stage(c3, self.cov2, self.cab3, self.block3, 3)
+        c4 = F.max_pool2d(e3, kernel_size=2, stride=2)  # alternate avg_pool
+        return self.stage(c4, self.cov3, self.cab4, self.block4, 4)
+
+
+class FCAResNet(FCAResNetBackbone):
     def __init__(self,
                  first_inputchannels=64, reduction=16,
-                 skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True):
+                 skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True, patch=32):
         super(FCAResNet, self).__init__()
         self.reduction = reduction
         self.skip_connection = skip_connection
@@ -165,9 +369,8 @@ class FCAResNet(nn.Module):
         self.if_FT = if_FT
         self.if_CAB = if_CAB
 
-        # patch = round(256 / math.sqrt(first_inputchannels))
-        # when first_inputchannels includes the reference,the int round make it still work.
-        patch = 32  # assuming that I will not tune the patch size later
+        # patch: the patch size of the data, the inputs are its 2 * patch FFTs (256 / patch) ** 2 channels for the
+        # 256 x 256 images, e.g. 64 channels of 64 x 64 for the default 32
 
         self.cab1 = CoordAttentionBlock(input_channels=first_inputchannels, reduction=self.reduction)
         self.cab2 = CoordAttentionBlock(input_channels=first_inputchannels * 2, reduction=self.reduction)
@@ -198,41 +401,7 @@ class FCAResNet(nn.Module):
         self.cov3 = nn.Conv2d(first_inputchannels * 4, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        c1 = gelu(self.cov0(x))
-        keep = gelu(self.cov0(x))
-        if self.if_CAB:
-            c1 = self.cab1(c1)
-        c1 = self.block1(c1)
-
-        if self.skip_connection:
-            c1 += keep
-        c2 = F.max_pool2d(c1, kernel_size=2, stride=2)
-
-        d2 = gelu(self.cov1(c2))
-        keep = gelu(self.cov1(c2))
-        if self.if_CAB:
-            d2 = self.cab2(d2)
-        d2 = self.block2(d2)
-        if self.skip_connection:
-            d2 += keep
-        c3 = F.max_pool2d(d2, kernel_size=2, stride=2)
-
-        e3 = gelu(self.cov2(c3))
-        keep = gelu(self.cov2(c3))
-        if self.if_CAB:
-            e3 = self.cab3(e3)
-        e3 = self.block3(e3)
-        if self.skip_connection:
-            e3 += keep
-        c4 = F.max_pool2d(e3, kernel_size=2, stride=2)  # alternate avg_pool
-
-        f4 = gelu(self.cov3(c4))
-        keep = gelu(self.cov3(c4))
-        if self.if_CAB:
-            f4 = self.cab4(f4)
-        f4 = self.block4(f4)
-        if self.skip_connection:
-            f4 += keep
+        f4 = self.features(x)
         flat = self.flatten(f4)
         final = gelu(self.dense1(flat))
         final = gelu(self.dense2(final))
@@ -242,7 +411,7 @@ class FCAResNet(nn.Module):
         return final
 
 
-class FCAResNetSecondOrder(nn.Module):
+class FCAResNetSecondOrder(FCAResNetBackbone):
     def __init__(self,
                  first_inputchannels=64, reduction=16,
                  skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True):
@@ -280,42 +449,7 @@ class FCAResNetSecondOrder(nn.Module):
         self.cov3 = nn.Conv2d(first_inputchannels * 4, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
 
     def forward(self, x: torch.Tensor, first: torch.Tensor) -> torch.Tensor:
-        c1 = gelu(self.cov0(x))
-        keep = gelu(self.cov0(x))
-        if self.if_CAB:
-            c1 = self.cab1(c1)
-        c1 = self.block1(c1)
-
-        if self.skip_connection:
-            c1 += keep
-        c2 = F.max_pool2d(c1, kernel_size=2, stride=2)
-
-        d2 = gelu(self.cov1(c2))
-        keep = gelu(self.cov1(c2))
-        if self.if_CAB:
-            d2 = self.cab2(d2)
-        d2 = self.block2(d2)
-        if self.skip_connection:
-            d2 += keep
-        c3 = F.max_pool2d(d2, kernel_size=2, stride=2)
-
-        e3 = gelu(self.cov2(c3))
-        keep = gelu(self.cov2(c3))
-        if self.if_CAB:
-            e3 = self.cab3(e3)
-        e3 = self.block3(e3)
-        if self.skip_connection:
-            e3 += keep
-        c4 = F.max_pool2d(e3, kernel_size=2, stride=2)  # alternate avg_pool
-
-        f4 = gelu(self.cov3(c4))
-        keep = gelu(self.cov3(c4))
-        if self.if_CAB:
-            f4 = self.cab4(f4)
-        f4 = self.block4(f4)
-        if self.skip_connection:
-            f4 += keep
-
+        f4 = self.features(x)
         flat = self.flatten(f4)
         final = torch.cat([flat, first], dim=1)
         final = gelu(self.dense1(final))
@@ -326,10 +460,11 @@ class FCAResNetSecondOrder(nn.Module):
         return final
 
 
-class FCAResNetC1A1Cs(nn.Module):
+class FCAResNetC1A1Cs(FCAResNetBackbone):
     def __init__(self,
                  first_inputchannels=4, reduction=16,
-                 skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True, fftsize=64):
+                 skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True, fftsize=64, head='dense', head_pool=4,
+                 head_rank=64, conv='dense', conv_groups=4, head_width=None):
         # fft_pad_factor and patch is not used and read from calling, leave here for code generality
         super(FCAResNetC1A1Cs, self).__init__()
         self.reduction = reduction
@@ -347,67 +482,33 @@ class FCAResNetC1A1Cs(nn.Module):
 
         self.block1 = nn.Sequential(
             *[FCABlock(input_channels=first_inputchannels, reduction=self.reduction, batch_norm=True,
-                       if_FT=self.if_FT)] * self.fca_block_n)
+                       if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
         self.block2 = nn.Sequential(
             *[FCABlock(input_channels=first_inputchannels * 2, reduction=self.reduction, batch_norm=True,
-                       if_FT=self.if_FT)] * self.fca_block_n)
+                       if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
         self.block3 = nn.Sequential(
             *[FCABlock(input_channels=first_inputchannels * 4, reduction=self.reduction, batch_norm=True,
-                       if_FT=self.if_FT)] * self.fca_block_n)
+                       if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
         self.block4 = nn.Sequential(
             *[FCABlock(input_channels=first_inputchannels * 4, reduction=self.reduction, batch_norm=True,
-                       if_FT=self.if_FT)] * self.fca_block_n)
-        self.cov0 = nn.Conv2d(first_inputchannels, first_inputchannels, kernel_size=3, stride=1, padding='same')
-        self.cov1 = nn.Conv2d(first_inputchannels, first_inputchannels * 2, kernel_size=3, stride=1, padding='same')
-        self.cov2 = nn.Conv2d(first_inputchannels * 2, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
-        self.dense1 = nn.Linear(first_inputchannels * 4 * int(self.fftsize / 8) ** 2,
-                                # the * 2 is the FFT padding factor 2.
-                                int(math.sqrt(first_inputchannels)) * self.fftsize * 2)
-        self.dense2 = nn.Linear(int(math.sqrt(first_inputchannels)) * self.fftsize * 2,
-                                64)  # the second 2 is the FFT padding factor 2.
+                       if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
+        self.cov0 = conv3x3(first_inputchannels, first_inputchannels, conv, conv_groups)
+        self.cov1 = conv3x3(first_inputchannels, first_inputchannels * 2, conv, conv_groups)
+        self.cov2 = conv3x3(first_inputchannels * 2, first_inputchannels * 4, conv, conv_groups)
+        # the * 2 is the FFT padding factor 2.
+        width = self.dense_width(first_inputchannels, self.fftsize, head, head_pool, head_width)
+        self.dense1 = self.build_dense1(first_inputchannels * 4, self.fftsize, width,
+                                        head=head, head_pool=head_pool, head_rank=head_rank)
+        self.dense2 = nn.Linear(width, 64)
 
         self.dense3 = nn.Linear(64, 3)  ##################### temp
         self.flatten = nn.Flatten()
 
-        self.cov3 = nn.Conv2d(first_inputchannels * 4, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
+        self.cov3 = conv3x3(first_inputchannels * 4, first_inputchannels * 4, conv, conv_groups)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        c1 = gelu(self.cov0(x))
-        keep = gelu(self.cov0(x))
-        if self.if_CAB:
-            c1 = self.cab1(c1)
-        c1 = self.block1(c1)
-
-        if self.skip_connection:
-            c1 += keep
-        c2 = F.max_pool2d(c1, kernel_size=2, stride=2)
-
-        d2 = gelu(self.cov1(c2))
-        keep = gelu(self.cov1(c2))
-        if self.if_CAB:
-            d2 = self.cab2(d2)
-        d2 = self.block2(d2)
-        if self.skip_connection:
-            d2 += keep
-        c3 = F.max_pool2d(d2, kernel_size=2, stride=2)
-
-        e3 = gelu(self.cov2(c3))
-        keep = gelu(self.cov2(c3))
-        if self.if_CAB:
-            e3 = self.cab3(e3)
-        e3 = self.block3(e3)
-        if self.skip_connection:
-            e3 += keep
-        c4 = F.max_pool2d(e3, kernel_size=2, stride=2)  # alternate avg_pool
-
-        f4 = gelu(self.cov3(c4))
-        keep = gelu(self.cov3(c4))
-        if self.if_CAB:
-            f4 = self.cab4(f4)
-        f4 = self.block4(f4)
-        if self.skip_connection:
-            f4 += keep
-        flat = self.flatten(f4)
+        f4 = self.features(x)
+        flat = self.flat_features(f4)
         final = gelu(self.dense1(flat))
         final = gelu(self.dense2(final))
         # final = torch.cat([final, cov], dim=1)
@@ -416,10 +517,11 @@ class FCAResNetC1A1Cs(nn.Module):
         return final
 
 
-class FCAResNetB2A2(nn.Module):
+class FCAResNetB2A2(FCAResNetBackbone):
     def __init__(self,
                  first_inputchannels=128, reduction=16,
-                 skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True, fftsize = 64):
+                 skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True, fftsize = 64, head='dense',
+                 head_pool=4, head_rank=64, conv='dense', conv_groups=4, head_width=None):
         super(FCAResNetB2A2, self).__init__()
         self.reduction = reduction
         self.skip_connection = skip_connection
@@ -435,69 +537,141 @@ class FCAResNetB2A2(nn.Module):
         self.fftsize = fftsize
 
         self.block1 = nn.Sequential(*[FCABlock(input_channels=first_inputchannels, reduction=self.reduction, batch_norm=True,
-                                               if_FT=self.if_FT)] * self.fca_block_n)
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
         self.block2 = nn.Sequential(*[FCABlock(input_channels=first_inputchannels * 2, reduction=self.reduction, batch_norm=True,
-                                               if_FT=self.if_FT)] * self.fca_block_n)
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
         self.block3 = nn.Sequential(*[FCABlock(input_channels=first_inputchannels * 4, reduction=self.reduction, batch_norm=True,
-                                               if_FT=self.if_FT)] * self.fca_block_n)
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
         self.block4 = nn.Sequential(*[FCABlock(input_channels=first_inputchannels * 4, reduction=self.reduction, batch_norm=True,
-                                               if_FT=self.if_FT)] * self.fca_block_n)
-        self.cov0 = nn.Conv2d(first_inputchannels, first_inputchannels, kernel_size=3, stride=1, padding='same')
-        self.cov1 = nn.Conv2d(first_inputchannels, first_inputchannels * 2, kernel_size=3, stride=1, padding='same')
-        self.cov2 = nn.Conv2d(first_inputchannels * 2, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
-        self.dense1 = nn.Linear(first_inputchannels * 4 * int(self.fftsize / 8) ** 2 + 3, ###################
-                                # the * 2 is the FFT padding factor 2.
-                                int(math.sqrt(first_inputchannels)) * self.fftsize * 2)
-        self.dense2 = nn.Linear(int(math.sqrt(first_inputchannels)) * self.fftsize * 2,
-                                64)  # the second 2 is the FFT padding factor 2.
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
+        self.cov0 = conv3x3(first_inputchannels, first_inputchannels, conv, conv_groups)
+        self.cov1 = conv3x3(first_inputchannels, first_inputchannels * 2, conv, conv_groups)
+        self.cov2 = conv3x3(first_inputchannels * 2, first_inputchannels * 4, conv, conv_groups)
+        # the * 2 is the FFT padding factor 2.
+        width = self.dense_width(first_inputchannels, self.fftsize, head, head_pool, head_width)
+        self.dense1 = self.build_dense1(first_inputchannels * 4, self.fftsize, width,
+                                        extra=3, head=head, head_pool=head_pool, head_rank=head_rank)
+        self.dense2 = nn.Linear(width, 64)
 
         self.dense3 = nn.Linear(64, 4)
         self.flatten = nn.Flatten()
 
-        self.cov3 = nn.Conv2d(first_inputchannels * 4, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
+        self.cov3 = conv3x3(first_inputchannels * 4, first_inputchannels * 4, conv, conv_groups)
 
     def forward(self, x: torch.Tensor, first: torch.Tensor) -> torch.Tensor:
-        c1 = gelu(self.cov0(x))
-        keep = gelu(self.cov0(x))
-        if self.if_CAB:
-            c1 = self.cab1(c1)
-        c1 = self.block1(c1)
+        f4 = self.features(x)
+        flat = self.flat_features(f4)
+        final = torch.cat([flat, first], dim=1)
+        final = gelu(self.dense1(final))
+        final = gelu(self.dense2(final))
+        # final = torch.cat([final, cov], dim=1)
+        final = self.dense3(final)
 
-        if self.skip_connection:
-            c1 += keep
-        c2 = F.max_pool2d(c1, kernel_size=2, stride=2)
+        return final
 
-        d2 = gelu(self.cov1(c2))
-        keep = gelu(self.cov1(c2))
-        if self.if_CAB:
-            d2 = self.cab2(d2)
-        d2 = self.block2(d2)
-        if self.skip_connection:
-            d2 += keep
-        c3 = F.max_pool2d(d2, kernel_size=2, stride=2)
 
-        e3 = gelu(self.cov2(c3))
-        keep = gelu(self.cov2(c3))
-        if self.if_CAB:
-            e3 = self.cab3(e3)
-        e3 = self.block3(e3)
-        if self.skip_connection:
-            e3 += keep
-        c4 = F.max_pool2d(e3, kernel_size=2, stride=2)  # alternate avg_pool
+AGGREGATIONS = ('attention', 'mean')
 
-        f4 = gelu(self.cov3(c4))
-        keep = gelu(self.cov3(c4))
-        if self.if_CAB:
-            f4 = self.cab4(f4)
-        f4 = self.block4(f4)
-        if self.skip_connection:
-            f4 += keep
 
-        flat = self.flatten(f4)
-        final = torch.cat([flat, first], dim=1)
+class PatchPositionEncoding(nn.Module):
+    """
+    Embedding of the position of each patch of an n x n grid: sin and cos of the row and column coordinates in
+    [-1, 1] at frequencies 2 ** k * pi, k < n_frequencies, mapped to out_features. Defined for any n.
+    """
+
+    def __init__(self, out_features: int, n_frequencies: int = 4) -> None:
+        super(PatchPositionEncoding, self).__init__()
+        self.register_buffer('frequencies', math.pi * 2. ** torch.arange(n_frequencies), persistent=False)
+        self.linear = nn.Linear(4 * n_frequencies, out_features)
+
+    def forward(self, n: int) -> torch.Tensor:
+        """Returns: (n * n, out_features), the patches in row major order as in PatchDataset"""
+        coords = torch.linspace(-1, 1, n, device=self.frequencies.device) if n > 1 else \
+            torch.zeros(1, device=self.frequencies.device)
+        rows, cols = torch.meshgrid(coords, coords, indexing='ij')
+        angles = torch.stack([rows.flatten(), cols.flatten()], -1)[..., None] * self.frequencies  # (n * n, 2, F)
+        return self.linear(torch.cat([torch.sin(angles), torch.cos(angles)], -1).flatten(1))
+
+
+class FCAPatchSetNet(FCAResNetBackbone):
+    """
+    Model for PatchDataset inputs (B, n_keys * N, s, s), the N patch spectra of each data key: the four FCAResNet
+    stages run on each patch (n_keys channels) as an item of the batch, with shared weights, and the patch features
+    with their position encoding are aggregated over the patches:
+        'attention': a learned query attends to the patches (heads heads)
+        'mean': mean of the patch features
+    The widths do not depend on the number of patches, so the same model takes any N = n * n and its cost is
+    linear in N. The aggregated features and first (the n_first lower order coefficients) give n_out values.
+    first_inputchannels and fftsize are not used, the patch count and size are read from the input; they stay in the
+    signature for BaseTrainer. The other model arguments come from the hyperdict 'model_kwargs'.
+    """
+
+    def __init__(self,
+                 first_inputchannels=8, reduction=4,
+                 skip_connection=True, fca_block_n=1, if_FT=True, if_CAB=True, fftsize=64, n_keys=2, width=8,
+                 aggregation='attention', heads=4, n_first=4, n_out=4, n_frequencies=4, conv='dense',
+                 conv_groups=4):
+        super(FCAPatchSetNet, self).__init__()
+        if aggregation not in AGGREGATIONS:
+            raise ValueError('Unknown aggregation {}, one of {}'.format(aggregation, AGGREGATIONS))
+        self.reduction = reduction
+        self.skip_connection = skip_connection
+        self.fca_block_n = fca_block_n
+        self.if_FT = if_FT
+        self.if_CAB = if_CAB
+        self.n_keys = n_keys
+        self.aggregation = aggregation
+
+        self.cab1 = CoordAttentionBlock(input_channels=width, reduction=self.reduction)
+        self.cab2 = CoordAttentionBlock(input_channels=width * 2, reduction=self.reduction)
+        self.cab3 = CoordAttentionBlock(input_channels=width * 4, reduction=self.reduction)
+        self.cab4 = CoordAttentionBlock(input_channels=width * 4, reduction=self.reduction)
+
+        self.block1 = nn.Sequential(*[FCABlock(input_channels=width, reduction=self.reduction, batch_norm=True,
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
+        self.block2 = nn.Sequential(*[FCABlock(input_channels=width * 2, reduction=self.reduction, batch_norm=True,
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
+        self.block3 = nn.Sequential(*[FCABlock(input_channels=width * 4, reduction=self.reduction, batch_norm=True,
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
+        self.block4 = nn.Sequential(*[FCABlock(input_channels=width * 4, reduction=self.reduction, batch_norm=True,
+                                               if_FT=self.if_FT, conv=conv, conv_groups=conv_groups)] * self.fca_block_n)
+        for m in self.modules():
+            if isinstance(m, FCAModule):
+                m.batch_roll = False  # the batch holds the patches of the samples
+        self.cov0 = conv3x3(n_keys, width, conv, conv_groups)
+        self.cov1 = conv3x3(width, width * 2, conv, conv_groups)
+        self.cov2 = conv3x3(width * 2, width * 4, conv, conv_groups)
+        self.cov3 = conv3x3(width * 4, width * 4, conv, conv_groups)
+
+        features = width * 4
+        self.position = PatchPositionEncoding(features, n_frequencies)
+        if aggregation == 'attention':
+            self.query = nn.Parameter(torch.zeros(1, 1, features))
+            self.attention_pool = nn.MultiheadAttention(features, heads, batch_first=True)
+        self.dense1 = nn.Linear(features + n_first, 64)
+        self.dense2 = nn.Linear(64, 64)
+        self.dense3 = nn.Linear(64, n_out)
+
+    def patch_features(self, x: torch.Tensor) -> torch.Tensor:
+        """(B, n_keys * N, s, s) to the features of each patch with its position encoding, (B, N, width * 4)"""
+        b, c, h, w = x.shape
+        n_patches = c // self.n_keys
+        n = math.isqrt(n_patches)
+        if n * n * self.n_keys != c:
+            raise ValueError('{} input channels are not {} keys of n x n patches'.format(c, self.n_keys))
+        x = x.reshape(b, self.n_keys, n_patches, h, w).transpose(1, 2).reshape(b * n_patches, self.n_keys, h, w)
+        f = self.features(x).mean(dim=(-2, -1)).reshape(b, n_patches, -1)
+        return f + self.position(n)
+
+    def forward(self, x: torch.Tensor, first: torch.Tensor) -> torch.Tensor:
+        f = self.patch_features(x)
+        if self.aggregation == 'attention':
+            f = self.attention_pool(self.query.expand(f.shape[0], -1, -1), f, f, need_weights=False)[0][:, 0]
+        else:
+            f = f.mean(1)
+        final = torch.cat([f, first], dim=1)
         final = gelu(self.dense1(final))
         final = gelu(self.dense2(final))
-        # final = torch.cat([final, cov], dim=1)
         final = self.dense3(final)
 
         return final
@@ -514,7 +688,13 @@ class TwoLevelTemplated(nn.Module):
                                           fca_block_n=hyperdict1['fca_block_n'],
                                           if_FT=hyperdict1['if_FT'],
                                           if_CAB=hyperdict1['if_CAB'],
-                                          fftsize=hyperdict1['fftcropsize'])
+                                          fftsize=hyperdict1['fftcropsize'],
+                                          head=hyperdict1.get('head', 'dense'),
+                                          head_pool=hyperdict1.get('head_pool', 4),
+                                          head_rank=hyperdict1.get('head_rank', 64),
+                                          conv=hyperdict1.get('conv', 'dense'),
+                                          conv_groups=hyperdict1.get('conv_groups', 4),
+                                          head_width=hyperdict1.get('head_width', None))
 
         self.secondmodel = FCAResNetB2A2(first_inputchannels= hyperdict2['first_inputchannels'],
                                          reduction=hyperdict2['reduction'],
@@ -522,7 +702,17 @@ class TwoLevelTemplated(nn.Module):
                                          fca_block_n=hyperdict2['fca_block_n'],
                                          if_FT=hyperdict2['if_FT'],
                                          if_CAB=hyperdict2['if_CAB'],
-                                         fftsize=hyperdict2['fftcropsize'])
+                                         fftsize=hyperdict2['fftcropsize'],
+                                         head=hyperdict2.get('head', 'dense'),
+                                         head_pool=hyperdict2.get('head_pool', 4),
+                                         head_rank=hyperdict2.get('head_rank', 64),
+                                         conv=hyperdict2.get('conv', 'dense'),
+                                         conv_groups=hyperdict2.get('conv_groups', 4),
+                                         head_width=hyperdict2.get('head_width', None))
+        set_spectrum_pool(self.firstmodel, hyperdict1.get('spectrum_pool', 1))
+        set_spectrum_pool(self.secondmodel, hyperdict2.get('spectrum_pool', 1))
+        set_checkpoint_stages(self.firstmodel, hyperdict1.get('checkpoint_stages', ()))
+        set_checkpoint_stages(self.secondmodel, hyperdict2.get('checkpoint_stages', ()))
 
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         first = self.firstmodel(x)
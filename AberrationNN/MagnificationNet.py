@@ -2,15 +2,10 @@ from torch import nn
 import torch.nn.functional as F
 import torch
 import math
-from AberrationNN.FCAResNet import FCABlock, CoordAttentionBlock
+from AberrationNN.FCAResNet import FCABlock, CoordAttentionBlock, FCAResNetBackbone, gelu
 
 
-def gelu(x):
-    cdf = 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
-    return x * cdf
-
-
-class MagnificationNet(nn.Module):
+class MagnificationNet(FCAResNetBackbone):
     def __init__(self,
                  first_inputchannels=4, reduction=1,
                  skip_connection=False, fca_block_n=2, if_FT=True, if_CAB=True, patch = 32, fft_pad_factor=4):
@@ -57,41 +52,7 @@ class MagnificationNet(nn.Module):
         self.cov3 = nn.Conv2d(first_inputchannels * 4, first_inputchannels * 4, kernel_size=3, stride=1, padding='same')
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        c1 = gelu(self.cov0(x))
-        keep = gelu(self.cov0(x))
-        if self.if_CAB:
-            c1 = self.cab1(c1)
-        c1 = self.block1(c1)
-
-        if self.skip_connection:
-            c1 += keep
-        c2 = F.max_pool2d(c1, kernel_size=2, stride=2)
-
-        d2 = gelu(self.cov1(c2))
-        keep = gelu(self.cov1(c2))
-        if self.if_CAB:
-            d2 = self.cab2(d2)
-        d2 = self.block2(d2)
-        if self.skip_connection:
-            d2 += keep
-        c3 = F.max_pool2d(d2, kernel_size=2, stride=2)
-
-        e3 = gelu(self.cov2(c3))
-        keep = gelu(self.cov2(c3))
-        if self.if_CAB:
-            e3 = self.cab3(e3)
-        e3 = self.block3(e3)
-        if self.skip_connection:
-            e3 += keep
-        c4 = F.max_pool2d(e3, kernel_size=2, stride=2)  # alternate avg_pool
-
-        f4 = gelu(self.cov3(c4))
-        keep = gelu(self.cov3(c4))
-        if self.if_CAB:
-            f4 = self.cab4(f4)
-        f4 = self.block4(f4)
-        if self.skip_connection:
-            f4 += keep
+        f4 = self.features(x)
         flat = self.flatten(f4)
         final = gelu(self.dense1(flat))
         final = gelu(self.dense2(final))
@@ -1,14 +1,23 @@
 # Reference:https://github.com/mardani72/Hyper-Parameter_optimization/blob/master/Hyper_Param_Facies_tf_final.ipynb
 
+import json
+import math
+import multiprocessing
+import os
+import time
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
 from AberrationNN.train_utils import *
 from AberrationNN.FCAResNet import FCAResNet
 from AberrationNN.dataset import Ronchi2fftDatasetAll
 import skopt
-from skopt import gp_minimize
 from skopt.space import Real, Categorical
-from skopt.utils import use_named_args
 import torch.utils.data as data
-import multiprocessing
+from AberrationNN.loader_utils import loader_kwargs, available_cpus
+from AberrationNN.telemetry import MemoryMonitor
 from skopt.plots import plot_convergence
 from skopt.plots import plot_objective, plot_evaluations
 from skopt.plots import plot_objective
@@ -36,21 +45,33 @@ dimensions = [data_patchsize,
               train_learning_rate,
               train_loss]
 
-default_parameters = [32, 16, True, False, 2, 32, 6e-4, torch.nn.SmoothL1Loss()]
+default_parameters = [32, 16, True, False, 2, 32, 6e-4, 'smoothl1']
+
+# loss told to the optimizer for trials that crashed, e.g. out of memory
+FAILED_LOSS = 1e3
+
+
+class TrialPruned(Exception):
+    """Raised by fitness when the pruner stops a trial, with the last validation loss reported."""
+
+    def __init__(self, loss):
+        super().__init__(loss)
+        self.loss = loss
 
 
 # Initiate model
 def create_model(_data_patchsize, _model_reduction, _model_ft, _model_skipconnection, _model_blockN):
-    device = torch.device('cuda')
-    set_train_rng(1)
-    torch.cuda.empty_cache()
+    init_seeds(1)
     model = FCAResNet(first_inputchannels=int(256 / _data_patchsize) ** 2, reduction=int(_model_reduction),
-                      skip_connection=_model_skipconnection, fca_block_n=int(_model_blockN), if_FT=_model_ft)
+                      skip_connection=_model_skipconnection, fca_block_n=int(_model_blockN), if_FT=_model_ft,
+                      patch=int(_data_patchsize))
     return model
 
 
-def fit(epochs, model, data_loader_train, data_loader_test, _train_batchsize, _train_learning_rate, _train_loss):
-    device = torch.device('cuda')
+def fit(epochs, model, data_loader_train, data_loader_test, _train_batchsize, _train_learning_rate, _train_loss,
+        device='cuda', print_freq=100, should_stop=None):
+    """should_stop(i, testloss_total) is called after every iteration, training ends early when it returns True."""
+    device = torch.device(device)
     model.to(device)
     params = [p for p in model.parameters() if p.requires_grad]
     optimizer = torch.optim.Adam(params)
@@ -58,15 +79,17 @@ def fit(epochs, model, data_loader_train, data_loader_test, _train_batchsize, _t
     trainloss_total = []
     testloss_total = []
     record = time.time()
+    memory = MemoryMonitor(device)
 
     for i, ((images_train, targets_train), (images_test, targets_test)) in \
             enumerate(zip(data_loader_train, data_loader_test)):
 
         ###Train###
+        model.train()
         optimizer.zero_grad()  # stop accumulation of old gradients
         optimizer.param_groups[0]['lr'] = _train_learning_rate
         images_train = images_train.to(device)
-        targets = targets_train.to(device)
+        targets = targets_train[:, :3].to(device)  # FCAResNet predicts the first order C10, C12a, C12b
         pred = model(images_train)
         if _train_loss == 'smoothl1':
             lossfunc = torch.nn.SmoothL1Loss()
@@ -81,7 +104,7 @@ def fit(epochs, model, data_loader_train, data_loader_test, _train_batchsize, _t
         trainloss_total.append(trainloss.item())
         ###Test###
         images_test = images_test.to(device)
-        targets = targets_test.to(device)
+        targets = targets_test[:, :3].to(device)
         model.eval()
         with torch.no_grad():
             pred = model(images_test)
@@ -90,79 +113,340 @@ def fit(epochs, model, data_loader_train, data_loader_test, _train_batchsize, _t
 
         del images_train, images_test, targets
 
-        if i % 100 == 0:
+        if i % print_freq == 0:
             print("Epoch{}\t".format(i), "Train Loss {:.3f}".format(trainloss.item()))
-            print("Epoch{}\t".format(i), "Test Loss {:.3f}".format(trainloss.item()),
+            print("Epoch{}\t".format(i), "Test Loss {:.3f}".format(testloss.item()),
                   'Cost: {}\t s.'.format(time.time() - record))
-            gpu_usage = get_gpu_info(torch.cuda.current_device())
-            print('GPU memory usage: {}/{}'.format(gpu_usage[0], gpu_usage[1]))
+            print(MemoryMonitor.format(memory.sample()))
             record = time.time()
 
         if i == (epochs - 1):
             break
+        if should_stop is not None and should_stop(i, testloss_total):
+            break
 
     return trainloss_total, testloss_total, model
 
 
-path_best_model = '/srv/home/jwei74/AberrationEstimation/best.pt'
-# define global variable to store accuracy
-minimal_loss = 0.0
-
-
-@use_named_args(dimensions=dimensions)
-def fitness(data_patchsize,
-            model_reduction,
-            model_ft,
-            model_skipconnection,
-            model_blockN,
-            train_batchsize,
-            train_learning_rate,
-            train_loss):
+def fitness(data_path, data_patchsize, model_reduction, model_ft, model_skipconnection, model_blockN,
+            train_batchsize, train_learning_rate, train_loss, epochs=1000, device='cuda', loader_workers=None,
+            model_path=None, pruner=None, trial_id=None):
+    """
+    Train one model with the hyperparameters of a trial and return its final test loss.
+    loader_workers: DataLoader workers of each loader, None to derive them from the cores of the process
+    model_path: where to save the trained model
+    pruner: SuccessiveHalving to stop unpromising trials, then TrialPruned is raised when trial_id is stopped
+    """
     print('data_patchsize', data_patchsize, 'model_reduction', model_reduction, 'model_ft', model_ft,
           'model_skipconnection', model_skipconnection, 'model_blockN', model_blockN, 'train_batchsize',
           train_batchsize, 'train_learning_rate: {0:.1e}'.format(train_learning_rate), 'train_loss', train_loss)
 
-    dataset = Ronchi2fftDataset2nd('/srv/home/jwei74/AberrationEstimation/abtem_sto100/focusstep200nm_uniform_k_cov/',
-                                   filestart=0, filenum=160, nimage=50, normalization=False, transform=None,
+    dataset = Ronchi2fftDatasetAll(data_path, filestart=0, normalization=False, transform=None,
                                    patch=data_patchsize, imagesize=512, downsampling=2)
     # TODO: change this to concat datasets with augmentation
     ##################################################
-    epochs = 1000
     aug_dataset = data.ConcatDataset([dataset] * 30)
-    device = torch.device('cuda')
+    device = torch.device(device)
     ##################################################
     indices = torch.randperm(len(aug_dataset)).tolist()
     dataset_train = torch.utils.data.Subset(aug_dataset, indices[:-int(0.3 * len(aug_dataset))])
     dataset_test = torch.utils.data.Subset(aug_dataset, indices[-int(0.3 * len(aug_dataset)):])
-    pool = multiprocessing.Pool()
+    pms = None if loader_workers is None else {'num_workers': loader_workers}
     d_train = torch.utils.data.DataLoader(
-        dataset_train, batch_size=train_batchsize, shuffle=True, pin_memory=True, num_workers=pool._processes - 8)
+        dataset_train, batch_size=train_batchsize, shuffle=True, **loader_kwargs(device, pms, loader_index=0))
 
     d_test = torch.utils.data.DataLoader(
-        dataset_test, batch_size=train_batchsize, shuffle=False, pin_memory=True, num_workers=pool._processes - 8)
+        dataset_test, batch_size=train_batchsize, shuffle=False, **loader_kwargs(device, pms, loader_index=1))
 
     model = create_model(data_patchsize, model_reduction, model_ft, model_skipconnection, model_blockN)
 
+    pruned = []
+    should_stop = None
+    if pruner is not None:
+        def should_stop(i, losses):
+            if pruner(trial_id, i, losses):
+                pruned.append(i)
+                return True
+            return False
     trainloss_history, testloss_history, model_trained = fit(epochs, model, d_train, d_test, train_batchsize,
-                                                             train_learning_rate,
-                                                             train_loss)
-    plot_losses(trainloss_history, testloss_history)
-    print("loss: ".format(testloss_history[-1]))
-    global minimal_loss
-    if testloss_history[-1] < minimal_loss:
-        torch.save(model_trained, path_best_model)
-        minimal_loss = testloss_history[-1]
-    del model, model_trained
+                                                             train_learning_rate, train_loss, device=device,
+                                                             should_stop=should_stop)
+    if pruned:
+        print('Trial {} pruned at iteration {}'.format(trial_id, pruned[0]))
+        raise TrialPruned(pruner.rung_value(testloss_history))
+    print("loss: {}".format(testloss_history[-1]))
+    if model_path is not None:
+        torch.save(model_trained, model_path)
     # Scikit-optimize does minimization
     return testloss_history[-1]
 
 
-# test = fitness(x=default_parameters)
-#
-# search_result = gp_minimize(func=fitness,
-#                             dimensions=dimensions,
-#                             acq_func='EI', # Expected Improvement.
-#                             n_calls=40,
-#                             x0=default_parameters)
+class TrialDB:
+    """
+    Trial history of a search in a sqlite file, so that an interrupted search can continue where it stopped.
+    Each trial has its hyperparameters (json), a status (running, done, pruned or failed) and the final loss.
+    The intermediate validation losses at the successive halving rungs are in the reports table.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)  # the trial processes write their reports concurrently
+        self.conn.execute('CREATE TABLE IF NOT EXISTS trials (id INTEGER PRIMARY KEY, params TEXT, status TEXT, '
+                          'loss REAL, started TEXT, finished TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS reports (trial_id INTEGER, rung INTEGER, iteration INTEGER, '
+                          'loss REAL, PRIMARY KEY (trial_id, rung))')
+        self.conn.commit()
+
+    def add(self, params):
+        cur = self.conn.execute('INSERT INTO trials (params, status, started) VALUES (?, ?, ?)',
+                                (json.dumps(params), 'running', datetime.now().isoformat()))
+        self.conn.commit()
+        return cur.lastrowid
+
+    def restart(self, trial_id):
+        self.conn.execute('UPDATE trials SET started = ? WHERE id = ?', (datetime.now().isoformat(), trial_id))
+        self.conn.execute('DELETE FROM reports WHERE trial_id = ?', (trial_id,))
+        self.conn.commit()
+
+    def report(self, trial_id, rung, iteration, loss):
+        self.conn.execute('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?)', (trial_id, rung, iteration, loss))
+        self.conn.commit()
+
+    def rung_losses(self, rung):
+        """Validation losses of all the trials that reached the rung."""
+        return [loss for (loss,) in self.conn.execute('SELECT loss FROM reports WHERE rung = ?', (rung,))]
+
+    def iterations(self, epochs):
+        """Training iterations spent on the completed and pruned trials, with epochs iterations per full trial."""
+        total = epochs * len(self.trials('done'))
+        for trial_id, _, _ in self.trials('pruned'):
+            row = self.conn.execute('SELECT MAX(iteration) FROM reports WHERE trial_id = ?', (trial_id,)).fetchone()
+            total += row[0] + 1
+        return total
+
+    def finish(self, trial_id, loss, status='done'):
+        self.conn.execute('UPDATE trials SET status = ?, loss = ?, finished = ? WHERE id = ?',
+                          (status, loss, datetime.now().isoformat(), trial_id))
+        self.conn.commit()
+
+    def trials(self, status=None):
+        """List of (id, params, loss) of the trials, optionally only those with the given status."""
+        query, args = 'SELECT id, params, loss FROM trials', ()
+        if status is not None:
+            query, args = query + ' WHERE status = ?', (status,)
+        return [(i, json.loads(p), loss) for i, p, loss in self.conn.execute(query + ' ORDER BY id', args)]
+
+    def best(self):
+        """(id, params, loss) of the trial with the lowest loss, or None."""
+        done = self.trials('done')
+        return min(done, key=lambda t: t[2]) if done else None
+
+    def close(self):
+        self.conn.close()
+
+
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving (ASHA, https://arxiv.org/abs/1810.05934) over the training iterations.
+    The rungs are at min_budget * eta**k iterations. A trial reaching a rung reports its validation loss (mean of the
+    last test losses) and continues only if the loss is in the best 1/eta of the losses reported at that rung so far,
+    so only about 1/eta of the trials are promoted to each longer budget. The first trial at a rung is promoted.
+    The reports go through the TrialDB file, so the decisions take the trials of all the worker processes into
+    account.
+    """
+
+    def __init__(self, db_path, min_budget=30, max_budget=1000, eta=3, window=20):
+        self.db_path = db_path
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.eta = eta
+        self.window = window
+        self.rungs = []
+        budget = min_budget
+        while budget < max_budget:
+            self.rungs.append(budget)
+            budget *= eta
+
+    def rung_value(self, losses):
+        return float(np.mean(losses[-self.window:]))
+
+    def __call__(self, trial_id, iteration, losses):
+        """Whether trial_id should stop after iteration, given its test losses so far."""
+        if iteration + 1 not in self.rungs:
+            return False
+        rung = self.rungs.index(iteration + 1)
+        value = self.rung_value(losses)
+        db = TrialDB(self.db_path)
+        try:
+            db.report(trial_id, rung, iteration, value)
+            competing = sorted(db.rung_losses(rung))
+        finally:
+            db.close()
+        n_promoted = max(len(competing) // self.eta, 1)
+        return value > competing[n_promoted - 1]
+
+
+def init_trial_worker(threads):
+    """Initializer of the trial processes: the torch and OpenMP threads of each trial are limited to threads."""
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+    torch.set_num_threads(threads)
+
+
+def _to_params(x):
+    """A point of the search space as a json-friendly dict of hyperparameters."""
+    return {dim.name: v.item() if hasattr(v, 'item') else v for dim, v in zip(dimensions, x)}
+
+
+def _to_point(params):
+    return [params[dim.name] for dim in dimensions]
+
+
+def _ask(optimizer, running, n):
+    """
+    n new points, with the points of the running trials told to a copy of the optimizer with the best loss so far
+    (constant liar), so that the new points are not proposed next to them.
+    """
+    if running:
+        optimizer = optimizer.copy(random_state=optimizer.rng.randint(0, 2 ** 31 - 1))
+        optimizer.tell([_to_point(p) for p in running], [min(optimizer.yi, default=0.)] * len(running))
+    return optimizer.ask(n_points=n) if n > 1 else [optimizer.ask()]
+
+
+def search(data_path, db_path, n_trials=40, q=4, n_workers=None, threads_per_worker=None, epochs=1000,
+           device='cpu', loader_workers=0, best_model_path=None, acq_func='EI', random_state=0, min_budget=None,
+           eta=3):
+    """
+    Asynchronous parallel Bayesian optimization with the skopt ask/tell interface. q trials run at a time in
+    n_workers processes; whenever one finishes, its loss is told back and a new point is proposed, with the running
+    points told as constant lies.
+    The trials are stored in the sqlite file db_path. Calling search again with the same db_path continues the
+    search: the finished trials are told to the new optimizer, and trials left running by an interruption are run
+    again first.
+    With min_budget, the trials are pruned by SuccessiveHalving from their intermediate validation losses (ASHA, the
+    freed worker takes a new trial at once), and the pruned trials are told to the optimizer with their loss at the
+    rung where they stopped.
+    Args:
+        data_path: dataset folder for Ronchi2fftDatasetAll
+        db_path: sqlite file of the trial history
+        n_trials: total number of trials, including those already in the database
+        q: trials running at a time
+        n_workers: trial processes, default q
+        threads_per_worker: torch threads of each trial, default the available cores divided by n_workers
+        epochs: training iterations per trial
+        loader_workers: DataLoader workers of each trial, 0 loads in the trial process
+        best_model_path: where to keep the model of the best trial
+        min_budget: iterations of the first successive halving rung, None trains every trial for all the epochs
+        eta: successive halving reduction factor, about 1/eta of the trials are promoted to each next rung
+    Returns: (params, loss) of the best trial
+    """
+    n_workers = n_workers or q
+    threads_per_worker = threads_per_worker or max(len(available_cpus()) // n_workers, 1)
+    db = TrialDB(db_path)
+    finished = [(params, loss) for _, params, loss in db.trials('done') + db.trials('pruned')] + \
+               [(params, FAILED_LOSS) for _, params, _ in db.trials('failed')]
+    pruner = SuccessiveHalving(db_path, min_budget, epochs, eta) if min_budget else None
+    # a resumed search draws new random points instead of repeating the first ones
+    optimizer = skopt.Optimizer(dimensions, base_estimator='GP', acq_func=acq_func,
+                                random_state=random_state + len(finished), n_initial_points=max(2 * q, 10))
+    if finished:
+        optimizer.tell([_to_point(p) for p, _ in finished], [loss for _, loss in finished])
+        print('Resumed the search with {} finished trials'.format(len(finished)))
+    if not db.trials():
+        # start from the default hyperparameters
+        db.add(_to_params(default_parameters))
+    best = db.best()
+    best_loss = best[2] if best else float('inf')
+    model_dir = os.path.dirname(os.path.abspath(best_model_path)) if best_model_path else None
+
+    ctx = multiprocessing.get_context('spawn')  # no forked CUDA or OpenMP state in the trials
+    new_pool = lambda: ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=init_trial_worker,
+                                           initargs=(threads_per_worker,))
+    pool = new_pool()
+    futures = {}
+
+    def submit(trial_id, params):
+        model_path = os.path.join(model_dir, 'trial{}.pt'.format(trial_id)) if model_dir else None
+        futures[pool.submit(fitness, data_path, epochs=epochs, device=device, loader_workers=loader_workers,
+                            model_path=model_path, pruner=pruner, trial_id=trial_id,
+                            **params)] = (trial_id, params, model_path)
+
+    try:
+        # trials left running by an interruption (and the default point) first
+        for trial_id, params, _ in db.trials('running'):
+            db.restart(trial_id)
+            submit(trial_id, params)
+        while True:
+            # keep q trials running: a worker freed by a pruned trial gets a new point at once
+            n_new = min(q - len(futures), n_trials - len(db.trials()))
+            if n_new > 0:
+                for x in _ask(optimizer, [params for _, params, _ in futures.values()], n_new):
+                    params = _to_params(x)
+                    submit(db.add(params), params)
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                trial_id, params, model_path = futures.pop(future)
+                status = 'done'
+                try:
+                    loss = float(future.result())
+                    if not math.isfinite(loss):
+                        raise ValueError('loss is {}'.format(loss))
+                    db.finish(trial_id, loss)
+                except TrialPruned as e:
+                    loss, status = e.loss, 'pruned'
+                    db.finish(trial_id, loss, status=status)
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):  # a trial process was killed, e.g. out of memory
+                        broken = True
+                    print('Trial {} failed: {}'.format(trial_id, e))
+                    loss, status = FAILED_LOSS, 'failed'
+                    db.finish(trial_id, None, status=status)
+                print('Trial {} {} -> {:.4g} ({})'.format(trial_id, params, loss, status))
+                # only the fully trained trials compete for best_model_path, as in db.best()
+                if model_path and os.path.exists(model_path):
+                    if status == 'done' and loss < best_loss:
+                        os.replace(model_path, best_model_path)
+                    else:
+                        os.remove(model_path)
+                if status == 'done':
+                    best_loss = min(best_loss, loss)
+                optimizer.tell(_to_point(params), loss)
+            if broken:  # the other trials of the broken pool fail too, they are collected by the next waits
+                pool.shutdown(cancel_futures=True)
+                pool = new_pool()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    best = db.best()
+    print('Training iterations: {} for {} trials, {} without pruning'.format(
+        db.iterations(epochs), len(db.trials()) - len(db.trials('failed')),
+        epochs * (len(db.trials()) - len(db.trials('failed')))))
+    db.close()
+    return (best[1], best[2]) if best else (None, None)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parallel Bayesian optimization of the FCAResNet hyperparameters')
+    parser.add_argument('--data_path', required=True)
+    parser.add_argument('--db', default='bo_trials.sqlite', help='trial history, reused to resume a search')
+    parser.add_argument('--n_trials', type=int, default=40)
+    parser.add_argument('--q', type=int, default=4, help='trials running in parallel')
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=1000)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--best_model_path', default='best.pt')
+    parser.add_argument('--min_budget', type=int, default=None, help='first successive halving rung (iterations)')
+    parser.add_argument('--eta', type=int, default=3)
+    args = parser.parse_args()
 
-# search_result.x, search_result.fun,
\ No newline at end of file
+    best_params, best_loss = search(args.data_path, args.db, n_trials=args.n_trials, q=args.q,
+                                    n_workers=args.n_workers, threads_per_worker=args.threads_per_worker,
+                                    epochs=args.epochs, device=args.device, best_model_path=args.best_model_path,
+                                    min_budget=args.min_budget, eta=args.eta)
+    print('Best trial: {} loss {}'.format(best_params, best_loss))
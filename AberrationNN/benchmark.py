@@ -0,0 +1,497 @@
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from AberrationNN.FCAResNet import FCAResNet, FCAResNetC1A1Cs, FCAResNetB2A2, TwoLevelTemplated, FCAModule, HEADS, \
+    set_checkpoint_stages, FCAPatchSetNet, AGGREGATIONS, CONVS
+from AberrationNN.MagnificationNet import MagnificationNet
+from AberrationNN.profiling import time_step, summarize, allocated_bytes, peak_allocated_bytes
+from AberrationNN.train_utils import compile_model
+
+MODEL_NAMES = ('FCAResNet', 'FCAResNetC1A1Cs', 'FCAResNetB2A2', 'MagnificationNet', 'TwoLevelTemplated')
+
+
+def level_hyperdicts(fftsize=64):
+    """Level 1 and level 2 hyperdicts of a TwoLevelTemplated of the usual size, for benchmarks."""
+    common = dict(skip_connection=True, fca_block_n=2, if_FT=True, if_CAB=True, fftcropsize=fftsize)
+    return (dict(first_inputchannels=4, reduction=1, **common),
+            dict(first_inputchannels=32, reduction=4, **common))
+
+
+def build_benchmark_model(name, batchsize=8, fftsize=64, hyperdict1=None, hyperdict2=None):
+    """
+    A model of the FCAResNet family with random weights and a random input batch of the matching shape.
+    Returns: model, tuple of inputs
+    """
+    if name == 'FCAResNet':  # the dense layers are fixed to 64 x 64 inputs
+        return FCAResNet(first_inputchannels=16, reduction=4), (torch.randn(batchsize, 16, 64, 64),)
+    if name == 'FCAResNetC1A1Cs':
+        return (FCAResNetC1A1Cs(first_inputchannels=4, reduction=1, skip_connection=True, fftsize=fftsize),
+                (torch.randn(batchsize, 4, fftsize, fftsize),))
+    if name == 'FCAResNetB2A2':
+        return (FCAResNetB2A2(first_inputchannels=32, reduction=4, skip_connection=True, fftsize=fftsize),
+                (torch.randn(batchsize, 32, fftsize, fftsize), torch.randn(batchsize, 3)))
+    if name == 'MagnificationNet':
+        return (MagnificationNet(first_inputchannels=4, reduction=1, patch=fftsize // 4, fft_pad_factor=4),
+                (torch.randn(batchsize, 4, fftsize, fftsize),))
+    if name == 'TwoLevelTemplated':
+        if hyperdict1 is None:
+            hyperdict1, hyperdict2 = level_hyperdicts(fftsize)
+        return (TwoLevelTemplated(hyperdict1, hyperdict2),
+                (torch.randn(batchsize, hyperdict1['first_inputchannels'], hyperdict1['fftcropsize'],
+                             hyperdict1['fftcropsize']),
+                 torch.randn(batchsize, hyperdict2['first_inputchannels'], hyperdict2['fftcropsize'],
+                             hyperdict2['fftcropsize'])))
+    raise ValueError('Unknown model {}'.format(name))
+
+
+def train_step_fn(model, forward, inputs):
+    """One training step (forward, backward, SGD update) of model, with forward the eager or compiled module."""
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-6, momentum=0.9)
+    model.train()
+
+    def step():
+        optimizer.zero_grad()
+        forward(*inputs).float().pow(2).mean().backward()
+        optimizer.step()
+    return step
+
+
+def benchmark_compile(names=MODEL_NAMES, batchsize=8, fftsize=64, n_iter=10, warmup=3, mode=None, train=True,
+                      cache_dir=None):
+    """
+    Eager vs torch.compile step time of the FCAResNet family, on the current default device (CPU).
+    The compiled model is checked for graph breaks and against the eager output first.
+    Returns: list of dicts per model with the compile time, the eager and compiled step time and the speedup
+    """
+    import torch._dynamo  # imported here, so that importing this module does not load dynamo
+
+    results = []
+    for name in names:
+        torch.manual_seed(0)
+        model, inputs = build_benchmark_model(name, batchsize, fftsize)
+        explained = torch._dynamo.explain(model)(*inputs)
+        compiled = compile_model(model, mode=mode, cache_dir=cache_dir)
+
+        start = time.perf_counter()
+        model.eval()
+        with torch.no_grad():
+            max_diff = (compiled(*inputs) - model(*inputs)).abs().max().item()
+        if train:
+            step = train_step_fn(model, compiled, inputs)
+            step()
+        compile_s = time.perf_counter() - start
+
+        if train:
+            eager = time_step(train_step_fn(model, model, inputs), n_iter, warmup)
+            fast = time_step(train_step_fn(model, compiled, inputs), n_iter, warmup)
+        else:
+            with torch.inference_mode():
+                eager = time_step(lambda: model(*inputs), n_iter, warmup)
+            with torch.no_grad():
+                fast = time_step(lambda: compiled(*inputs), n_iter, warmup)
+        result = {'model': name, 'batchsize': batchsize, 'fftsize': fftsize, 'train': train,
+                  'graph_breaks': explained.graph_break_count, 'max_abs_diff': max_diff, 'compile_s': compile_s,
+                  'eager': summarize(eager), 'compiled': summarize(fast)}
+        result['speedup'] = result['eager']['median_ms'] / result['compiled']['median_ms']
+        print('{model}: eager {eager[median_ms]:.1f} ms, compiled {compiled[median_ms]:.1f} ms, speedup '
+              '{speedup:.2f}x, compile {compile_s:.0f} s, graph breaks {graph_breaks}, max diff '
+              '{max_abs_diff:.1e}'.format(**result))
+        results.append(result)
+    return results
+
+
+def fca_fft2_reference(module, x):
+    """FCAModule.forward as it was with the full fft2 and fftshift, the reference for benchmark_fca."""
+    out = torch.abs(torch.fft.fftshift(torch.fft.fft2(x)))
+    out = torch.mean(torch.nn.functional.relu(module.cov(out)), axis=(-2, -1), keepdims=True)
+    if module.reduction != 1:
+        out = torch.sigmoid(module.cov2back(torch.nn.functional.relu(module.cov2(out))))
+    else:
+        out = torch.sigmoid(out)
+    return torch.multiply(x, out)
+
+
+def benchmark_fca(fftsizes=(64, 128), channels=(4, 32), batchsize=8, reduction=1, n_iter=20, warmup=3,
+                  spectrum_pools=(1, 2)):
+    """
+    FCAModule forward + backward with rfft2 and the half-spectrum weights, against the full fft2 and fftshift, on
+    CPU. Reports the max abs difference of the output, the step time and the bytes allocated per step.
+    Returns: list of dicts per fftsize, channel count and spectrum_pool
+    """
+    results = []
+    for fftsize in fftsizes:
+        for c in channels:
+            torch.manual_seed(0)
+            module = FCAModule(c, reduction, if_FT=True)
+            x = torch.randn(batchsize, c, fftsize, fftsize, requires_grad=True)
+            reference = fca_fft2_reference(module, x)
+
+            def ref_step():
+                fca_fft2_reference(module, x).sum().backward()
+            t_ref, mem_ref = time_step(ref_step, n_iter, warmup), allocated_bytes(ref_step)
+            for pool in spectrum_pools:
+                module.spectrum_pool = pool
+
+                def step():
+                    module(x).sum().backward()
+                with torch.no_grad():
+                    diff = (module(x) - reference).abs().max().item()
+                result = {'fftsize': fftsize, 'channels': c, 'batchsize': batchsize, 'spectrum_pool': pool,
+                          'max_abs_diff': diff, 'fft2': summarize(t_ref), 'rfft2': summarize(time_step(step, n_iter, warmup)),
+                          'fft2_alloc_mb': mem_ref / 2 ** 20, 'rfft2_alloc_mb': allocated_bytes(step) / 2 ** 20}
+                result['speedup'] = result['fft2']['median_ms'] / result['rfft2']['median_ms']
+                print('fftsize {fftsize} channels {channels} pool {spectrum_pool}: fft2 {fft2[median_ms]:.2f} ms '
+                      '{fft2_alloc_mb:.0f} MiB, rfft2 {rfft2[median_ms]:.2f} ms {rfft2_alloc_mb:.0f} MiB, speedup '
+                      '{speedup:.2f}x, max diff {max_abs_diff:.1e}'.format(**result))
+                results.append(result)
+    return results
+
+
+def estimator_hyperdicts(fftsize=64, imagesize=128, patch=32, n_keys=2):
+    """Level hyperdicts with the data keys of a ronchigram pair, for benchmarks of the whole inference path."""
+    data = dict(data_keys=list(range(n_keys)), normalization=True, pre_normalization=True, imagesize=imagesize,
+                if_HP=True, if_reference=True, downsampling=1, fft_pad_factor=2, fftcropsize=fftsize)
+    h1, h2 = level_hyperdicts(fftsize)
+    h1.update(data, patch=imagesize, first_inputchannels=n_keys)
+    h2.update(data, patch=patch, first_inputchannels=n_keys * (imagesize // patch) ** 2)
+    return h1, h2
+
+
+def benchmark_estimator(batchsize=64, fftsize=64, imagesize=128, patch=32, n_keys=2, n_iter=10, warmup=2,
+                        savepath=None, device='cpu'):
+    """
+    Latency of AberrationEstimator (preprocessing of the raw ronchigrams and inference) for one batch.
+    Without savepath, a TwoLevelTemplated with random weights is written to a temporary training folder.
+    The raw ronchigrams are 2 * imagesize wide, as in the simulated datasets.
+    Returns: dict with the latency of the preprocessing alone and of the whole call
+    """
+    from AberrationNN.inference import AberrationEstimator
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        if savepath is None:
+            savepath = tmp
+            h1, h2 = estimator_hyperdicts(fftsize, imagesize, patch, n_keys)
+            for name, h in (('hyperdict1.json', h1), ('hyperdict2.json', h2)):
+                with open(os.path.join(tmp, name), 'w') as fp:
+                    json.dump(h, fp)
+            torch.save({'ema': TwoLevelTemplated(h1, h2).eval()}, os.path.join(tmp, 'model_bestepoch.tar'))
+        estimator = AberrationEstimator(savepath, reference=torch.rand(n_keys, imagesize, imagesize).numpy(),
+                                        device=device, batchsize=batchsize)
+        images = torch.rand(batchsize, n_keys, 2 * imagesize, 2 * imagesize)
+        preprocess = estimator.build_preprocess(images.shape[-2:])
+        with torch.inference_mode():
+            t_pre = time_step(lambda: preprocess(images.to(estimator.device)), n_iter, warmup)
+        t_all = time_step(lambda: estimator(images), n_iter, warmup)
+    result = {'batchsize': batchsize, 'fftsize': fftsize, 'imagesize': imagesize, 'patch': patch,
+              'threads': torch.get_num_threads(), 'preprocess': summarize(t_pre), 'total': summarize(t_all)}
+    result['per_pair_ms'] = result['total']['median_ms'] / batchsize
+    print('batch {batchsize}: preprocessing {preprocess[median_ms]:.0f} ms, total {total[median_ms]:.0f} ms '
+          '(p90 {total[p90_ms]:.0f} ms), {per_pair_ms:.1f} ms per pair, {threads} threads'.format(**result))
+    return result
+
+
+def benchmark_optimize(names=MODEL_NAMES, batchsize=8, fftsize=64, n_iter=10, warmup=3):
+    """
+    Inference latency of the FCAResNet family before and after optimize_for_inference, with contiguous and
+    channels_last weights and with the traced and frozen graph, each checked against the eager outputs.
+    Returns: list of dicts per model with the latency and max abs difference of each variant
+    """
+    from AberrationNN.inference import optimize_for_inference
+    results = []
+    for name in names:
+        torch.manual_seed(0)
+        model, inputs = build_benchmark_model(name, batchsize, fftsize)
+        model.eval()
+        last = tuple(x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x for x in inputs)
+        variants = {'eager': (model, inputs),
+                    'folded': (optimize_for_inference(model, channels_last=False), inputs),
+                    'folded_channels_last': (optimize_for_inference(model), last),
+                    'folded_jit': (optimize_for_inference(model, channels_last=False, example_inputs=inputs), inputs),
+                    'folded_jit_channels_last': (optimize_for_inference(model, example_inputs=inputs), last)}
+        result = {'model': name, 'batchsize': batchsize, 'fftsize': fftsize}
+        with torch.no_grad():
+            expected = model(*inputs)
+            for key, (m, x) in variants.items():
+                result[key] = summarize(time_step(lambda: m(*x), n_iter, warmup))
+                result[key]['max_abs_diff'] = (m(*x) - expected).abs().max().item()
+        print('{}: '.format(name) + ', '.join('{} {:.1f} ms ({:.1e})'.format(k, result[k]['median_ms'],
+                                                                            result[k]['max_abs_diff'])
+                                               for k in variants))
+        results.append(result)
+    return results
+
+
+def benchmark_head(fftsizes=(64, 128), heads=HEADS, batchsize=8, head_pool=4, head_rank=64, n_iter=10, warmup=3):
+    """
+    Parameters, memory and training step time of TwoLevelTemplated with each regression head (see
+    FCAResNetBackbone), at each fftsize. The step is the forward, backward and an AdamW update, whose two moment
+    buffers per weight make the optimizer state twice the parameters.
+    Returns: list of dicts per fftsize and head
+    """
+    results = []
+    for fftsize in fftsizes:
+        for head in heads:
+            torch.manual_seed(0)
+            h1, h2 = level_hyperdicts(fftsize)
+            for h in (h1, h2):
+                h.update(head=head, head_pool=head_pool, head_rank=head_rank)
+            model, inputs = build_benchmark_model('TwoLevelTemplated', batchsize, hyperdict1=h1, hyperdict2=h2)
+            optimizer = torch.optim.AdamW(model.parameters(), lr=1e-6)
+            model.train()
+
+            def step():
+                optimizer.zero_grad()
+                model(*inputs).pow(2).mean().backward()
+                optimizer.step()
+            times = time_step(step, n_iter, warmup)
+            n_params = sum(p.numel() for p in model.parameters())
+            dense1 = sum(p.numel() for m in (model.firstmodel, model.secondmodel) for p in m.dense1.parameters())
+            result = {'fftsize': fftsize, 'head': head, 'batchsize': batchsize, 'params_m': n_params / 1e6,
+                      'dense1_params_m': dense1 / 1e6, 'params_mb': n_params * 4 / 2 ** 20,
+                      'optimizer_mb': n_params * 8 / 2 ** 20, 'step_alloc_mb': allocated_bytes(step) / 2 ** 20,
+                      'step': summarize(times)}
+            result['samples_per_s'] = batchsize / result['step']['median_ms'] * 1e3
+            print('fftsize {fftsize} {head}: {params_m:.2f} M parameters ({dense1_params_m:.2f} M in dense1), '
+                  '{params_mb:.0f} + {optimizer_mb:.0f} MiB optimizer, step {step[median_ms]:.0f} ms, '
+                  '{samples_per_s:.1f} samples/s, {step_alloc_mb:.0f} MiB allocated'.format(**result))
+            results.append(result)
+    return results
+
+
+CHECKPOINT_CONFIGS = ('none', '1', '1,2', 'all')
+
+
+def benchmark_checkpoint(fftsizes=(64, 128), configs=CHECKPOINT_CONFIGS, batchsize=8, n_iter=10, warmup=2):
+    """
+    Peak memory and training step time of TwoLevelTemplated with the attention blocks of some stages checkpointed
+    (checkpoint_stages of the hyperdicts, configs as 'none', 'all' or comma separated stages). The gradients are
+    checked against the step without checkpointing.
+    Returns: list of dicts per fftsize and config
+    """
+    results = []
+    for fftsize in fftsizes:
+        torch.manual_seed(0)
+        model, inputs = build_benchmark_model('TwoLevelTemplated', batchsize, fftsize)
+        model.train()
+        for config in configs:
+            stages = () if config == 'none' else 'all' if config == 'all' else [int(k) for k in config.split(',')]
+            set_checkpoint_stages(model, stages)
+
+            def step():
+                model.zero_grad()
+                model(*inputs).pow(2).mean().backward()
+            step()
+            grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+            if config == configs[0]:
+                reference = grads
+            diff = max((g - r).abs().max().item() for g, r in zip(grads, reference))
+            result = {'fftsize': fftsize, 'checkpoint_stages': config, 'batchsize': batchsize,
+                      'peak_mb': peak_allocated_bytes(step) / 2 ** 20, 'step': summarize(time_step(step, n_iter, warmup)),
+                      'max_grad_diff': diff}
+            print('fftsize {fftsize} checkpoint {checkpoint_stages}: peak {peak_mb:.0f} MiB, step '
+                  '{step[median_ms]:.0f} ms, max grad diff {max_grad_diff:.1e}'.format(**result))
+            results.append(result)
+        set_checkpoint_stages(model, ())
+    return results
+
+
+def benchmark_patchset(grids=(2, 4, 8), n_keys=2, fftsize=32, batchsize=8, width=8, aggregations=AGGREGATIONS,
+                       n_iter=10, warmup=2):
+    """
+    Training step time and parameters of FCAPatchSetNet against FCAResNetB2A2 on the stacked patch channels
+    (n_keys * n * n input channels), for PatchDataset inputs of n x n patches of fftsize spectra. The step is the
+    forward, backward and an SGD update.
+    Returns: list of dicts per grid and model
+    """
+    results = []
+    for n in grids:
+        channels = n_keys * n * n
+        x = torch.randn(batchsize, channels, fftsize, fftsize)
+        models = [('FCAResNetB2A2', FCAResNetB2A2(first_inputchannels=channels, reduction=4, skip_connection=True,
+                                                  fca_block_n=1, fftsize=fftsize), torch.randn(batchsize, 3))]
+        models += [('FCAPatchSetNet ' + a, FCAPatchSetNet(n_keys=n_keys, width=width, aggregation=a),
+                    torch.randn(batchsize, 4)) for a in aggregations]
+        for name, model, first in models:
+            step = train_step_fn(model, model, (x, first))
+            result = {'grid': n, 'patches': n * n, 'model': name, 'batchsize': batchsize,
+                      'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+                      'step': summarize(time_step(step, n_iter, warmup))}
+            print('{grid}x{grid} patches {model}: {params_m:.3f} M parameters, step {step[median_ms]:.0f} ms'
+                  .format(**result))
+            results.append(result)
+    return results
+
+
+def forward_flops(model, inputs):
+    """FLOPs of one forward of model, counted by the dispatcher for the convs and matrix products (not the FFTs)."""
+    from torch.utils.flop_counter import FlopCounterMode
+    with FlopCounterMode(display=False) as counter, torch.no_grad():
+        model(*inputs)
+    return counter.get_total_flops()
+
+
+def conv_variants(convs, conv_groups=4):
+    """The MultiModelTrainer variants setting the conv of both levels, see FCAResNet.conv3x3."""
+    return [{'hyperdict1': {'conv': c, 'conv_groups': conv_groups}, 'hyperdict2': {'conv': c, 'conv_groups': conv_groups}}
+            for c in convs]
+
+
+def benchmark_conv(channels=(32, 64), convs=CONVS, conv_groups=4, batchsize=8, fftsize=64, n_iter=10, warmup=2,
+                   data_path=None, savepath=None, hyperdict=None, hyperdict1=None, hyperdict2=None, n_eval=256):
+    """
+    FLOPs, parameters, inference latency and training step time of TwoLevelTemplated with each conv variant of the
+    stages and FCABlocks, for level 2 models of the given first_inputchannels (4x that in stages 3 and 4).
+    With data_path, the variants are also trained side by side on the same data with MultiModelTrainer
+    (hyperdict, hyperdict1, hyperdict2 as for TwoLevelTrainer, the conv keys set per variant) in
+    savepath/variant{k}/, and the MAE of their EMA models is measured on n_eval samples of the dataset.
+    Returns: list of dicts per level 2 width and conv, and per conv for the trained models
+    """
+    results = []
+    for c in channels:
+        for conv in convs:
+            torch.manual_seed(0)
+            h1, h2 = level_hyperdicts(fftsize)
+            h2['first_inputchannels'] = c
+            for h in (h1, h2):
+                h.update(conv=conv, conv_groups=conv_groups)
+            model, inputs = build_benchmark_model('TwoLevelTemplated', batchsize, hyperdict1=h1, hyperdict2=h2)
+            model.eval()
+            with torch.inference_mode():
+                latency = summarize(time_step(lambda: model(*inputs), n_iter, warmup))
+            result = {'channels': c, 'conv': conv, 'batchsize': batchsize, 'gflops': forward_flops(model, inputs) / 1e9,
+                      'params_m': sum(p.numel() for p in model.parameters()) / 1e6, 'latency': latency,
+                      'step': summarize(time_step(train_step_fn(model, model, inputs), n_iter, warmup))}
+            print('channels {channels} {conv}: {gflops:.2f} GFLOPs, {params_m:.2f} M parameters, inference '
+                  '{latency[median_ms]:.0f} ms, step {step[median_ms]:.0f} ms'.format(**result))
+            results.append(result)
+
+    if data_path is not None:
+        import random
+        from torch.utils.data import DataLoader, Subset
+        from AberrationNN.dataset import TwoLevelDataset
+        from AberrationNN.new_trainer import MultiModelTrainer
+        from AberrationNN.quantization import predict
+        from AberrationNN.inference import CARTESIAN_KEYS
+        trainer = MultiModelTrainer('TwoLevelDataset', 'TwoLevelTemplated', data_path, 'cpu', hyperdict, savepath, 1)
+        trainer.train(hyperdict1, hyperdict2, 0.5, 1.0, variants=conv_variants(convs, conv_groups))
+        dataset = TwoLevelDataset(data_path, hyperdict1, hyperdict2)
+        indices = list(range(len(dataset)))
+        random.Random(0).shuffle(indices)
+        evaluation = DataLoader(Subset(dataset, indices[:n_eval]), batch_size=batchsize)
+        for conv, t in zip(convs, trainer.trainers):
+            pred, target = predict(t.ema.ema.float().eval(), evaluation)
+            mae = (pred - target).abs().mean(0)
+            result = {'conv': conv, 'mae': dict(zip(CARTESIAN_KEYS, mae.tolist())), 'mean_mae': mae.mean().item(),
+                      'params_m': sum(p.numel() for p in t.ema.ema.parameters()) / 1e6}
+            print('trained {conv}: {params_m:.2f} M parameters, mean MAE {mean_mae:.3e}'.format(**result))
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the AberrationNN models on CPU')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('compile', help='eager vs torch.compile step time')
+    p.add_argument('--models', nargs='+', default=list(MODEL_NAMES), choices=MODEL_NAMES)
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--fftsize', type=int, default=64)
+    p.add_argument('--n_iter', type=int, default=10)
+    p.add_argument('--mode', default=None, help='torch.compile mode, e.g. max-autotune')
+    p.add_argument('--inference', action='store_true', help='time the forward pass only')
+    p.add_argument('--cache_dir', default=None)
+    p = sub.add_parser('fca', help='rfft2 vs fft2 FCAModule step time and memory')
+    p.add_argument('--fftsizes', nargs='+', type=int, default=[64, 128])
+    p.add_argument('--channels', nargs='+', type=int, default=[4, 32])
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--reduction', type=int, default=1)
+    p.add_argument('--n_iter', type=int, default=20)
+    p.add_argument('--spectrum_pools', nargs='+', type=int, default=[1, 2])
+    p = sub.add_parser('estimator', help='AberrationEstimator latency from raw ronchigrams')
+    p.add_argument('--batchsize', type=int, default=64)
+    p.add_argument('--fftsize', type=int, default=64)
+    p.add_argument('--imagesize', type=int, default=128)
+    p.add_argument('--patch', type=int, default=32)
+    p.add_argument('--n_iter', type=int, default=10)
+    p.add_argument('--savepath', default=None, help='training folder of a trained model, random weights otherwise')
+    p.add_argument('--device', default='cpu')
+    p = sub.add_parser('optimize', help='optimize_for_inference parity and latency')
+    p.add_argument('--models', nargs='+', default=list(MODEL_NAMES), choices=MODEL_NAMES)
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--fftsize', type=int, default=64)
+    p.add_argument('--n_iter', type=int, default=10)
+    p = sub.add_parser('head', help='dense vs pooled vs low-rank regression head memory and step time')
+    p.add_argument('--fftsizes', nargs='+', type=int, default=[64, 128])
+    p.add_argument('--heads', nargs='+', default=list(HEADS), choices=HEADS)
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--head_pool', type=int, default=4)
+    p.add_argument('--head_rank', type=int, default=64)
+    p.add_argument('--n_iter', type=int, default=10)
+    p = sub.add_parser('checkpoint', help='activation checkpointing peak memory and step time')
+    p.add_argument('--fftsizes', nargs='+', type=int, default=[64, 128])
+    p.add_argument('--configs', nargs='+', default=list(CHECKPOINT_CONFIGS),
+                   help="checkpointed stages: none, all or comma separated, e.g. 1,2")
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--n_iter', type=int, default=10)
+    p = sub.add_parser('patchset', help='FCAPatchSetNet vs stacked patch channels step time over patch counts')
+    p.add_argument('--grids', nargs='+', type=int, default=[2, 4, 8], help='n of the n x n patches')
+    p.add_argument('--n_keys', type=int, default=2)
+    p.add_argument('--fftsize', type=int, default=32)
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--width', type=int, default=8)
+    p.add_argument('--n_iter', type=int, default=10)
+    p = sub.add_parser('conv', help='dense vs separable vs grouped 3x3 convs: FLOPs, parameters, latency, accuracy')
+    p.add_argument('--channels', nargs='+', type=int, default=[32, 64], help='level 2 first_inputchannels')
+    p.add_argument('--convs', nargs='+', default=list(CONVS), choices=CONVS)
+    p.add_argument('--conv_groups', type=int, default=4)
+    p.add_argument('--batchsize', type=int, default=8)
+    p.add_argument('--fftsize', type=int, default=64)
+    p.add_argument('--n_iter', type=int, default=10)
+    p.add_argument('--data_path', default=None, help='dataset folder to also train and compare the variants')
+    p.add_argument('--savepath', default=None, help='folder (ending in /) with the hyperdict.json, '
+                                                    'hyperdict1.json and hyperdict2.json to train with')
+    p.add_argument('--n_eval', type=int, default=256)
+    for p in sub.choices.values():
+        p.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+        p.add_argument('--out', default=None, help='json file for the results')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.command == 'compile':
+        results = benchmark_compile(args.models, args.batchsize, args.fftsize, args.n_iter, mode=args.mode,
+                                    train=not args.inference, cache_dir=args.cache_dir)
+    elif args.command == 'fca':
+        results = benchmark_fca(args.fftsizes, args.channels, args.batchsize, args.reduction, args.n_iter,
+                                spectrum_pools=args.spectrum_pools)
+    elif args.command == 'estimator':
+        results = benchmark_estimator(args.batchsize, args.fftsize, args.imagesize, args.patch, n_iter=args.n_iter,
+                                      savepath=args.savepath, device=args.device)
+    elif args.command == 'optimize':
+        results = benchmark_optimize(args.models, args.batchsize, args.fftsize, args.n_iter)
+    elif args.command == 'head':
+        results = benchmark_head(args.fftsizes, args.heads, args.batchsize, args.head_pool, args.head_rank,
+                                 args.n_iter)
+    elif args.command == 'checkpoint':
+        results = benchmark_checkpoint(args.fftsizes, args.configs, args.batchsize, args.n_iter)
+    elif args.command == 'conv':
+        hyperdicts = [None] * 3
+        if args.data_path:
+            from AberrationNN.inference import load_hyperdicts
+            hyperdicts = load_hyperdicts(args.savepath)
+        results = benchmark_conv(args.channels, args.convs, args.conv_groups, args.batchsize, args.fftsize,
+                                 args.n_iter, data_path=args.data_path, savepath=args.savepath,
+                                 hyperdict=hyperdicts[0], hyperdict1=hyperdicts[1], hyperdict2=hyperdicts[2],
+                                 n_eval=args.n_eval)
+    elif args.command == 'patchset':
+        results = benchmark_patchset(args.grids, args.n_keys, args.fftsize, args.batchsize, args.width,
+                                     n_iter=args.n_iter)
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=1)
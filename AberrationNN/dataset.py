@@ -2,6 +2,7 @@ import json
 
 import numpy as np
 import torch
+from torch import nn
 import os
 import torch.nn.functional as F
 from AberrationNN.utils import polar2cartesian, evaluate_aberration_derivative_cartesian, evaluate_aberration_cartesian
@@ -612,6 +613,121 @@ class TwoLevelDataset:
         return allab
 
 
+def butterworth_mask(shape, cutoff_frequency_ratio=0.05, order=3, real=True):
+    """
+    The rfft2 mask of hp_filter: the squared high-pass Butterworth filter of skimage.filters.butterworth.
+    Returns: float32 tensor of shape (shape[0], shape[1] // 2 + 1), or the fft2 mask (shape) with real=False
+    """
+    ranges = []
+    for d in shape:
+        axis = np.arange(-(d - 1) // 2, (d - 1) // 2 + 1) / (d * cutoff_frequency_ratio)
+        ranges.append(np.fft.ifftshift(axis ** 2))
+    if real:
+        ranges[-1] = ranges[-1][:shape[-1] // 2 + 1]
+    q2 = np.power((ranges[0][:, None] + ranges[1][None, :]).astype('float32'), order)
+    return torch.as_tensor(q2 / (1 + q2), dtype=torch.float32)
+
+
+def hanning2d(n):
+    """The 2D Hann window of the FFTs, as float32."""
+    return torch.as_tensor(np.outer(np.hanning(n), np.hanning(n)), dtype=torch.float32)
+
+
+class TwoLevelPreprocess(nn.Module):
+    """
+    The preprocessing of TwoLevelDataset (get_image1 and get_image2, without the augmentation) as batched torch ops,
+    from raw ronchigrams to the inputs of TwoLevelTemplated, so it runs on the inference device and can be exported
+    with the model. The high-pass filter, Hann windows and the reference patch FFTs are precomputed buffers.
+    Args:
+        hyperdict1, hyperdict2: the level hyperdicts of the training
+        image_shape: (H, W) of the raw ronchigrams, as stored in ronchi_stack.npz
+        reference: the standard reference ronchigrams of the data keys (K, h, w), needed with if_reference
+    forward(x): x of shape (B, K, H, W), K the data keys (e.g. the beam tilt pair)
+    Returns: level 1 input (B, K, fftcropsize1, fftcropsize1), level 2 input (B, K * n_patches, fftcropsize2, ...)
+    """
+
+    def __init__(self, hyperdict1, hyperdict2, image_shape, reference=None):
+        super(TwoLevelPreprocess, self).__init__()
+        self.imagesize = hyperdict1['imagesize']
+        self.if_HP = hyperdict1['if_HP']
+        self.pre_normalization = hyperdict1['pre_normalization']
+        self.normalization = hyperdict1['normalization']
+        self.downsampling1, self.downsampling2 = hyperdict1['downsampling'], hyperdict2['downsampling']
+        self.fft_pad_factor1, self.fft_pad_factor2 = hyperdict1['fft_pad_factor'], hyperdict2['fft_pad_factor']
+        self.fftcropsize1, self.fftcropsize2 = hyperdict1['fftcropsize'], hyperdict2['fftcropsize']
+        self.patch2 = hyperdict2['patch']
+        self.if_reference = hyperdict2['if_reference']
+
+        self.image_shape = tuple(image_shape)
+        self.crop = self.imagesize // 2 if self.imagesize < image_shape[-1] else 0
+        cropped = (image_shape[0] - 2 * self.crop, image_shape[1] - 2 * self.crop)
+        self.register_buffer('hp_mask', butterworth_mask(cropped))
+        self.register_buffer('hann1', hanning2d(self.imagesize))
+        self.register_buffer('hann2', hanning2d(self.patch2))
+        if self.if_reference:
+            if reference is None:
+                raise ValueError('The model was trained with if_reference, the standard reference images are needed')
+            reference = torch.as_tensor(np.asarray(reference), dtype=torch.float32)[None]
+            self.register_buffer('reference_mask', butterworth_mask(reference.shape[-2:]))
+            self.register_buffer('reference2', self.level2(reference, self.reference_mask, crop=False))
+
+    @staticmethod
+    def minmax(x):
+        low, high = x.amin(dim=(-2, -1), keepdim=True), x.amax(dim=(-2, -1), keepdim=True)
+        return (x - low) / (high - low)
+
+    @staticmethod
+    def center_crop(x, size):
+        if x.shape[-1] <= size:
+            return x
+        top, left = x.shape[-2] // 2 - size // 2, x.shape[-1] // 2 - size // 2
+        return x[..., top:top + size, left:left + size]
+
+    def spectrum(self, x, hann, pad_factor):
+        """Centered magnitude spectrum of the Hann windowed images, zero padded by pad_factor (wholeFFT, singleFFT)."""
+        n = hann.shape[-1]
+        isize = n * pad_factor
+        top = isize // 2 - n // 2
+        x = F.pad(x * hann, (top, isize - top - n, top, isize - top - n))
+        fft = torch.abs(torch.fft.fftshift(torch.fft.fft2(x), dim=(-2, -1)))
+        return self.minmax(fft) if self.normalization else fft
+
+    def high_pass(self, x, mask):
+        """hp_filter"""
+        return torch.fft.irfft2(torch.fft.rfft2(x) * mask, s=x.shape[-2:])
+
+    def filtered(self, x, mask, downsampling, crop=True):
+        if crop and self.crop:
+            x = x[..., self.crop:-self.crop, self.crop:-self.crop]
+        if self.if_HP:
+            x = self.high_pass(x, mask)
+        if downsampling is not None and downsampling > 1:
+            x = F.interpolate(x, scale_factor=1 / downsampling, mode='bilinear')
+        if self.pre_normalization:
+            x = self.minmax(x)
+        return x
+
+    def level1(self, x):
+        x = self.filtered(x, self.hp_mask, self.downsampling1)
+        return self.center_crop(self.spectrum(x, self.hann1, self.fft_pad_factor1), self.fftcropsize1)
+
+    def level2(self, x, mask, crop=True):
+        x = self.filtered(x, mask, self.downsampling2, crop)
+        p = self.patch2
+        b, k, h, w = x.shape
+        # the patches row by row, as image.unfold(0, p, p).unfold(1, p, p) in get_image2
+        windows = x[..., :h // p * p, :w // p * p].reshape(b, k, h // p, p, w // p, p).transpose(3, 4)
+        windows = windows.reshape(b, k * (h // p) * (w // p), p, p)
+        return self.center_crop(self.spectrum(windows, self.hann2, self.fft_pad_factor2), self.fftcropsize2)
+
+    def forward(self, x: torch.Tensor):
+        x = x.float()
+        image2 = self.level2(x, self.hp_mask)
+        if self.if_reference:
+            image2 = image2 - self.reference2
+        return self.level1(x), image2
+
+
 class TwoLevelDatasetDifference(TwoLevelDataset):
     """
     Remember for such data for model_level1, the first_inputchannels in hyperdict should be 2.
@@ -0,0 +1,77 @@
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+import torch.utils.data as data
+
+from AberrationNN.FCAResNet import FCAResNetC1A1Cs
+from AberrationNN.train_utils import init_distributed, is_main_process, reduce_mean, broadcast_flag, \
+    check_gradients, cleanup_distributed
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, world_size, port, n_samples=10):
+    """
+    One rank of the check: the DistributedSampler shards cover the dataset without overlap, reduce_mean and
+    broadcast_flag agree on every rank, and one DDP step of a model with unused layers (if_CAB=False, reduction=1)
+    gives the same gradients on every rank and passes check_gradients.
+    """
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), LOCAL_RANK=str(rank),
+                      WORLD_SIZE=str(world_size))
+    torch.set_num_threads(1)
+    rank, _, world_size = init_distributed('gloo')
+    device = torch.device('cpu')
+    try:
+        sampler = data.DistributedSampler(range(n_samples), num_replicas=world_size, rank=rank, shuffle=True)
+        shards = [None] * world_size
+        dist.all_gather_object(shards, list(sampler))
+        # every sample in a shard, the shards of equal size, padded by repeating fewer than world_size samples
+        seen = [i for shard in shards for i in shard]
+        assert sorted(set(seen)) == list(range(n_samples)), shards
+        assert len(set(map(len, shards))) == 1 and len(seen) - n_samples < world_size, shards
+
+        mean = reduce_mean(float(rank), device)
+        assert mean == (world_size - 1) / 2, mean
+        assert broadcast_flag(rank == 0, device) is True
+        assert broadcast_flag(rank != 0, device) is False
+
+        torch.manual_seed(0)  # the same initial weights on every rank, DDP also broadcasts them
+        model = FCAResNetC1A1Cs(first_inputchannels=4, reduction=1, skip_connection=True, fca_block_n=1,
+                                if_CAB=False, fftsize=32)
+        model = nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+        torch.manual_seed(rank)  # a different batch per rank
+        model(torch.randn(4, 4, 32, 32)).pow(2).mean().backward()
+        check_gradients(model)
+        grads = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+        spread = grads.clone()
+        dist.all_reduce(spread, op=dist.ReduceOp.MAX)
+        spread -= grads
+        assert spread.abs().max().item() < 1e-6, spread.abs().max().item()
+        unused = sum(p.grad is None for p in model.parameters())
+        if is_main_process():
+            print('{} ranks: sampler shards {}, reduce_mean {}, broadcast_flag ok, DDP gradients equal '
+                  '({} unused parameters without gradient)'.format(world_size, shards, mean, unused))
+    finally:
+        cleanup_distributed()
+
+
+def check(world_size=2):
+    """Run the distributed helpers with world_size CPU processes and the gloo backend."""
+    mp.spawn(worker, args=(world_size, free_port()), nprocs=world_size, join=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='CPU (gloo) check of the DDP training helpers')
+    parser.add_argument('--world_size', type=int, default=2)
+    args = parser.parse_args()
+    check(args.world_size)
@@ -0,0 +1,217 @@
+import json
+import math
+import os
+from copy import deepcopy
+
+import numpy as np
+import torch
+from torch import nn
+
+from AberrationNN.FCAResNet import FCAModule
+from AberrationNN.dataset import TwoLevelPreprocess, butterworth_mask
+from AberrationNN.inference import load_model, load_hyperdicts, CARTESIAN_KEYS
+from AberrationNN.profiling import time_step, summarize
+
+
+def dft_matrices(freqs, n, size, offset=0):
+    """
+    Real and imaginary parts of the DFT of length `size` restricted to the output frequencies `freqs` and to the n
+    input samples starting at `offset`, the others being the zero padding: F = (cos - i sin) @ x.
+    Returns: cos, sin float32 tensors of shape (len(freqs), n)
+    """
+    angle = 2 * math.pi * np.outer(np.asarray(freqs), np.arange(offset, offset + n)) / size
+    return torch.as_tensor(np.cos(angle), dtype=torch.float32), torch.as_tensor(np.sin(angle), dtype=torch.float32)
+
+
+class MatmulDFTMagnitude(nn.Module):
+    """
+    |DFT| of the last two dimensions as matrix products, for the exporters and runtimes without FFT ops.
+    rows, cols: output frequencies of the two dimensions, n: input (h, w), size: DFT lengths (zero padded), offset:
+    position of the input in the padded array.
+    """
+
+    def __init__(self, rows, cols, n, size, offset=(0, 0)):
+        super(MatmulDFTMagnitude, self).__init__()
+        for name, freqs, n_, size_, offset_ in zip(('h', 'w'), (rows, cols), n, size, offset):
+            cos, sin = dft_matrices(freqs, n_, size_, offset_)
+            self.register_buffer('cos_' + name, cos)
+            self.register_buffer('sin_' + name, sin)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # F = (Ch - i Sh) x (Cw - i Sw)^T
+        xc, xs = x @ self.cos_w.T, x @ self.sin_w.T
+        real = self.cos_h @ xc - self.sin_h @ xs
+        imag = self.cos_h @ xs + self.sin_h @ xc
+        return torch.sqrt(real * real + imag * imag)
+
+
+class ExportPreprocess(TwoLevelPreprocess):
+    """
+    TwoLevelPreprocess with the FFTs as matrix products. The centered (fftshift) spectra are computed in shifted
+    frequency order, and the high-pass filter is the full complex DFT, the mask and the inverse DFT. The reference
+    patches are still preprocessed with the FFTs, once in __init__.
+    """
+    matmul = False  # set once the DFT matrices are built
+
+    def __init__(self, hyperdict1, hyperdict2, image_shape, reference=None):
+        super(ExportPreprocess, self).__init__(hyperdict1, hyperdict2, image_shape, reference)
+        self.spectra = nn.ModuleDict()
+        for n, pad in ((self.imagesize, self.fft_pad_factor1), (self.patch2, self.fft_pad_factor2)):
+            size = n * pad
+            freqs = np.arange(size) - size // 2  # fftshift order
+            top = size // 2 - n // 2
+            self.spectra['{}_{}'.format(n, size)] = MatmulDFTMagnitude(freqs, freqs, (n, n), (size, size), (top, top))
+        cropped = (image_shape[0] - 2 * self.crop, image_shape[1] - 2 * self.crop)
+        for name, d in zip(('h', 'w'), cropped):
+            cos, sin = dft_matrices(np.arange(d), d, d)
+            self.register_buffer('hp_cos_' + name, cos)
+            self.register_buffer('hp_sin_' + name, sin)
+        self.register_buffer('hp_full_mask', butterworth_mask(cropped, real=False))
+        self.matmul = True
+
+    def high_pass(self, x, mask):
+        if not self.matmul:
+            return super(ExportPreprocess, self).high_pass(x, mask)
+        ch, sh, cw, sw = self.hp_cos_h, self.hp_sin_h, self.hp_cos_w, self.hp_sin_w
+        xc, xs = x @ cw.T, x @ sw.T
+        real = (ch @ xc - sh @ xs) * self.hp_full_mask
+        imag = -(ch @ xs + sh @ xc) * self.hp_full_mask
+        # real part of the inverse DFT (Ch + i Sh) G (Cw + i Sw)^T / (h w)
+        out = ch @ (real @ cw.T - imag @ sw.T) - sh @ (real @ sw.T + imag @ cw.T)
+        return out / (x.shape[-2] * x.shape[-1])
+
+    def spectrum(self, x, hann, pad_factor):
+        if not self.matmul:
+            return super(ExportPreprocess, self).spectrum(x, hann, pad_factor)
+        n = hann.shape[-1]
+        fft = self.spectra['{}_{}'.format(n, n * pad_factor)](x * hann)
+        return self.minmax(fft) if self.normalization else fft
+
+
+class ExportedEstimator(nn.Module):
+    """Raw ronchigrams (B, K, H, W) to the Cartesian aberrations (B, 7) in CARTESIAN_KEYS order."""
+
+    def __init__(self, preprocess, model):
+        super(ExportedEstimator, self).__init__()
+        self.preprocess = preprocess
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        image1, image2 = self.preprocess(x)
+        return self.model(image1, image2)
+
+
+def use_matmul_dft(model, *inputs):
+    """Replace the rfft2 of each FCAModule of model by MatmulDFTMagnitude, for the input shapes of one forward."""
+    shapes, hooks = {}, []
+
+    def record(module, args):
+        shapes[module] = args[0].shape[-2:]
+
+    for m in model.modules():
+        if isinstance(m, FCAModule) and m.if_FT:
+            hooks.append(m.register_forward_pre_hook(record))
+    with torch.no_grad():
+        model(*inputs)
+    for hook in hooks:
+        hook.remove()
+    for m, (h, w) in shapes.items():
+        m.dft = MatmulDFTMagnitude(np.arange(h), np.arange(w // 2 + 1), (h, w), (h, w))  # the rfft2 columns
+    return model
+
+
+def build_export_module(savepath, image_shape, reference=None, checkpoint='model_bestepoch.tar', matmul_dft=False,
+                        batchsize=1):
+    """
+    The preprocessing and the EMA model of a training folder as one module, in eval mode on the CPU.
+    matmul_dft: replace all the FFTs by matrix products, needed for ONNX.
+    Returns: module, example input of shape (batchsize, K, H, W)
+    """
+    _, hyperdict1, hyperdict2 = load_hyperdicts(savepath)
+    model = deepcopy(load_model(savepath, checkpoint, 'cpu', ema=True)).to(memory_format=torch.contiguous_format)
+    preprocess = (ExportPreprocess if matmul_dft else TwoLevelPreprocess)(hyperdict1, hyperdict2, image_shape,
+                                                                          reference)
+    module = ExportedEstimator(preprocess, model).eval()
+    example = torch.rand(batchsize, len(hyperdict1['data_keys']), *image_shape)
+    if matmul_dft:
+        with torch.no_grad():
+            use_matmul_dft(model, *preprocess(example))
+    return module, example
+
+
+def export(savepath, out_dir, image_shape, reference=None, checkpoint='model_bestepoch.tar', batchsize=1,
+           formats=('torchscript', 'onnx'), opset=17, n_iter=20, warmup=3):
+    """
+    Export the preprocessing and the model of a training folder to TorchScript (estimator.pt, traced) and ONNX
+    (estimator.onnx), check them against the eager estimator and time them on the CPU. The graphs take raw
+    ronchigrams (batchsize, K, H, W) and return the Cartesian aberrations (batchsize, 7). The batch size is fixed,
+    as the FCA modules roll the batch dimension by half of its size.
+    Returns: dict with the max abs difference and the latency of each format, also written to out_dir/export.json
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    eager, example = build_export_module(savepath, image_shape, reference, checkpoint, batchsize=batchsize)
+    x = torch.rand_like(example)  # the parity input, not the tracing input
+    with torch.inference_mode():
+        expected = eager(x)
+        t_eager = summarize(time_step(lambda: eager(x), n_iter, warmup))['median_ms']
+    report = {'batchsize': batchsize, 'image_shape': list(image_shape), 'outputs': list(CARTESIAN_KEYS),
+              'eager_ms': t_eager}
+    print('eager: {:.1f} ms'.format(t_eager))
+
+    if 'torchscript' in formats:
+        path = os.path.join(out_dir, 'estimator.pt')
+        with torch.no_grad():
+            traced = torch.jit.trace(eager, example, check_trace=False)
+        traced.save(path)
+        loaded = torch.jit.load(path)
+        with torch.inference_mode():
+            diff = (loaded(x) - expected).abs().max().item()
+            t = summarize(time_step(lambda: loaded(x), n_iter, warmup))['median_ms']
+        report['torchscript'] = {'path': path, 'max_abs_diff': diff, 'latency_ms': t}
+        print('TorchScript: max diff {:.1e}, {:.1f} ms'.format(diff, t))
+
+    if 'onnx' in formats:
+        import onnxruntime
+        path = os.path.join(out_dir, 'estimator.onnx')
+        module, example = build_export_module(savepath, image_shape, reference, checkpoint, matmul_dft=True,
+                                              batchsize=batchsize)
+        with torch.no_grad():
+            torch.onnx.export(module, (example,), path, input_names=['ronchigrams'], output_names=['aberrations'],
+                              opset_version=opset, dynamo=False)
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        feed = {'ronchigrams': x.numpy()}
+        diff = float(np.abs(session.run(None, feed)[0] - expected.numpy()).max())
+        t = summarize(time_step(lambda: session.run(None, feed), n_iter, warmup))['median_ms']
+        report['onnx'] = {'path': path, 'max_abs_diff': diff, 'latency_ms': t, 'opset': opset}
+        print('ONNX (onnxruntime CPU): max diff {:.1e}, {:.1f} ms'.format(diff, t))
+
+    with open(os.path.join(out_dir, 'export.json'), 'w') as fp:
+        json.dump(report, fp, indent=1)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export a trained TwoLevelTemplated with its preprocessing')
+    parser.add_argument('savepath', help='training folder with the checkpoint and the hyperdicts')
+    parser.add_argument('--out_dir', default=None, help='savepath/export by default')
+    parser.add_argument('--image_shape', nargs=2, type=int, required=True, help='H W of the raw ronchigrams')
+    parser.add_argument('--reference', default=None,
+                        help='standard_reference.npz, its data_keys entries are subtracted at level 2')
+    parser.add_argument('--checkpoint', default='model_bestepoch.tar')
+    parser.add_argument('--batchsize', type=int, default=1)
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    reference = None
+    if args.reference:
+        data_keys = load_hyperdicts(args.savepath)[1]['data_keys']
+        with np.load(args.reference) as ref:
+            reference = np.stack([ref[k] for k in np.array(list(ref.keys()))[data_keys]])
+    export(args.savepath, args.out_dir or os.path.join(args.savepath, 'export'), args.image_shape, reference,
+           args.checkpoint, args.batchsize, args.formats, args.opset)
@@ -0,0 +1,184 @@
+import json
+import os
+from copy import deepcopy
+
+import numpy as np
+import torch
+from torch import nn
+
+from AberrationNN.FCAResNet import CoordAttentionBlock, FCAModule, FCAResNetBackbone
+from AberrationNN.dataset import TwoLevelPreprocess
+from AberrationNN.train_utils import configure_performance, compile_model
+from AberrationNN.utils import cartesian2polar
+
+# the outputs of TwoLevelTemplated, level 1 then level 2, in the units of the training targets
+CARTESIAN_KEYS = ('C10', 'C12a', 'C12b', 'C21a', 'C21b', 'C23a', 'C23b')
+
+
+def load_hyperdicts(savepath):
+    """hyperdict.json, hyperdict1.json and hyperdict2.json of a training folder, None for the missing ones."""
+    out = []
+    for name in ('hyperdict.json', 'hyperdict1.json', 'hyperdict2.json'):
+        path = os.path.join(savepath, name)
+        if os.path.exists(path):
+            with open(path) as fp:
+                out.append(json.load(fp))
+        else:
+            out.append(None)
+    return out
+
+
+def bn_affine(bn):
+    """The scale and shift of an eval mode BatchNorm2d."""
+    scale = bn.weight.detach() * torch.rsqrt(bn.running_var + bn.eps)
+    return scale, bn.bias.detach() - bn.running_mean * scale
+
+
+def fold_bn(conv, bn):
+    """Fold an eval mode BatchNorm2d into the conv before it, in place."""
+    scale, shift = bn_affine(bn)
+    with torch.no_grad():
+        conv.weight.mul_(scale.reshape(-1, *([1] * (conv.weight.dim() - 1))))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(shift)
+        conv.bias = nn.Parameter(bias * scale + shift)
+    return conv
+
+
+def optimize_for_inference(model, channels_last=True, example_inputs=None):
+    """
+    An inference copy of a model of the FCAResNet family, with the same outputs:
+        - bn1 of the CoordAttentionBlocks folded into conv1. The BN after the residual add of the FCABlocks has no
+          conv right before it and stays an eval BatchNorm2d, which is already one per-channel affine kernel (faster
+          on CPU than the same affine as broadcast ops)
+        - the modules that are never called removed: the CoordAttentionBlocks without if_CAB and the excitation
+          convs of the FCAModules with reduction 1
+        - no gradients, channels_last weights (the inputs should be channels_last too)
+    With example_inputs (a tuple of model inputs), the model is also traced, frozen and passed through
+    torch.jit.optimize_for_inference, which fuses the convs with the following adds and activations. The traced
+    module is for the batch size of example_inputs, as the FCA modules roll the batch dimension.
+    """
+    model = deepcopy(model).float().eval()
+    for m in list(model.modules()):
+        if isinstance(m, CoordAttentionBlock) and isinstance(m.bn1, nn.BatchNorm2d):
+            fold_bn(m.conv1, m.bn1)
+            m.bn1 = nn.Identity()
+        elif isinstance(m, FCAModule) and m.reduction == 1:
+            m.cov2 = m.cov2back = None
+        elif isinstance(m, FCAResNetBackbone) and not m.if_CAB:
+            for k in range(1, 5):
+                setattr(m, 'cab{}'.format(k), nn.Identity())
+    model.requires_grad_(False)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if example_inputs is not None:
+        if channels_last:
+            example_inputs = tuple(x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x
+                                   for x in example_inputs)
+        with torch.no_grad():
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(model, example_inputs,
+                                                                                      check_trace=False)))
+    return model
+
+
+def load_model(savepath, checkpoint='model_bestepoch.tar', device='cpu', ema=True, compile=False, optimize=False):
+    """
+    Load a trained model from the folder of a training run for inference.
+    Args:
+        savepath: the training folder with the checkpoint and hyperdict.json
+        checkpoint: file name of the checkpoint, e.g. model_bestepoch.tar or model_final.tar
+        device: inference device
+        ema: use the EMA weights, otherwise the raw weights in 'state_dict'
+        compile: torch.compile the model, True or a torch.compile mode. The compiled kernels are cached in
+            savepath/compile_cache, so only the first load pays the full compilation.
+        optimize: apply optimize_for_inference (BN folding, unused modules removed, channels_last)
+    Returns: the model in eval mode, in the memory format of the performance settings of the run
+    """
+    device = torch.device(device)
+    ckpt = torch.load(os.path.join(savepath, checkpoint), map_location=device, weights_only=False)
+    model = ckpt['ema']
+    if not ema:
+        model = deepcopy(model)
+        model.load_state_dict(ckpt['state_dict'])
+    model = model.float().eval()
+
+    hyperdict = load_hyperdicts(savepath)[0]
+    if hyperdict is not None:
+        # only the flags of the model, the thread settings of the training stay with the caller
+        perf = configure_performance(hyperdict, device, apply_threads=False)
+        if perf.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+    if optimize:
+        model = optimize_for_inference(model)
+    if compile:
+        model = compile_model(model, mode=None if compile is True else compile,
+                              cache_dir=os.path.join(savepath, 'compile_cache'))
+    return model
+
+
+class AberrationEstimator:
+    """
+    Aberrations from raw ronchigrams with a trained TwoLevelTemplated. The EMA weights, the hyperdicts and the
+    preprocessing buffers are loaded once, then each call preprocesses and runs the batches on the device under
+    inference_mode.
+    Args:
+        savepath: the training folder, with the checkpoint, hyperdict1.json and hyperdict2.json
+        reference: the standard reference ronchigrams (K, h, w) of the data keys, needed if the model was trained
+            with if_reference
+        checkpoint, device, compile, optimize: as in load_model
+        batchsize: largest batch run at once
+    Example:
+        estimator = AberrationEstimator(savepath, reference=np.stack([ref[k] for k in keys]))
+        polar = estimator(ronchigrams)  # (N, K, H, W) -> {'C10': (N,), 'C12': (N,), 'phi12': (N,), ...}
+    """
+
+    def __init__(self, savepath, reference=None, checkpoint='model_bestepoch.tar', device='cpu', compile=False,
+                 batchsize=64, optimize=False):
+        self.device = torch.device(device)
+        self.model = load_model(savepath, checkpoint, device, ema=True, compile=compile, optimize=optimize)
+        hyperdict, self.hyperdict1, self.hyperdict2 = load_hyperdicts(savepath)
+        if self.hyperdict1 is None or self.hyperdict2 is None:
+            raise FileNotFoundError('hyperdict1.json and hyperdict2.json are missing in {}'.format(savepath))
+        self.reference = reference
+        self.batchsize = batchsize
+        self.preprocess = None  # built for the image shape of the first call
+        channels_last = optimize or hyperdict is not None and configure_performance(
+            hyperdict, self.device, apply_threads=False).channels_last
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+    def build_preprocess(self, image_shape):
+        if self.preprocess is None or self.preprocess.image_shape != tuple(image_shape):
+            self.preprocess = TwoLevelPreprocess(self.hyperdict1, self.hyperdict2, image_shape,
+                                                 self.reference).to(self.device)
+        return self.preprocess
+
+    def predict(self, images):
+        """
+        Args:
+            images: raw ronchigrams (N, K, H, W), numpy array or tensor, K the data keys of the training
+        Returns: Cartesian aberrations (N, 7) as a float32 tensor on the CPU, columns in CARTESIAN_KEYS order
+        """
+        images = torch.as_tensor(np.asarray(images) if not torch.is_tensor(images) else images)
+        if images.dim() == 3:
+            images = images[None]
+        preprocess = self.build_preprocess(images.shape[-2:])
+        out = []
+        with torch.inference_mode():
+            for batch in images.split(self.batchsize):
+                image1, image2 = preprocess(batch.to(self.device, non_blocking=True))
+                pred = self.model(image1.contiguous(memory_format=self.memory_format),
+                                  image2.contiguous(memory_format=self.memory_format))
+                out.append(pred.float().cpu())
+        return torch.cat(out)
+
+    def __call__(self, images, polar=True):
+        """
+        Returns: dict of numpy arrays (N,), polar coefficients (C10, C12, phi12, C21, phi21, C23, phi23) or the
+        Cartesian ones of CARTESIAN_KEYS with polar=False
+        """
+        pred = self.predict(images).numpy()
+        cartesian = {k: pred[:, j] for j, k in enumerate(CARTESIAN_KEYS)}
+        if not polar:
+            return cartesian
+        out = cartesian2polar(cartesian)
+        out.pop('Cs', None)  # not predicted
+        return out
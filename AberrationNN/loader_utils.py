@@ -0,0 +1,234 @@
+import json
+import os
+import time
+from datetime import datetime
+from functools import partial
+
+import torch
+
+from AberrationNN.telemetry import process_tree_rss
+
+
+def available_cpus():
+    """
+    CPUs this process is allowed to run on. Unlike multiprocessing.cpu_count(), this respects taskset, cgroup
+    and SLURM affinity, so it is the number of cores actually given to the job.
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS and Windows
+        return list(range(os.cpu_count() or 1))
+
+
+def local_cpus():
+    """The share of available_cpus() for this rank when torchrun starts several processes on one node."""
+    cpus = available_cpus()
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if local_world_size > 1:
+        n = max(len(cpus) // local_world_size, 1)
+        cpus = cpus[local_rank * n: (local_rank + 1) * n] or cpus[-1:]
+    return cpus
+
+
+def default_num_workers(device, n_loaders=2):
+    """
+    Number of workers for each of n_loaders DataLoaders running side by side.
+    On a GPU node the main process only feeds the device, so every core but one goes to the workers.
+    On a CPU-only node the main process computes the model with torch threads, so the workers get half the cores.
+    """
+    n_cpu = len(local_cpus())
+    for_workers = n_cpu - 1 if torch.device(device).type == 'cuda' else n_cpu // 2
+    return max(for_workers // n_loaders, 0)
+
+
+def init_worker(worker_id, threads=1, cpus=None):
+    """
+    worker_init_fn of the DataLoaders. The preprocessing in __getitem__ (hp filter, FFTs, interpolation) is run
+    by many workers in parallel, so each worker is limited to a few threads instead of one per core.
+    With cpus, the worker is pinned to cpus[worker_id] (wrapping around).
+    """
+    torch.set_num_threads(threads)
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    if cpus:
+        try:
+            os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+        except (AttributeError, OSError):
+            pass
+
+
+def loader_kwargs(device, pms=None, n_loaders=2, loader_index=0):
+    """
+    Keyword arguments for torch.utils.data.DataLoader, from the optional hyperdict keys
+    num_workers, prefetch_factor, persistent_workers, pin_memory, worker_threads and worker_affinity.
+    Missing keys are derived from the cores of the job and the device type.
+    Args:
+        device: the training device
+        pms: Parameters or dict of the training hyperparameters, may be None
+        n_loaders: number of loaders iterated together (train and test)
+        loader_index: index of this loader, used to give each loader its own cores for worker_affinity
+    """
+    get = (lambda k, d: d) if pms is None else pms.get
+    is_cuda = torch.device(device).type == 'cuda'
+    num_workers = get('num_workers', None)
+    if num_workers is None:
+        num_workers = default_num_workers(device, n_loaders)
+    kwargs = {'num_workers': num_workers, 'pin_memory': get('pin_memory', is_cuda) and is_cuda}
+    if num_workers > 0:
+        cpus = None
+        if get('worker_affinity', False):
+            # the main process keeps the first cores, each loader's workers get the next block
+            cpus = local_cpus()
+            reserved = len(cpus) - num_workers * n_loaders
+            if reserved > 0:
+                cpus = cpus[reserved:]
+            cpus = cpus[loader_index * num_workers: (loader_index + 1) * num_workers] or None
+        kwargs.update(persistent_workers=get('persistent_workers', True),
+                      prefetch_factor=get('prefetch_factor', 2),
+                      worker_init_fn=partial(init_worker, threads=get('worker_threads', 1), cpus=cpus))
+    return kwargs
+
+
+LOADER_CONFIG = 'loaderconfig.json'
+TUNED_KEYS = ('batchsize', 'num_workers', 'prefetch_factor', 'pin_memory')
+
+
+def load_loader_config(savepath):
+    """The configuration written by autotune_loader into savepath, or an empty dict if it was never tuned."""
+    path = os.path.join(savepath, LOADER_CONFIG)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return {k: v for k, v in json.load(fp)['best'].items() if k in TUNED_KEYS}
+
+
+def _to_device(obj, device, non_blocking):
+    if torch.is_tensor(obj):
+        return obj.to(device, non_blocking=non_blocking)
+    if isinstance(obj, (list, tuple)):
+        return [_to_device(o, device, non_blocking) for o in obj]
+    return obj
+
+
+def benchmark_loader(dataset, device, batchsize, num_workers, prefetch_factor=2, pin_memory=False,
+                     n_batches=10, warmup_batches=2):
+    """
+    Time one DataLoader configuration. The worker start-up and the first warmup_batches are not timed.
+    Returns: dict of the configuration with samples_per_sec and rss_mb (main process plus workers)
+    """
+    config = {'batchsize': batchsize, 'num_workers': num_workers, 'pin_memory': pin_memory}
+    kwargs = dict(num_workers=num_workers, pin_memory=pin_memory)
+    if num_workers > 0:
+        config['prefetch_factor'] = prefetch_factor
+        kwargs.update(prefetch_factor=prefetch_factor, worker_init_fn=init_worker)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batchsize, shuffle=True, drop_last=True, **kwargs)
+    n_batches = min(n_batches, len(loader) - warmup_batches)
+    if n_batches < 1:
+        raise ValueError('The dataset is too small for batchsize {}'.format(batchsize))
+    it = iter(loader)
+    for _ in range(warmup_batches):
+        _to_device(next(it), device, pin_memory)
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        _to_device(next(it), device, pin_memory)
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    config['samples_per_sec'] = n_batches * batchsize / elapsed
+    config['rss_mb'] = process_tree_rss() / 2 ** 20
+    del it, loader
+    return config
+
+
+def autotune_loader(dataset, device, batchsize, savepath=None, worker_counts=None, batch_sizes=None,
+                    prefetch_factors=(2, 4), n_batches=10, max_rss_mb=None):
+    """
+    Short timed sweep of the DataLoader settings on this node. The knobs are tuned one after the other
+    (workers, prefetch depth, pin_memory, batch size), each time keeping the fastest setting, instead of timing the
+    full grid. Configurations using more than max_rss_mb are discarded.
+    With savepath, the results and the winner are written to savepath/loaderconfig.json, where the trainers pick
+    the winner up instead of the hyperdict values.
+    Returns: the best configuration
+    """
+    is_cuda = torch.device(device).type == 'cuda'
+    if worker_counts is None:
+        n_cpu = len(local_cpus())
+        worker_counts = sorted({0, 1, default_num_workers(device), *[2 ** k for k in range(1, 8) if 2 ** k < n_cpu]})
+    if batch_sizes is None:
+        batch_sizes = [max(batchsize // 2, 1), batchsize * 2]
+    results = []
+
+    def run(**config):
+        result = benchmark_loader(dataset, device, n_batches=n_batches, **config)
+        print('{} -> {:.1f} samples/s, {:.0f} MB'.format(config, result['samples_per_sec'], result['rss_mb']))
+        results.append(result)
+        if max_rss_mb is not None and result['rss_mb'] > max_rss_mb:
+            return None
+        return result
+
+    def sweep(best, key, values):
+        for v in values:
+            if key == 'prefetch_factor' and best['num_workers'] == 0:
+                return best
+            if v == best.get(key) and best['samples_per_sec'] > 0:
+                continue
+            config = {k: best[k] for k in ('batchsize', 'num_workers', 'prefetch_factor', 'pin_memory') if k in best}
+            config[key] = v
+            try:
+                result = run(**config)
+            except ValueError:
+                continue
+            if result is not None and result['samples_per_sec'] > best['samples_per_sec']:
+                best = result
+        return best
+
+    best = {'batchsize': batchsize, 'num_workers': worker_counts[0], 'prefetch_factor': 2, 'pin_memory': False,
+            'samples_per_sec': 0.0}
+    best = sweep(best, 'num_workers', worker_counts)
+    best = sweep(best, 'prefetch_factor', prefetch_factors)
+    if is_cuda:
+        best = sweep(best, 'pin_memory', [True])
+    best = sweep(best, 'batchsize', batch_sizes)
+    if best['samples_per_sec'] == 0.0:
+        raise RuntimeError('No DataLoader configuration fits the memory limit')
+    print('Best loader configuration:', best)
+
+    if savepath is not None:
+        with open(os.path.join(savepath, LOADER_CONFIG), 'w') as fp:
+            json.dump({'date': datetime.now().isoformat(), 'device': str(device), 'cpus': len(local_cpus()),
+                       'best': best, 'results': results}, fp, indent=1)
+    return best
+
+
+if __name__ == '__main__':
+    import argparse
+    from AberrationNN import dataset as datasets
+
+    parser = argparse.ArgumentParser(description='Benchmark the DataLoader settings for the dataset configured in '
+                                                 'savepath and save the fastest one to savepath/loaderconfig.json')
+    parser.add_argument('--savepath', required=True, help='folder with hyperdict.json (and hyperdict1/2.json)')
+    parser.add_argument('--data_path', required=True)
+    parser.add_argument('--dataset', default='TwoLevelDataset', help='dataset class name in AberrationNN.dataset')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--n_batches', type=int, default=10)
+    parser.add_argument('--max_rss_mb', type=float, default=None)
+    args = parser.parse_args()
+
+    savepath = os.path.join(args.savepath, '')
+    with open(savepath + 'hyperdict.json') as fp:
+        hyper = json.load(fp)
+    if os.path.exists(savepath + 'hyperdict1.json'):
+        with open(savepath + 'hyperdict1.json') as fp:
+            hyper1 = json.load(fp)
+        with open(savepath + 'hyperdict2.json') as fp:
+            hyper2 = json.load(fp)
+        data = getattr(datasets, args.dataset)(args.data_path, hyper1, hyper2)
+    else:
+        data = getattr(datasets, args.dataset)(
+            args.data_path, filestart=0, transform=None, pre_normalization=hyper['pre_normalization'],
+            normalization=hyper['normalization'], picked_keys=hyper['data_keys'], patch=hyper['patch'],
+            imagesize=hyper['imagesize'], downsampling=hyper['downsampling'], if_HP=hyper['if_HP'],
+            fft_pad_factor=hyper['fft_pad_factor'], fftcropsize=hyper['fftcropsize'],
+            target_high_order=hyper['target_high_order'], if_reference=hyper['if_reference'])
+    autotune_loader(data, torch.device(args.device), hyper['batchsize'], savepath=savepath,
+                    n_batches=args.n_batches, max_rss_mb=args.max_rss_mb)
@@ -0,0 +1,89 @@
+import csv
+import os
+
+import numpy as np
+
+HEADER = ('iteration', 'name', 'value')
+
+
+class MetricLog:
+    """
+    Append-only log of the training metrics (losses, learning rates, memory samples...), replacing the history lists
+    that grew with every iteration and were pickled into the checkpoints. The records are buffered and appended to a
+    CSV file with one row per value: iteration, name, value. The memory used is bounded by flush_every rows.
+    With path None (the non-main ranks of a distributed run) the records are discarded.
+    Example:
+        log = MetricLog(savepath + 'metrics.csv')
+        log.log(i, {'train_loss': 0.1, 'lr/pg0': 1e-3})
+        log.close()
+        MetricLog.read(savepath + 'metrics.csv')['train_loss']  # (iterations, values)
+    """
+
+    def __init__(self, path, flush_every=1000):
+        self.path = path
+        self.flush_every = flush_every
+        self.buffer = []
+
+    def log(self, iteration, values):
+        """Record a dict of scalar values at an iteration. None values are skipped."""
+        if self.path is None:
+            return
+        self.buffer.extend((iteration, k, '{:.8g}'.format(v)) for k, v in values.items() if v is not None)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered records to the file."""
+        if self.path is None or not self.buffer:
+            return
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as fp:
+            writer = csv.writer(fp)
+            if new:
+                writer.writerow(HEADER)
+            writer.writerows(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    def reset(self):
+        """Start a new log, removing the file of a previous run in the same folder."""
+        self.buffer = []
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def truncate(self, iteration):
+        """
+        Drop the records after an iteration, e.g. when resuming from a checkpoint, as the iterations logged after the
+        checkpoint was written are repeated.
+        """
+        self.buffer = [r for r in self.buffer if r[0] <= iteration]
+        if self.path is None or not os.path.exists(self.path):
+            return
+        tmp = self.path + '.tmp'
+        with open(self.path, newline='') as src, open(tmp, 'w', newline='') as dst:
+            reader, writer = csv.reader(src), csv.writer(dst)
+            writer.writerow(next(reader))
+            writer.writerows(row for row in reader if int(row[0]) <= iteration)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def read(path, names=None):
+        """
+        Load a log file.
+        Args:
+            path: the CSV file written by MetricLog
+            names: the metric names to load, all by default
+        Returns: dict name: (iterations, values) numpy arrays
+        """
+        columns = {}
+        with open(path, newline='') as fp:
+            reader = csv.reader(fp)
+            next(reader)
+            for i, name, value in reader:
+                if names is None or name in names:
+                    columns.setdefault(name, ([], []))
+                    columns[name][0].append(int(i))
+                    columns[name][1].append(float(value))
+        return {k: (np.asarray(i), np.asarray(v)) for k, (i, v) in columns.items()}
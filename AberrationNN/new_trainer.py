@@ -1,6 +1,6 @@
+import contextlib
 import gc
 import math
-import multiprocessing
 import os
 import time
 import warnings
@@ -20,8 +20,14 @@ from AberrationNN.customloss import CombinedLoss, CombinedLossStep
 from AberrationNN.dataset import *
 from AberrationNN.FCAResNet import *
 from AberrationNN.train import hyperdict
+from AberrationNN.loader_utils import loader_kwargs, load_loader_config, LOADER_CONFIG
+from AberrationNN.profiling import StageTimer
+from AberrationNN.telemetry import MemoryMonitor
+from AberrationNN.metrics import MetricLog
 
-from AberrationNN.train_utils import Parameters, init_seeds, weights_init, EarlyStopping, ModelEMA, get_gpu_info, plot_losses
+from AberrationNN.train_utils import Parameters, init_seeds, weights_init, EarlyStopping, ModelEMA, plot_losses, \
+    init_distributed, is_main_process, reduce_mean, broadcast_flag, de_parallel, CheckpointWriter, capture_rng_state, \
+    restore_rng_state, configure_performance, compile_model, check_gradients
 
 
 def one_cycle(y1=0.0, y2=1.0, steps=100):
@@ -34,8 +40,6 @@ class BaseTrainer:
         self.dataset_name = dataset_name
         self.model_name = model_name
         self.d_train, self.d_test = None, None
-        self.lr_history, self.momentum_history = [],[]
-        self.trainloss_total, self.testloss_total = [],[]
         self.accumulate = None
         self.lr = None
         self.epoch = None
@@ -43,37 +47,66 @@ class BaseTrainer:
         self.optimizer = None
         self.lf = None
         self.scheduler = None
+        self.writer = None
+        self.iteration, self.start_iter, self.last_opt_step = 0, 0, -1
         self.data_path = data_path
         self.device = torch.device(device)
+        # torchrun launch: one process per device, rank 0 keeps the EMA and writes all the files
+        self.rank, self.local_rank, self.world_size = init_distributed()
+        if self.world_size > 1 and self.device.type == 'cuda':
+            self.device = torch.device('cuda', self.local_rank)
+        self.is_main = is_main_process()
         self.pms = Parameters(**hyperdict)
         self.savepath = savepath
         self.patience = self.pms.patience
         self.subset = subset
-        if not os.path.exists(self.savepath):
-            os.mkdir(self.savepath)
-        with open(self.savepath + 'hyperdict.json', 'w') as fp:
-            json.dump(hyperdict, fp)
-
-    def train(self):
+        if self.is_main:
+            if not os.path.exists(self.savepath):
+                os.mkdir(self.savepath)
+            with open(self.savepath + 'hyperdict.json', 'w') as fp:
+                json.dump(hyperdict, fp)
+        # the DataLoader settings found by loader_utils.autotune_loader for this node replace the hyperdict ones
+        tuned = load_loader_config(self.savepath)
+        if tuned:
+            if self.is_main:
+                print('Using the DataLoader settings from {}: {}'.format(LOADER_CONFIG, tuned))
+            for k, v in tuned.items():
+                setattr(self.pms, k, v)
+        self.perf = configure_performance(self.pms, self.device, loader_kwargs(self.device, self.pms)['num_workers'])
+        self.memory_format = torch.channels_last if self.perf.channels_last else torch.contiguous_format
+        self.memory = MemoryMonitor(self.device)
+        self.memory_sample = None  # the last MemoryMonitor sample
+        # losses, learning rates and memory samples, streamed to savepath/metrics.csv by rank 0
+        self.metrics = MetricLog(self.savepath + 'metrics.csv' if self.is_main else None,
+                                 flush_every=self.pms.get('metric_flush', 1000))
+
+    def train(self, resume=None):
+        """
+        resume: path of a model_last.tar checkpoint to continue from, or True for the one in savepath.
+        """
 
         # Initialize model
-        init_seeds(1)
+        init_seeds(1, self.perf.deterministic)
         self.model = eval(self.model_name + "(first_inputchannels=self.pms.first_inputchannels, reduction=self.pms.reduction, "
                                             "skip_connection=self.pms.reduction,fca_block_n=self.pms.fca_block_n, if_FT=self.pms.if_FT,"
-                                            "if_CAB=self.pms.if_CAB, fftsize=min(self.pms.fftcropsize, self.pms.patch*self.pms.fft_pad_factor),)"
+                                            "if_CAB=self.pms.if_CAB, fftsize=min(self.pms.fftcropsize, self.pms.patch*self.pms.fft_pad_factor),"
+                                            "**self.pms.get('model_kwargs', {}))"
                           )
-        self.model.to(self.device)
+        self.model.to(self.device, memory_format=self.memory_format)
         self.model.apply(weights_init)
 
         self.stopper = EarlyStopping(patience=self.patience)  #########################################
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.pms.amp)  # automatic mixed precision training for speeding up and save memory
-        self.ema = ModelEMA(self.model)
-        self.accumulate = max(round(self.pms.nbs / self.pms.batchsize),1) # accumulate loss before optimizing, nbs nominal batch size
-        weight_decay = self.pms.weight_decay * self.pms.batchsize * self.accumulate / self.pms.nbs  # scale weight_decay
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.perf.scaler)  # automatic mixed precision training for speeding up and save memory
+        self.ema = self.build_ema() if self.is_main else None
+        batch_total = self.pms.batchsize * self.world_size  # samples per optimizer step over all ranks
+        self.accumulate = max(round(self.pms.nbs / batch_total),1) # accumulate loss before optimizing, nbs nominal batch size
+        weight_decay = self.pms.weight_decay * batch_total * self.accumulate / self.pms.nbs  # scale weight_decay
 
         self.optimizer = self.build_optimizer(model=self.model, lr=self.pms.lr0, momentum=self.pms.momentum,decay=weight_decay)
         self.setup_scheduler()
         self.scheduler.last_epoch = - 1  # do not move
+        self.wrap_model()
+        self.setup_compile()
 
 
         # Initialize dataset
@@ -104,28 +137,33 @@ class BaseTrainer:
                                                 indices[:-int(0.4 * len(repeat_dataset))])  # swing back to 0.3
         dataset_test = torch.utils.data.Subset(repeat_dataset, indices[-int(0.4 * len(repeat_dataset)):])
 
-        pool = multiprocessing.Pool()
         # define training and validation data loaders
-        self.d_train = torch.utils.data.DataLoader(
-            dataset_train, batch_size=self.pms.batchsize, shuffle=True, pin_memory=True,
-            num_workers=int(pool._processes / 2))
-
-        self.d_test = torch.utils.data.DataLoader(
-            dataset_test, batch_size=self.pms.batchsize, shuffle=True, pin_memory=True,
-            num_workers=int(pool._processes / 2))
+        self.d_train = self.build_dataloader(dataset_train, loader_index=0)
+        self.d_test = self.build_dataloader(dataset_test, loader_index=1)
 
-        print('##############################START TRAINING ######################################')
+        if self.is_main:
+            print('##############################START TRAINING ######################################')
 
-        if not os.path.exists(self.savepath):
-            os.mkdir(self.savepath)
         self.optimizer.zero_grad()
-        self.train_cell(self.d_train, self.d_test)
-        torch.save({"date": datetime.now().isoformat(),'ema': deepcopy(self.ema.ema), 'state_dict': self.model.state_dict(),
-                    'train': self.trainloss_total, 'test': self.testloss_total}, self.savepath + 'model_final.tar')
-
-        plot_losses(self.trainloss_total, self.testloss_total, self.savepath)
-
-        return self.model
+        self.start_iter, self.last_opt_step = 0, -1
+        if resume:
+            self.resume_from(self.savepath + 'model_last.tar' if resume is True else resume)
+        else:
+            self.metrics.reset()
+        self.writer = CheckpointWriter(self.pms.get('best_save_interval', 10.0)) if self.is_main else None
+        try:
+            self.train_cell(self.d_train, self.d_test)
+            if self.is_main:
+                self.writer.save({"date": datetime.now().isoformat(),'ema': self.ema.ema, 'state_dict': de_parallel(self.model).state_dict(),
+                                  'metrics': self.metrics.path}, self.savepath + 'model_final.tar')
+        finally:
+            self.metrics.close()
+            if self.writer:
+                self.writer.close()
+        if self.is_main:
+            plot_losses(self.metrics.path, self.savepath)
+
+        return de_parallel(self.model)
 
 
     def train_cell(self, data_loader_train, data_loader_test,
@@ -135,13 +173,16 @@ class BaseTrainer:
 
         nb = len(data_loader_train)  # number of batches
         nw = self.pms.warmup_iters  # warmup iterations
-        last_opt_step = -1
+        save_period = self.pms.get('save_period', self.pms.print_freq)  # iterations between resumable checkpoints
 
         record = time.time()
+        self.timer = self.build_timer()
 
         # note: I will still keep the iteration loop and no real epoch loop
         for i, ((images_train, targets_train), (images_test, targets_test)) in enumerate(
-                zip(data_loader_train, data_loader_test)):
+                zip(data_loader_train, data_loader_test), start=self.start_iter):
+            self.timer.lap('data')
+            self.iteration = i
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")  # suppress 'Detected lr_scheduler.step() before optimizer.step()'
@@ -151,21 +192,22 @@ class BaseTrainer:
 
             self.optimizer.zero_grad() # YOU HAVE TO KEEP THIS. Do not remove
             if torch.is_tensor(images_train):
-                images_train = images_train.to(self.device)
+                images_train = images_train.to(self.device, memory_format=self.memory_format)
                 model_type = 1
             else:
                 model_type = 2
                 (images_train, lastlevel) = images_train
-                images_train = images_train.to(self.device)
+                images_train = images_train.to(self.device, memory_format=self.memory_format)
                 lastlevel = lastlevel.to(self.device)
 
             targets_train= targets_train.to(self.device)
+            self.timer.lap('h2d')
 
             # Warmup
             # ni = i + nb * epoch
             if i <= nw:
                 xi = [0, nw]  # x interp
-                self.accumulate = max(1, int(np.interp(i, xi, [1, self.pms.nbs / self.pms.batchsize]).round()))
+                self.accumulate = max(1, int(np.interp(i, xi, [1, self.pms.nbs / (self.pms.batchsize * self.world_size)]).round()))
                 for j, x in enumerate(self.optimizer.param_groups):
                     # Bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
                     x["lr"] = np.interp(
@@ -174,80 +216,93 @@ class BaseTrainer:
                     if "momentum" in x:
                         x["momentum"] = np.interp(i, xi, [self.pms.warmup_momentum, self.pms.momentum])
 
-            # Forward
-            with torch.cuda.amp.autocast(self.pms.amp):
-                if model_type==1:
-                    pred = self.model(images_train)
-                elif model_type==2:
-                    pred = self.model(images_train, lastlevel)
-
-                lossfunc = torch.nn.SmoothL1Loss()
-
-                trainloss = lossfunc(pred, targets_train)
-                self.trainloss_total.append(trainloss.item())
-
-            # Backward
-            self.scaler.scale(trainloss).backward() #######################
+            self.timer.lap('other')
+            opt_step = i - self.last_opt_step >= self.accumulate
+            with self.sync_context(opt_step):
+                # Forward
+                with self.autocast():
+                    if model_type==1:
+                        pred = self.forward_model(images_train)
+                    elif model_type==2:
+                        pred = self.forward_model(images_train, lastlevel)
+                    self.timer.lap('forward')
+
+                    lossfunc = torch.nn.SmoothL1Loss()
+
+                    trainloss = lossfunc(pred, targets_train)
+                    self.metrics.log(i, {'train_loss': trainloss.item()})
+                    self.timer.lap('loss')
+
+                # Backward
+                self.scaler.scale(trainloss).backward() #######################
+                self.timer.lap('backward')
                     # Save current learning rate and momentum
-            for param_group in self.optimizer.param_groups:
-                self.lr_history.append(param_group['lr'])
-                if 'betas' in param_group:
-                    self.momentum_history.append(param_group['betas'])
-                else:
-                    self.momentum_history.append(None)  # If momentum is not used
+            self.metrics.log(i, self.optimizer_metrics())
 
             # Optimize - https://pytorch.org/docs/master/notes/amp_examples.html
-            if i - last_opt_step >= self.accumulate:
+            self.timer.lap('other')
+            if opt_step:
                 self.optimizer_step() #########################
-                last_opt_step = i
+                self.last_opt_step = i
 
             if check_gradient:
-                for p, n in self.model.named_parameters():
-                    if n[-6:] == 'weight':
-                        if (p.grad > 1e5).any() or (p.grad < 1e-5).any():
-                            print('===========\ngradient:{}\n----------\n{}'.format(n, p.grad))
-                            break
+                check_gradients(self.model)
             ##########################################################################
             ###Test###
+            self.timer.lap('other')
             if torch.is_tensor(images_test ):
-                images_test = images_test .to(self.device)
+                images_test = images_test.to(self.device, memory_format=self.memory_format)
                 model_type = 1
             else:
                 model_type = 2
                 (images_test , lastlevel) = images_test
-                images_test= images_test.to(self.device)
+                images_test = images_test.to(self.device, memory_format=self.memory_format)
                 lastlevel = lastlevel.to(self.device)
 
             targets = targets_test.to(self.device)
+            self.timer.lap('h2d')
             self.model.eval()
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 if model_type==1:
-                    pred = self.model(images_test)
+                    pred = self.forward_model(images_test)
                 elif model_type==2:
-                    pred = self.model(images_test, lastlevel)
+                    pred = self.forward_model(images_test, lastlevel)
 
                 testloss = lossfunc(pred, targets)
 
-            self.testloss_total.append(testloss.item())
+            self.metrics.log(i, {'test_loss': testloss.item()})
+            self.timer.lap('eval')
 
             del images_train, images_test, targets  # mannually release GPU memory during training loop.
 
-            if i % self.pms.print_freq == 0:
+            if i % self.pms.get('memory_freq', self.pms.print_freq) == 0 and self.is_main:
+                self.sample_memory(i)
+            if i % self.pms.print_freq == 0 and self.is_main:
                 print("Epoch{}\t".format(i), "Train Loss data {:.3f}".format(trainloss.item()))
                 print("Epoch{}\t".format(i), "Test Loss data {:.3f}".format(testloss.item()),
                       'Cost: {}\t s.'.format(time.time() - record))
-                gpu_usage = get_gpu_info(torch.cuda.current_device())
-                print('GPU memory usage: {}/{}'.format(gpu_usage[0], gpu_usage[1]))
+                print(self.timer.format())
+                if self.memory_sample is None:  # no sample yet when memory_freq differs from print_freq
+                    self.sample_memory(i)
+                print(self.memory.format(self.memory_sample))
                 record = time.time()
 
-            stop = self.stopper(i, testloss.item())
+            # every rank sees the same averaged test loss, and rank 0 has the final say on stopping
+            stop = broadcast_flag(self.stopper(i, reduce_mean(testloss.item(), self.device)), self.device)
 
+            self.timer.lap('other')
             if not stop:
-                if self.stopper.best_epoch == i:
-                    torch.save(
-                        {'ema': deepcopy(self.ema.ema),'state_dict': self.model.state_dict(),
+                if self.stopper.best_epoch == i and self.is_main:
+                    self.writer.save(
+                        {'ema': self.ema.ema,'state_dict': de_parallel(self.model).state_dict(),
                          'epoch': self.stopper.best_epoch,"date": datetime.now().isoformat()},
-                        self.savepath + 'model_bestepoch.tar')
+                        self.savepath + 'model_bestepoch.tar', throttle=True)
+                if self.is_main:
+                    self.writer.poll()
+                if (i + 1) % save_period == 0 and self.is_main:
+                    self.writer.save(self.checkpoint_state(), self.savepath + 'model_last.tar')
+                self.timer.lap('checkpoint')
+                self.timer.step()
             else:
                 break
 
@@ -255,8 +310,12 @@ class BaseTrainer:
                 break
 
         # at finish
+        if self.is_main:
+            self.writer.save(self.checkpoint_state(), self.savepath + 'model_last.tar')
+            self.timer.save(self.savepath)
         self.lr = {f"lr/pg{ir}": x["lr"] for ir, x in enumerate(self.optimizer.param_groups)}  # for loggers
-        self.ema.update_attr(self.model, include=["yaml", "nc", "args", "names", "stride", "class_weights"])
+        if self.ema:
+            self.ema.update_attr(self.model, include=["yaml", "nc", "args", "names", "stride", "class_weights"])
 
         # Validation
         # to be added
@@ -324,6 +383,125 @@ class BaseTrainer:
 
         self.scheduler = optim.lr_scheduler.LambdaLR(self.optimizer, lr_lambda=self.lf)
 
+    def save_level_hyperdicts(self, hyperdict1, hyperdict2):
+        """Keep the level 1 and level 2 hyperdicts next to hyperdict.json, to rebuild the model and the dataset."""
+        for name, h in (('hyperdict1.json', hyperdict1), ('hyperdict2.json', hyperdict2)):
+            with open(self.savepath + name, 'w') as fp:
+                json.dump(h, fp)
+
+    def checkpoint_state(self, **extra):
+        """Everything needed to resume the training after the current iteration."""
+        state = {"date": datetime.now().isoformat(), 'iteration': self.iteration, 'last_opt_step': self.last_opt_step,
+                 'accumulate': self.accumulate, 'state_dict': de_parallel(self.model).state_dict(),
+                 'ema': self.ema.ema, 'ema_updates': self.ema.updates,
+                 'optimizer': self.optimizer.state_dict(), 'scaler': self.scaler.state_dict(),
+                 'scheduler': self.scheduler.state_dict(),
+                 'stopper': {'best_fitness': self.stopper.best_fitness, 'best_epoch': self.stopper.best_epoch},
+                 'rng': capture_rng_state(), 'metrics': self.metrics.path}
+        self.metrics.flush()  # the log on disk covers at least the iterations of the checkpoint
+        state.update(extra)
+        return state
+
+    def resume_from(self, path):
+        """Restore the state written by checkpoint_state, the training continues at the next iteration."""
+        ckpt = torch.load(path, map_location=self.device, weights_only=False)
+        de_parallel(self.model).load_state_dict(ckpt['state_dict'])
+        if self.ema:
+            self.ema.ema.load_state_dict(ckpt['ema'].state_dict())
+            self.ema.updates = ckpt['ema_updates']
+        self.optimizer.load_state_dict(ckpt['optimizer'])
+        self.scaler.load_state_dict(ckpt['scaler'])
+        self.scheduler.load_state_dict(ckpt['scheduler'])
+        self.stopper.best_fitness = ckpt['stopper']['best_fitness']
+        self.stopper.best_epoch = ckpt['stopper']['best_epoch']
+        self.metrics.truncate(ckpt['iteration'])  # drop the iterations logged after the checkpoint
+        self.accumulate = ckpt['accumulate']
+        self.last_opt_step = ckpt['last_opt_step']
+        self.start_iter = ckpt['iteration'] + 1
+        restore_rng_state(ckpt['rng'])
+        if self.is_main:
+            print('Resumed from {} at iteration {}'.format(path, self.start_iter))
+
+    def wrap_model(self):
+        """Wrap the model into DistributedDataParallel when launched by torchrun with more than one process."""
+        if self.world_size > 1:
+            # with if_CAB=False, if_FT=False or reduction=1 some attention layers never get a gradient
+            unused = any(getattr(m, 'if_CAB', True) is False or getattr(m, 'if_FT', True) is False
+                         or (isinstance(m, FCAModule) and m.reduction == 1) for m in self.model.modules())
+            self.model = nn.parallel.DistributedDataParallel(
+                self.model, device_ids=[self.local_rank] if self.device.type == 'cuda' else None,
+                find_unused_parameters=unused)
+
+    def setup_compile(self):
+        """
+        Opt-in torch.compile of the forward passes, with the hyperdict key 'compile': True or a torch.compile mode
+        such as 'max-autotune'. self.model stays the eager module, used for the optimizer, EMA and checkpoints.
+        The compiled kernels are cached in savepath/compile_cache.
+        """
+        self.forward_model = self.model
+        mode = self.pms.get('compile', False)
+        if mode:
+            self.forward_model = compile_model(self.model, mode=None if mode is True else mode,
+                                               fullgraph=self.world_size == 1,
+                                               cache_dir=self.savepath + 'compile_cache')
+
+    def sync_context(self, sync):
+        """Skip the DDP gradient all-reduce on the iterations without an optimizer step."""
+        if self.world_size > 1 and not sync:
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def build_dataloader(self, dataset, shuffle=True, loader_index=0):
+        """
+        DataLoader for one split, sharded over the ranks by a DistributedSampler in DDP mode.
+        The worker settings come from loader_utils.loader_kwargs, loader_index tells the train (0) and test (1)
+        loaders apart for the worker CPU affinity.
+        """
+        sampler = None
+        if self.world_size > 1:
+            sampler = data.DistributedSampler(dataset, num_replicas=self.world_size, rank=self.rank, shuffle=shuffle)
+            shuffle = False
+        return data.DataLoader(dataset, batch_size=self.pms.batchsize, shuffle=shuffle, sampler=sampler,
+                               **loader_kwargs(self.device, self.pms, loader_index=loader_index))
+
+    def autocast(self):
+        """Mixed precision context of the forward passes, fp16 on CUDA or bf16 with the CPU profile."""
+        return torch.autocast(self.device.type, dtype=self.perf.amp_dtype, enabled=self.perf.autocast)
+
+    def build_ema(self):
+        """
+        ModelEMA of self.model. Hyperdict keys: ema_every to update every k optimizer steps (default 1), ema_device
+        and ema_dtype (e.g. 'cpu', 'bfloat16') to keep the EMA copy outside the accelerator memory.
+        """
+        dtype = self.pms.get('ema_dtype', None)
+        return ModelEMA(self.model, every=self.pms.get('ema_every', 1), device=self.pms.get('ema_device', None),
+                        dtype=getattr(torch, dtype) if dtype else None)
+
+    def sample_memory(self, i):
+        """
+        Record a MemoryMonitor sample (process, DataLoader workers, shared memory and device allocator) with the
+        losses. Hyperdict key memory_freq: iterations between samples, print_freq by default.
+        """
+        self.memory_sample = self.memory.sample()
+        self.metrics.log(i, {'memory/' + k: v for k, v in self.memory_sample.items()})
+        return self.memory_sample
+
+    def optimizer_metrics(self):
+        """Learning rate and momentum (beta1 for Adam) of each parameter group."""
+        out = {}
+        for k, param_group in enumerate(self.optimizer.param_groups):
+            out['lr/pg{}'.format(k)] = param_group['lr']
+            out['momentum/pg{}'.format(k)] = param_group['betas'][0] if 'betas' in param_group \
+                else param_group.get('momentum')
+        return out
+
+    def build_timer(self):
+        """
+        StageTimer of the training loop, written to savepath/timing.json and timing.csv at the end of the training.
+        Hyperdict keys: stage_timers (default True), timer_sync to synchronize CUDA at each stage (default False).
+        """
+        return StageTimer(self.device, sync=self.pms.get('timer_sync', False), enabled=self.pms.get('stage_timers', True))
+
     def optimizer_step(self):
         """Perform a single step of the training optimizer with gradient clipping and EMA update."""
         self.scaler.unscale_(self.optimizer)  # unscale gradients
@@ -331,36 +509,83 @@ class BaseTrainer:
         self.scaler.step(self.optimizer)
         self.scaler.update()
         self.optimizer.zero_grad()
+        self.timer.lap('optimizer')
         if self.ema:
             self.ema.update(self.model)
+        self.timer.lap('ema')
 
 
 class TwoLevelTrainer(BaseTrainer):
 
-    def train(self, hyperdict1, hyperdict2, loss_alpha, loss_beta):
+    def train(self, hyperdict1, hyperdict2, loss_alpha, loss_beta, resume=None, model=None):
+        """
+        resume: path of a model_last.tar checkpoint to continue from, or True for the one in savepath.
+        model: a built model to fine-tune (e.g. a pruned one), instead of a new one from the level hyperdicts.
+        """
+
+        self.setup_model(hyperdict1, hyperdict2, loss_alpha, loss_beta, model)
+        dataset_train, dataset_test = self.build_datasets(hyperdict1, hyperdict2)
+
+        # define training and validation data loaders
+        self.d_train = self.build_dataloader(dataset_train, loader_index=0)
+        self.d_test = self.build_dataloader(dataset_test, loader_index=1)
+
+        if self.is_main:
+            print('##############################START TRAINING ######################################')
 
+        self.optimizer.zero_grad()
+        self.start_iter, self.last_opt_step = 0, -1
+        if resume:
+            self.resume_from(self.savepath + 'model_last.tar' if resume is True else resume)
+        else:
+            self.metrics.reset()
+        self.writer = CheckpointWriter(self.pms.get('best_save_interval', 10.0)) if self.is_main else None
+        try:
+            self.train_cell(self.d_train, self.d_test)
+            self.save_final()
+        finally:
+            self.metrics.close()
+            if self.writer:
+                self.writer.close()
+        if self.is_main:
+            plot_losses(self.metrics.path, self.savepath)
+
+        return de_parallel(self.model)
+
+    def setup_model(self, hyperdict1, hyperdict2, loss_alpha, loss_beta, model=None):
+        """Build the model (or take the given one), EMA, optimizer and scheduler for the level hyperdicts."""
         # Initialize model
-        init_seeds(1)
-        self.model = eval(self.model_name + "(hyperdict1, hyperdict2)" )
-        self.model.apply(weights_init)
+        self.model = model
+        init_seeds(1, self.perf.deterministic)
+        if self.model is None:
+            self.model = eval(self.model_name + "(hyperdict1, hyperdict2)" )
+            self.model.apply(weights_init)
 
-        self.model.to(self.device)
+        self.model.to(self.device, memory_format=self.memory_format)
 
         self.stopper = EarlyStopping(patience=self.patience)  #########################################
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.pms.amp)  # automatic mixed precision training for speeding up and save memory
-        self.ema = ModelEMA(self.model)
-        self.accumulate = max(round(self.pms.nbs / self.pms.batchsize),1) # accumulate loss before optimizing, nbs nominal batch size
-        weight_decay = self.pms.weight_decay * self.pms.batchsize * self.accumulate / self.pms.nbs  # scale weight_decay
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.perf.scaler)  # automatic mixed precision training for speeding up and save memory
+        self.ema = self.build_ema() if self.is_main else None
+        batch_total = self.pms.batchsize * self.world_size  # samples per optimizer step over all ranks
+        self.accumulate = max(round(self.pms.nbs / batch_total),1) # accumulate loss before optimizing, nbs nominal batch size
+        weight_decay = self.pms.weight_decay * batch_total * self.accumulate / self.pms.nbs  # scale weight_decay
 
         self.optimizer = self.build_optimizer(model=self.model, lr=self.pms.lr0, momentum=self.pms.momentum,decay=weight_decay)
         self.setup_scheduler()
         self.scheduler.last_epoch = - 1  # do not move
+        self.wrap_model()
+        self.setup_compile()
         self.loss_alpha = loss_alpha
         self.loss_beta = loss_beta
+        if self.is_main:
+            self.save_level_hyperdicts(hyperdict1, hyperdict2)
 
+    def build_datasets(self, hyperdict1, hyperdict2):
+        """The augmented training and test splits of the dataset."""
         # Initialize dataset
         dataset = eval(self.dataset_name + "(self.data_path, hyperdict1, hyperdict2, subset = self.subset)")
-        print('The training dataset contains ',len(dataset.ids),'samples')
+        if self.is_main:
+            print('The training dataset contains ',len(dataset.ids),'samples')
         # print("The input data shape is ", dataset.data_shape())
         aug_N = int(self.pms.epochs / (dataset.__len__() * 0.4 / self.pms.batchsize))
         datasets = []
@@ -377,159 +602,175 @@ class TwoLevelTrainer(BaseTrainer):
         dataset_train = torch.utils.data.Subset(repeat_dataset,
                                                 indices[:-int(0.4 * len(repeat_dataset))])  # swing back to 0.3
         dataset_test = torch.utils.data.Subset(repeat_dataset, indices[-int(0.4 * len(repeat_dataset)):])
+        return dataset_train, dataset_test
 
-        pool = multiprocessing.Pool()
-        # define training and validation data loaders
-        self.d_train = torch.utils.data.DataLoader(
-            dataset_train, batch_size=self.pms.batchsize, shuffle=True, pin_memory=True,
-            num_workers=int(pool._processes / 2))
-
-        self.d_test = torch.utils.data.DataLoader(
-            dataset_test, batch_size=self.pms.batchsize, shuffle=True, pin_memory=True,
-            num_workers=int(pool._processes / 2))
-
-        print('##############################START TRAINING ######################################')
-
-        if not os.path.exists(self.savepath):
-            os.mkdir(self.savepath)
-        self.optimizer.zero_grad()
-        self.train_cell(self.d_train, self.d_test)
-
-
-        torch.save({"date": datetime.now().isoformat(),'ema': deepcopy(self.ema.ema), 'state_dict': self.model.state_dict(),
-                    'train': self.trainloss_total, 'test': self.testloss_total, "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
-                   self.savepath + 'model_final.tar')
-
-        plot_losses(self.trainloss_total, self.testloss_total, self.savepath)
-
-        return self.model
-
+    def save_final(self):
+        """Write model_final.tar with the EMA, the weights and the path of the metric log."""
+        if self.is_main:
+            self.writer.save({"date": datetime.now().isoformat(),'ema': self.ema.ema, 'state_dict': de_parallel(self.model).state_dict(),
+                              'metrics': self.metrics.path, "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
+                             self.savepath + 'model_final.tar')
 
     def train_cell(self, data_loader_train, data_loader_test, check_gradient=True, regularization=False):
         """
         """
 
-        nb = len(data_loader_train)  # number of batches
-        nw = self.pms.warmup_iters  # warmup iterations
-        last_opt_step = -1
-
-        record = time.time()
+        self.record = time.time()
+        self.timer = self.build_timer()
 
         # note: I will still keep the iteration loop and no real epoch loop
         for i, ((images_train, targets_train), (images_test, targets_test)) in enumerate(
-                zip(data_loader_train, data_loader_test)):
-
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")  # suppress 'Detected lr_scheduler.step() before optimizer.step()'
-                self.scheduler.step()
-
-            self.model.train()  # turn on train mode!
-
-            self.optimizer.zero_grad() # YOU HAVE TO KEEP THIS. Do not remove
-
-            (images_train1, images_train2) = images_train
-            images_train1 = images_train1.to(self.device)
-            images_train2 = images_train2.to(self.device)
+                zip(data_loader_train, data_loader_test), start=self.start_iter):
+            stop = self.train_iteration(i, (images_train, targets_train), (images_test, targets_test), check_gradient)
+            if stop or i == (self.pms.epochs - 1):
+                break
 
-            targets_train= targets_train.to(self.device)
+        self.finish_training()
 
-            # Warmup
-            # ni = i + nb * epoch
-            if i <= nw:
-                xi = [0, nw]  # x interp
-                self.accumulate = max(1, int(np.interp(i, xi, [1, self.pms.nbs / self.pms.batchsize]).round()))
-                for j, x in enumerate(self.optimizer.param_groups):
-                    # Bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                    x["lr"] = np.interp(
-                        i, xi, [self.pms.warmup_bias_lr if j == 0 else 0.0, x["initial_lr"] * self.lf(i)]
-                    )
-                    if "momentum" in x:
-                        x["momentum"] = np.interp(i, xi, [self.pms.warmup_momentum, self.pms.momentum])
+    def train_iteration(self, i, batch_train, batch_test, check_gradient=True):
+        """
+        One training step and one test evaluation on a batch of each split, with the best and resumable checkpoints.
+        Returns: whether the early stopping criterion is met
+        """
+        nw = self.pms.warmup_iters  # warmup iterations
+        save_period = self.pms.get('save_period', self.pms.print_freq)  # iterations between resumable checkpoints
+        self.timer.lap('data')
+        (images_train, targets_train), (images_test, targets_test) = batch_train, batch_test
+        self.iteration = i
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # suppress 'Detected lr_scheduler.step() before optimizer.step()'
+            self.scheduler.step()
+
+        self.model.train()  # turn on train mode!
+
+        self.optimizer.zero_grad() # YOU HAVE TO KEEP THIS. Do not remove
+
+        (images_train1, images_train2) = images_train
+        images_train1 = images_train1.to(self.device, memory_format=self.memory_format)
+        images_train2 = images_train2.to(self.device, memory_format=self.memory_format)
+
+        targets_train= targets_train.to(self.device)
+        self.timer.lap('h2d')
+
+        # Warmup
+        # ni = i + nb * epoch
+        if i <= nw:
+            xi = [0, nw]  # x interp
+            self.accumulate = max(1, int(np.interp(i, xi, [1, self.pms.nbs / (self.pms.batchsize * self.world_size)]).round()))
+            for j, x in enumerate(self.optimizer.param_groups):
+                # Bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                x["lr"] = np.interp(
+                    i, xi, [self.pms.warmup_bias_lr if j == 0 else 0.0, x["initial_lr"] * self.lf(i)]
+                )
+                if "momentum" in x:
+                    x["momentum"] = np.interp(i, xi, [self.pms.warmup_momentum, self.pms.momentum])
 
+        self.timer.lap('other')
+        opt_step = i - self.last_opt_step >= self.accumulate
+        with self.sync_context(opt_step):
             # Forward
-            with torch.cuda.amp.autocast(self.pms.amp):
+            with self.autocast():
 
-                pred = self.model(images_train1, images_train2)
-                ##################################
-                k_sampling_mrad = 0.07360865
-                phasemap_gpts = 1024 # ! #
-                wavelengthA = 0.025
-                k = k_sampling_mrad * 1e-3 * (torch.arange(phasemap_gpts) - phasemap_gpts / 2)
-                kxx, kyy = torch.meshgrid(*(k, k), indexing="ij")  # rad
-                kxx = kxx.to(self.device)
-                kyy = kyy.to(self.device)
-                lossfunc = CombinedLoss(alpha = self.loss_alpha , beta = self.loss_beta)
-                trainloss = lossfunc(pred, targets_train, kxx, kyy, order=2,wavelengthA=wavelengthA)
-                ##################################
+                pred = self.forward_model(images_train1, images_train2)
+                self.timer.lap('forward')
+                trainloss = self.loss(i, pred, targets_train, (images_train1, images_train2))
 
-                self.trainloss_total.append(trainloss.item())
+                self.metrics.log(i, {'train_loss': trainloss.item()})
+                self.timer.lap('loss')
 
             # Backward
             self.scaler.scale(trainloss).backward() #######################
-                    # Save current learning rate and momentum
-            for param_group in self.optimizer.param_groups:
-                self.lr_history.append(param_group['lr'])
-                if 'betas' in param_group:
-                    self.momentum_history.append(param_group['betas'])
-                else:
-                    self.momentum_history.append(None)  # If momentum is not used
-
-            # Optimize - https://pytorch.org/docs/master/notes/amp_examples.html
-            if i - last_opt_step >= self.accumulate:
-                self.optimizer_step() #########################
-                last_opt_step = i
-
-            if check_gradient:
-                for p, n in self.model.named_parameters():
-                    if n[-6:] == 'weight':
-                        if (p.grad > 1e5).any() or (p.grad < 1e-5).any():
-                            print('===========\ngradient:{}\n----------\n{}'.format(n, p.grad))
-                            break
-            ##########################################################################
-            ###Test###
-
-            (images_test1, images_test2) = images_test
-            images_test1 = images_test1.to(self.device)
-            images_test2 = images_test2.to(self.device)
-
-            targets = targets_test.to(self.device)
-            self.model.eval()
-            with torch.no_grad():
-
-                pred = self.model(images_test1, images_test2)
-
-                testloss = lossfunc(pred, targets, kxx, kyy, order=2,wavelengthA=wavelengthA)
-
-            self.testloss_total.append(testloss.item())
-
-            del images_train1, images_test1, images_train2, images_test2, targets  # mannually release GPU memory during training loop.
-
-            if i % self.pms.print_freq == 0:
-                print("Epoch{}\t".format(i), "Train Loss data {:.3f}".format(trainloss.item()))
-                print("Epoch{}\t".format(i), "Test Loss data {:.3f}".format(testloss.item()),
-                      'Cost: {}\t s.'.format(time.time() - record))
-                gpu_usage = get_gpu_info(torch.cuda.current_device())
-                print('GPU memory usage: {}/{}'.format(gpu_usage[0], gpu_usage[1]))
-                record = time.time()
-
-            stop = self.stopper(i, testloss.item())
-
-            if not stop:
-                if self.stopper.best_epoch == i:
-                    torch.save(
-                        {'ema': deepcopy(self.ema.ema),'state_dict': self.model.state_dict(),
-                         'epoch': self.stopper.best_epoch,"date": datetime.now().isoformat(),
-                         "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
-                        self.savepath + 'model_bestepoch.tar')
-            else:
-                break
-
-            if i == (self.pms.epochs - 1):
-                break
-
+            self.timer.lap('backward')
+                # Save current learning rate and momentum
+        self.metrics.log(i, self.optimizer_metrics())
+
+        # Optimize - https://pytorch.org/docs/master/notes/amp_examples.html
+        self.timer.lap('other')
+        if opt_step:
+            self.optimizer_step() #########################
+            self.last_opt_step = i
+
+        if check_gradient:
+            check_gradients(self.model)
+        ##########################################################################
+        ###Test###
+        self.timer.lap('other')
+
+        (images_test1, images_test2) = images_test
+        images_test1 = images_test1.to(self.device, memory_format=self.memory_format)
+        images_test2 = images_test2.to(self.device, memory_format=self.memory_format)
+
+        targets = targets_test.to(self.device)
+        self.timer.lap('h2d')
+        self.model.eval()
+        with torch.no_grad(), self.autocast():
+
+            pred = self.forward_model(images_test1, images_test2)
+
+            testloss = self.chi_loss(pred, targets)
+
+        self.metrics.log(i, {'test_loss': testloss.item()})
+        self.timer.lap('eval')
+
+        del images_train1, images_test1, images_train2, images_test2, targets  # mannually release GPU memory during training loop.
+
+        if i % self.pms.get('memory_freq', self.pms.print_freq) == 0 and self.is_main:
+            self.sample_memory(i)
+        if i % self.pms.print_freq == 0 and self.is_main:
+            print("Epoch{}\t".format(i), "Train Loss data {:.3f}".format(trainloss.item()))
+            print("Epoch{}\t".format(i), "Test Loss data {:.3f}".format(testloss.item()),
+                  'Cost: {}\t s.'.format(time.time() - self.record))
+            print(self.timer.format())
+            if self.memory_sample is None:  # no sample yet when memory_freq differs from print_freq
+                self.sample_memory(i)
+            print(self.memory.format(self.memory_sample))
+            self.record = time.time()
+
+        # every rank sees the same averaged test loss, and rank 0 has the final say on stopping
+        stop = broadcast_flag(self.stopper(i, reduce_mean(testloss.item(), self.device)), self.device)
+
+        self.timer.lap('other')
+        if not stop:
+            if self.stopper.best_epoch == i and self.is_main:
+                self.writer.save(
+                    {'ema': self.ema.ema,'state_dict': de_parallel(self.model).state_dict(),
+                     'epoch': self.stopper.best_epoch,"date": datetime.now().isoformat(),
+                     "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
+                    self.savepath + 'model_bestepoch.tar', throttle=True)
+            if self.is_main:
+                self.writer.poll()
+            if (i + 1) % save_period == 0 and self.is_main:
+                self.writer.save(self.checkpoint_state(loss_alpha=self.loss_alpha, loss_beta=self.loss_beta),
+                                 self.savepath + 'model_last.tar')
+            self.timer.lap('checkpoint')
+            self.timer.step()
+        return stop
+
+    def chi_loss(self, pred, targets):
+        """CombinedLoss of the predicted coefficients, with the phase maps on the k grid of the simulations."""
+        if getattr(self, 'kgrid', None) is None:
+            k_sampling_mrad = 0.07360865
+            phasemap_gpts = 1024 # ! #
+            k = k_sampling_mrad * 1e-3 * (torch.arange(phasemap_gpts) - phasemap_gpts / 2)
+            kxx, kyy = torch.meshgrid(*(k, k), indexing="ij")  # rad
+            self.kgrid = (kxx.to(self.device), kyy.to(self.device))
+        lossfunc = CombinedLoss(alpha=self.loss_alpha, beta=self.loss_beta)
+        return lossfunc(pred, targets, *self.kgrid, order=2, wavelengthA=0.025)
+
+    def loss(self, i, pred, targets, images):
+        """The training loss of iteration i, images: the (level 1, level 2) inputs of pred."""
+        return self.chi_loss(pred, targets)
+
+    def finish_training(self):
         # at finish
+        if self.is_main:
+            self.writer.save(self.checkpoint_state(loss_alpha=self.loss_alpha, loss_beta=self.loss_beta),
+                             self.savepath + 'model_last.tar')
+            self.timer.save(self.savepath)
         self.lr = {f"lr/pg{ir}": x["lr"] for ir, x in enumerate(self.optimizer.param_groups)}  # for loggers
-        self.ema.update_attr(self.model, include=["yaml", "nc", "args", "names", "stride", "class_weights"])
+        if self.ema:
+            self.ema.update_attr(self.model, include=["yaml", "nc", "args", "names", "stride", "class_weights"])
 
         # Validation
         # to be added
@@ -538,29 +779,193 @@ class TwoLevelTrainer(BaseTrainer):
         torch.cuda.empty_cache()  # clear GPU memory at end of epoch, may help reduce CUDA out of memory errors
 
 
+class MultiModelTrainer(TwoLevelTrainer):
+    """
+    Trains several TwoLevel models side by side on one data stream, e.g. for hyperparameter screening: every batch
+    is loaded and preprocessed once and then used for one step of each model. Each model keeps its own optimizer,
+    scheduler, EMA and early stopping, and writes its hyperdicts and checkpoints to savepath/variant{k}/.
+    Example:
+        trainer = MultiModelTrainer('TwoLevelDataset', 'TwoLevelTemplated', data_path, 'cpu', hyperdict, savepath, 1)
+        models = trainer.train(hyperdict1, hyperdict2, 0.5, 1.0,
+                               variants=[{}, {'lr0': 3e-4}, {'hyperdict2': {'reduction': 8, 'fca_block_n': 3}}])
+    """
+    # keys of the level hyperdicts that define the data, so they must be the same for all the variants
+    DATA_KEYS = ('data_keys', 'normalization', 'pre_normalization', 'imagesize', 'if_HP', 'if_reference',
+                 'downsampling', 'fft_pad_factor', 'fftcropsize', 'patch', 'first_inputchannels')
+    LOADER_KEYS = ('batchsize', 'num_workers', 'prefetch_factor', 'pin_memory')
+
+    def train(self, hyperdict1, hyperdict2, loss_alpha, loss_beta, variants=({},)):
+        """
+        Args:
+            hyperdict1, hyperdict2: the level hyperdicts shared by all models, they also configure the dataset
+            loss_alpha, loss_beta: CombinedLoss weights
+            variants: one dict of overrides per model. 'hyperdict1' and 'hyperdict2' update the model keys of the
+                level hyperdicts (reduction, fca_block_n, skip_connection, if_FT, if_CAB), 'loss_alpha' and
+                'loss_beta' the loss weights, and all other keys the training hyperdict (lr0, weight_decay, epochs,
+                print_freq, save_period, ...) of that model.
+        Returns: the list of trained models
+        """
+        self.trainers = []
+        for k, variant in enumerate(variants):
+            variant = dict(variant)
+            h1 = dict(hyperdict1, **variant.pop('hyperdict1', {}))
+            h2 = dict(hyperdict2, **variant.pop('hyperdict2', {}))
+            changed = [key for key in self.DATA_KEYS if h1.get(key) != hyperdict1.get(key)
+                       or h2.get(key) != hyperdict2.get(key)] + [key for key in self.LOADER_KEYS if key in variant]
+            if changed:
+                raise ValueError('Variant {} changes {}, which must be shared by all models'.format(k, changed))
+            alpha, beta = variant.pop('loss_alpha', loss_alpha), variant.pop('loss_beta', loss_beta)
+            trainer = TwoLevelTrainer(self.dataset_name, self.model_name, self.data_path, self.device,
+                                      dict(dict(self.pms), **variant), self.savepath + 'variant{}/'.format(k),
+                                      self.subset)
+            trainer.setup_model(h1, h2, alpha, beta)
+            trainer.optimizer.zero_grad()
+            trainer.metrics.reset()
+            trainer.writer = CheckpointWriter(trainer.pms.get('best_save_interval', 10.0)) if self.is_main else None
+            self.trainers.append(trainer)
+
+        self.memory_format = self.trainers[0].memory_format
+        # the data stream lasts for the longest variant, each model stops at its own epochs
+        self.pms.epochs = max(trainer.pms.epochs for trainer in self.trainers)
+        dataset_train, dataset_test = self.build_datasets(hyperdict1, hyperdict2)
+        self.d_train = self.build_dataloader(dataset_train, loader_index=0)
+        self.d_test = self.build_dataloader(dataset_test, loader_index=1)
+        if self.is_main:
+            print('######################## START TRAINING {} MODELS ##################################'.format(
+                len(self.trainers)))
+        try:
+            self.train_cell(self.d_train, self.d_test)
+            for trainer in self.trainers:
+                trainer.save_final()
+        finally:
+            for trainer in self.trainers:
+                trainer.metrics.close()
+                if trainer.writer:
+                    trainer.writer.close()
+        if self.is_main:
+            for trainer in self.trainers:
+                plot_losses(trainer.metrics.path, trainer.savepath)
+
+        return [de_parallel(trainer.model) for trainer in self.trainers]
+
+    def train_cell(self, data_loader_train, data_loader_test, check_gradient=False, regularization=False):
+        """Step every model that has not stopped yet on each pair of train and test batches."""
+        active = list(self.trainers)
+        for trainer in active:
+            trainer.record = time.time()
+            trainer.timer = trainer.build_timer()
+        self.timer = self.build_timer()  # data loading and transfer, shared by the models
+        for i, (batch_train, batch_test) in enumerate(zip(data_loader_train, data_loader_test)):
+            self.timer.lap('data')
+            # move the batch once, the transfers inside train_iteration are then no-ops
+            batch_train, batch_test = self.batch_to_device(batch_train), self.batch_to_device(batch_test)
+            self.timer.lap('h2d')
+            for k, trainer in enumerate(self.trainers):
+                if trainer not in active:
+                    continue
+                trainer.timer.start()  # the time of the other models is not data wait of this one
+                stop = trainer.train_iteration(i, batch_train, batch_test, check_gradient)
+                if stop and self.is_main:
+                    print('Model {} stopped early at iteration {}'.format(k, i))
+                if stop or i == (trainer.pms.epochs - 1):
+                    trainer.finish_training()
+                    active.remove(trainer)
+            self.timer.step()
+            self.timer.start()  # the model steps are timed by the timers of the trainers
+            if not active or i == (self.pms.epochs - 1):
+                break
+        for trainer in active:
+            trainer.finish_training()
+        if self.is_main:
+            self.timer.save(self.savepath)
+
+    def batch_to_device(self, batch):
+        (images1, images2), targets = batch
+        return ((images1.to(self.device, memory_format=self.memory_format),
+                 images2.to(self.device, memory_format=self.memory_format)), targets.to(self.device))
+
+
+class DistillationTrainer(TwoLevelTrainer):
+    """
+    Trains a small TwoLevel student on the data stream of TwoLevelTrainer, against the targets and the predictions
+    of a trained teacher (its EMA weights, frozen in eval mode). The training loss is
+        (1 - distill_weight) * CombinedLoss(student, targets) + distill_weight * MSE(student, teacher)
+    with distill_weight from the hyperdict (default 0.5). The test loss and the early stopping use the CombinedLoss
+    to the targets alone. The student is saved like any TwoLevelTrainer run, with its level hyperdicts, so
+    AberrationEstimator(savepath) and export.py load it as they load the teacher.
+    Example:
+        trainer = DistillationTrainer('TwoLevelDataset', 'TwoLevelTemplated', data_path, 'cpu', hyperdict,
+                                      student_savepath, 1)
+        student = trainer.train(hyperdict1, hyperdict2, 0.5, 1.0, teacher=teacher_savepath,
+                                student={'fca_block_n': 1, 'if_CAB': False, 'head': 'pooled'})
+    """
+    # the default student: one FCABlock per stage, no coordinate attention and a pooled head
+    STUDENT = {'fca_block_n': 1, 'if_CAB': False, 'head': 'pooled'}
+
+    def train(self, hyperdict1, hyperdict2, loss_alpha, loss_beta, teacher=None, student=None, resume=None):
+        """
+        Args:
+            hyperdict1, hyperdict2: the level hyperdicts of the data, the same as those of the teacher
+            teacher: the training folder of the teacher, whose model_bestepoch.tar EMA weights are used, or a model
+            student: the model keys of the student updating both level hyperdicts (STUDENT by default), or a built
+                TwoLevel model, e.g. a pruned copy of the teacher
+        Returns: the trained student
+        """
+        from AberrationNN.inference import load_model, load_hyperdicts
+        if isinstance(teacher, str):
+            teacher_hyperdicts = load_hyperdicts(teacher)[1:]
+            changed = [key for key in MultiModelTrainer.DATA_KEYS for h, t in zip((hyperdict1, hyperdict2),
+                       teacher_hyperdicts) if t is not None and h.get(key) != t.get(key)]
+            if changed:
+                raise ValueError('The teacher was trained on other data, {} differ'.format(sorted(set(changed))))
+            teacher = load_model(teacher, device=self.device, ema=True)
+        self.teacher = deepcopy(teacher).to(self.device).eval().requires_grad_(False)
+        self.distill_weight = self.pms.get('distill_weight', 0.5)
+        model = None
+        if isinstance(student, nn.Module):
+            model = student
+        else:
+            student = self.STUDENT if student is None else student
+            hyperdict1, hyperdict2 = dict(hyperdict1, **student), dict(hyperdict2, **student)
+        return super(DistillationTrainer, self).train(hyperdict1, hyperdict2, loss_alpha, loss_beta, resume, model)
+
+    def loss(self, i, pred, targets, images):
+        with torch.no_grad():
+            teacher_pred = self.teacher(*images).float()
+        chi = self.chi_loss(pred, targets)
+        distill = nn.functional.mse_loss(pred.float(), teacher_pred)
+        self.metrics.log(i, {'chi_loss': chi.item(), 'distill_loss': distill.item()})
+        return (1 - self.distill_weight) * chi + self.distill_weight * distill
+
+
 class TwoLevelTrainer_3step(BaseTrainer):
     from AberrationNN.train_utils import plot_losses
-    def train_step(self, step, hyperdict1, hyperdict2, loss_alpha, loss_beta, model=None):
+    def train_step(self, step, hyperdict1, hyperdict2, loss_alpha, loss_beta, model=None, resume=None):
+        if self.world_size > 1:  # no DDP wrapping, rank gating or stop broadcast here, see TwoLevelTrainer
+            raise RuntimeError('TwoLevelTrainer_3step runs as a single process, torchrun started {} '
+                               'processes'.format(self.world_size))
 
         # Initialize model
         self.model = model
-        init_seeds(1)
+        init_seeds(1, self.perf.deterministic)
         if self.model is None:
             self.model = eval(self.model_name + "(hyperdict1, hyperdict2)" )
             self.model.apply(weights_init)
-        self.model.to(self.device)
+        self.model.to(self.device, memory_format=self.memory_format)
 
         self.stopper = EarlyStopping(patience=self.patience)  #########################################
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.pms.amp)  # automatic mixed precision training for speeding up and save memory
-        self.ema = ModelEMA(self.model)
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.perf.scaler)  # automatic mixed precision training for speeding up and save memory
+        self.ema = self.build_ema()
         self.accumulate = max(round(self.pms.nbs / self.pms.batchsize),1) # accumulate loss before optimizing, nbs nominal batch size
         weight_decay = self.pms.weight_decay * self.pms.batchsize * self.accumulate / self.pms.nbs  # scale weight_decay
 
         self.optimizer = self.build_optimizer(model=self.model, lr=self.pms.lr0, momentum=self.pms.momentum,decay=weight_decay)
         self.setup_scheduler()
         self.scheduler.last_epoch = - 1  # do not move
+        self.setup_compile()
         self.loss_alpha = loss_alpha
         self.loss_beta = loss_beta
+        self.save_level_hyperdicts(hyperdict1, hyperdict2)
 
         # Initialize dataset
         dataset = eval(self.dataset_name + "(self.data_path, hyperdict1, hyperdict2,)")
@@ -580,29 +985,34 @@ class TwoLevelTrainer_3step(BaseTrainer):
                                                 indices[:-int(0.4 * len(repeat_dataset))])  # swing back to 0.3
         dataset_test = torch.utils.data.Subset(repeat_dataset, indices[-int(0.4 * len(repeat_dataset)):])
 
-        pool = multiprocessing.Pool()
         # define training and validation data loaders
-        self.d_train = torch.utils.data.DataLoader(
-            dataset_train, batch_size=self.pms.batchsize, shuffle=True, pin_memory=True,
-            num_workers=int(pool._processes / 2))
-
-        self.d_test = torch.utils.data.DataLoader(
-            dataset_test, batch_size=self.pms.batchsize, shuffle=True, pin_memory=True,
-            num_workers=int(pool._processes / 2))
+        self.d_train = self.build_dataloader(dataset_train, loader_index=0)
+        self.d_test = self.build_dataloader(dataset_test, loader_index=1)
 
         print('##############################START TRAINING ######################################')
 
         if not os.path.exists(self.savepath):
             os.mkdir(self.savepath)
         self.optimizer.zero_grad()
-        self.train_cell_step(step, self.d_train, self.d_test)
-
-
-        torch.save({"date": datetime.now().isoformat(),'ema': deepcopy(self.ema.ema), 'state_dict': self.model.state_dict(),
-                    'train': self.trainloss_total, 'test': self.testloss_total, "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
-                   self.savepath + 'model_final_step'+str(step)+'.tar')
-
-        plot_losses(step, self.trainloss_total, self.testloss_total, self.savepath)
+        self.start_iter, self.last_opt_step = 0, -1
+        # a log per step, so that the loss from difference steps are not stack together
+        self.metrics = MetricLog(self.savepath + 'metrics_step' + str(step) + '.csv',
+                                 flush_every=self.pms.get('metric_flush', 1000))
+        if resume:
+            self.resume_from(self.savepath + 'model_last_step'+str(step)+'.tar' if resume is True else resume)
+        else:
+            self.metrics.reset()
+        self.writer = CheckpointWriter(self.pms.get('best_save_interval', 10.0))
+        try:
+            self.train_cell_step(step, self.d_train, self.d_test)
+            self.writer.save({"date": datetime.now().isoformat(),'ema': self.ema.ema, 'state_dict': self.model.state_dict(),
+                              'metrics': self.metrics.path, "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
+                             self.savepath + 'model_final_step'+str(step)+'.tar')
+        finally:
+            self.metrics.close()
+            self.writer.close()
+
+        plot_losses(self.metrics.path, self.savepath, step)
 
         return self.model
 
@@ -611,17 +1021,19 @@ class TwoLevelTrainer_3step(BaseTrainer):
                         check_gradient=True, regularization=False):
         """
         """
-        self.trainloss_total, self.testloss_total = [],[] # so that the loss from difference steps are not stack together
 
         nb = len(data_loader_train)  # number of batches
         nw = self.pms.warmup_iters  # warmup iterations
-        last_opt_step = -1
+        save_period = self.pms.get('save_period', self.pms.print_freq)  # iterations between resumable checkpoints
 
         record = time.time()
+        self.timer = self.build_timer()
 
         # note: I will still keep the iteration loop and no real epoch loop
         for i, ((images_train, targets_train), (images_test, targets_test)) in enumerate(
-                zip(data_loader_train, data_loader_test)):
+                zip(data_loader_train, data_loader_test), start=self.start_iter):
+            self.timer.lap('data')
+            self.iteration = i
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")  # suppress 'Detected lr_scheduler.step() before optimizer.step()'
@@ -643,10 +1055,11 @@ class TwoLevelTrainer_3step(BaseTrainer):
             self.optimizer.zero_grad() # YOU HAVE TO KEEP THIS. Do not remove
 
             (images_train1, images_train2) = images_train
-            images_train1 = images_train1.to(self.device)
-            images_train2 = images_train2.to(self.device)
+            images_train1 = images_train1.to(self.device, memory_format=self.memory_format)
+            images_train2 = images_train2.to(self.device, memory_format=self.memory_format)
 
             targets_train= targets_train.to(self.device)
+            self.timer.lap('h2d')
 
             # Warmup
             # ni = i + nb * epoch
@@ -662,9 +1075,11 @@ class TwoLevelTrainer_3step(BaseTrainer):
                         x["momentum"] = np.interp(i, xi, [self.pms.warmup_momentum, self.pms.momentum])
 
             # Forward
-            with torch.cuda.amp.autocast(self.pms.amp):
+            self.timer.lap('other')
+            with self.autocast():
 
-                pred = self.model(images_train1, images_train2)
+                pred = self.forward_model(images_train1, images_train2)
+                self.timer.lap('forward')
                 ##################################
                 k_sampling_mrad = 0.07360865
                 phasemap_gpts = 1024 # ! #
@@ -677,65 +1092,73 @@ class TwoLevelTrainer_3step(BaseTrainer):
                 trainloss = lossfunc(pred, targets_train, kxx, kyy, order=2,wavelengthA=wavelengthA)
                 ##################################
 
-                self.trainloss_total.append(trainloss.item())
+                self.metrics.log(i, {'train_loss': trainloss.item()})
+                self.timer.lap('loss')
 
             # Backward
             self.scaler.scale(trainloss).backward() #######################
+            self.timer.lap('backward')
                     # Save current learning rate and momentum
-            for param_group in self.optimizer.param_groups:
-                self.lr_history.append(param_group['lr'])
-                if 'betas' in param_group:
-                    self.momentum_history.append(param_group['betas'])
-                else:
-                    self.momentum_history.append(None)  # If momentum is not used
+            self.metrics.log(i, self.optimizer_metrics())
 
             # Optimize - https://pytorch.org/docs/master/notes/amp_examples.html
-            if i - last_opt_step >= self.accumulate:
+            self.timer.lap('other')
+            if i - self.last_opt_step >= self.accumulate:
                 self.optimizer_step() #########################
-                last_opt_step = i
+                self.last_opt_step = i
 
             if check_gradient:
-                for p, n in self.model.named_parameters():
-                    if n[-6:] == 'weight':
-                        if (p.grad > 1e5).any() or (p.grad < 1e-5).any():
-                            print('===========\ngradient:{}\n----------\n{}'.format(n, p.grad))
-                            break
+                check_gradients(self.model)
             ##########################################################################
             ###Test###
+            self.timer.lap('other')
 
             (images_test1, images_test2) = images_test
-            images_test1 = images_test1.to(self.device)
-            images_test2 = images_test2.to(self.device)
+            images_test1 = images_test1.to(self.device, memory_format=self.memory_format)
+            images_test2 = images_test2.to(self.device, memory_format=self.memory_format)
 
             targets = targets_test.to(self.device)
+            self.timer.lap('h2d')
             self.model.eval()
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
 
-                pred = self.model(images_test1, images_test2)
+                pred = self.forward_model(images_test1, images_test2)
 
                 testloss = lossfunc(pred, targets, kxx, kyy, order=2,wavelengthA=wavelengthA)
 
-            self.testloss_total.append(testloss.item())
+            self.metrics.log(i, {'test_loss': testloss.item()})
+            self.timer.lap('eval')
 
             del images_train1, images_test1, images_train2, images_test2, targets  # mannually release GPU memory during training loop.
 
+            if i % self.pms.get('memory_freq', self.pms.print_freq) == 0:
+                self.sample_memory(i)
             if i % self.pms.print_freq == 0:
                 print("Epoch{}\t".format(i), "Train Loss data {:.3f}".format(trainloss.item()))
                 print("Epoch{}\t".format(i), "Test Loss data {:.3f}".format(testloss.item()),
                       'Cost: {}\t s.'.format(time.time() - record))
-                gpu_usage = get_gpu_info(torch.cuda.current_device())
-                print('GPU memory usage: {}/{}'.format(gpu_usage[0], gpu_usage[1]))
+                print(self.timer.format())
+                if self.memory_sample is None:  # no sample yet when memory_freq differs from print_freq
+                    self.sample_memory(i)
+                print(self.memory.format(self.memory_sample))
                 record = time.time()
 
             stop = self.stopper(i, testloss.item())
 
+            self.timer.lap('other')
             if not stop:
                 if self.stopper.best_epoch == i:
-                    torch.save(
-                        {'ema': deepcopy(self.ema.ema),'state_dict': self.model.state_dict(),
+                    self.writer.save(
+                        {'ema': self.ema.ema,'state_dict': self.model.state_dict(),
                          'epoch': self.stopper.best_epoch,"date": datetime.now().isoformat(),
                          "loss_alpha": self.loss_alpha, "loss_beta": self.loss_beta},
-                        self.savepath + 'model_bestepoch'+str(step)+'.tar')
+                        self.savepath + 'model_bestepoch'+str(step)+'.tar', throttle=True)
+                self.writer.poll()
+                if (i + 1) % save_period == 0:
+                    self.writer.save(self.checkpoint_state(step=step, loss_alpha=self.loss_alpha, loss_beta=self.loss_beta),
+                                     self.savepath + 'model_last_step'+str(step)+'.tar')
+                self.timer.lap('checkpoint')
+                self.timer.step()
             else:
                 break
 
@@ -743,6 +1166,9 @@ class TwoLevelTrainer_3step(BaseTrainer):
                 break
 
         # at finish
+        self.writer.save(self.checkpoint_state(step=step, loss_alpha=self.loss_alpha, loss_beta=self.loss_beta),
+                         self.savepath + 'model_last_step'+str(step)+'.tar')
+        self.timer.save(self.savepath, 'timing_step' + str(step))
         self.lr = {f"lr/pg{ir}": x["lr"] for ir, x in enumerate(self.optimizer.param_groups)}  # for loggers
         self.ema.update_attr(self.model, include=["yaml", "nc", "args", "names", "stride", "class_weights"])
 
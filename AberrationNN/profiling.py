@@ -0,0 +1,141 @@
+import csv
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+
+def time_step(fn, n_iter=10, warmup=3):
+    """Wall time in seconds of each of n_iter calls of fn, after warmup untimed calls."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(n_iter):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times):
+    """Median and 90th percentile in milliseconds of a list of times in seconds."""
+    return {'median_ms': float(np.median(times) * 1e3), 'p90_ms': float(np.percentile(times, 90) * 1e3)}
+
+
+def allocated_bytes(fn):
+    """Bytes allocated by the CPU ops of one call of fn, from the profiler memory events."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0)
+
+
+def peak_allocated_bytes(fn):
+    """
+    Peak of the memory held by one call of fn above what was held before it: from the CUDA allocator on GPU, from the
+    running sum of the profiler allocation and free events on CPU.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - before
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    return max(np.cumsum([0] + [e.self_cpu_memory_usage for e in events]))
+
+
+STAGES = ('data', 'h2d', 'forward', 'loss', 'backward', 'optimizer', 'ema', 'eval', 'checkpoint', 'other')
+
+
+class StageTimer:
+    """
+    Wall-clock time of the stages of each training iteration. The training loop calls lap(stage) at the end of each
+    stage, which books the time since the previous lap to that stage, and step() at the end of the iteration.
+    The first lap of an iteration, 'data', is the time spent waiting for the DataLoaders.
+    On CUDA the kernels run asynchronously, so without sync the GPU time shows up in the stage that waits for it
+    (e.g. the .item() of the loss); sync=True synchronizes at every lap for exact but slower timings.
+    Only the last `window` iterations are kept for the percentiles.
+    Example:
+        timer = StageTimer(device)
+        for batch in loader:
+            timer.lap('data')
+            ...
+            timer.lap('forward')
+            timer.step()
+        timer.save(savepath)
+    """
+
+    def __init__(self, device=None, sync=False, window=10000, enabled=True):
+        self.sync = sync and device is not None and torch.device(device).type == 'cuda'
+        self.device = device
+        self.enabled = enabled
+        self.records = deque(maxlen=window)
+        self.current = dict.fromkeys(STAGES, 0.0)
+        self.n_steps = 0
+        self.start()
+
+    def start(self):
+        """Restart the clock, the time since the last lap or step is not booked to any stage."""
+        self._t = time.perf_counter()
+
+    def lap(self, stage):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        t = time.perf_counter()
+        self.current[stage] += t - self._t
+        self._t = t
+
+    def step(self):
+        """Close the current iteration."""
+        if not self.enabled:
+            return
+        self.records.append([self.current[s] for s in STAGES])
+        self.current = dict.fromkeys(STAGES, 0.0)
+        self.n_steps += 1
+
+    def summary(self):
+        """
+        Percentiles in ms of each stage and of the whole iteration, and the share of the iteration time per stage.
+        The run is loader_bound when more than 10% of the time is spent waiting for data.
+        """
+        if not self.records:
+            return {}
+        times = np.asarray(self.records) * 1e3
+        total = times.sum(axis=1)
+        out = {'iterations': self.n_steps, 'window': len(self.records), 'stages': {}}
+        for k, stage in enumerate(STAGES + ('iteration',)):
+            t = times[:, k] if stage != 'iteration' else total
+            out['stages'][stage] = {'mean_ms': float(t.mean()), 'p50_ms': float(np.percentile(t, 50)),
+                                    'p90_ms': float(np.percentile(t, 90)), 'p99_ms': float(np.percentile(t, 99)),
+                                    'share': float(t.sum() / max(total.sum(), 1e-12))}
+        shares = {s: out['stages'][s]['share'] for s in STAGES}
+        out['bottleneck'] = max(shares, key=shares.get)
+        out['loader_bound'] = shares['data'] > 0.1
+        return out
+
+    def format(self):
+        """One line with the share of each stage, for the training log."""
+        s = self.summary()
+        if not s:
+            return ''
+        return 'Time per iteration {:.0f} ms: '.format(s['stages']['iteration']['p50_ms']) + ', '.join(
+            '{} {:.0%}'.format(k, s['stages'][k]['share']) for k in STAGES if s['stages'][k]['share'] >= 0.005)
+
+    def save(self, savepath, name='timing'):
+        """Write the summary to savepath/name.json and the per-iteration stage times (s) to savepath/name.csv."""
+        if not self.records:
+            return
+        with open(os.path.join(savepath, name + '.json'), 'w') as fp:
+            json.dump(self.summary(), fp, indent=1)
+        with open(os.path.join(savepath, name + '.csv'), 'w', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(STAGES)
+            writer.writerows(self.records)
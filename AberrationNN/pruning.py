@@ -0,0 +1,271 @@
+import ast
+import json
+import os
+import random
+from copy import deepcopy
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+
+from AberrationNN.FCAResNet import FCAResNetB2A2, LowRankLinear, gelu
+from AberrationNN.profiling import time_step, summarize
+from AberrationNN.dataset import *
+from AberrationNN.inference import load_model, load_hyperdicts, CARTESIAN_KEYS
+from AberrationNN.new_trainer import TwoLevelTrainer
+from AberrationNN.quantization import predict, state_dict_bytes
+
+CRITERIA = ('bn', 'activation')
+
+
+def prune_conv(conv, out_idx=None, in_idx=None):
+    """A new Conv2d with the output channels out_idx and the input channels in_idx of conv (None keeps all)."""
+    weight, bias = conv.weight.detach(), None if conv.bias is None else conv.bias.detach()
+    if out_idx is not None:
+        weight = weight[out_idx]
+        bias = None if bias is None else bias[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    new = nn.Conv2d(weight.shape[1], weight.shape[0], conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                    bias=bias is not None, padding_mode=conv.padding_mode).to(weight.device, weight.dtype)
+    with torch.no_grad():
+        new.weight.copy_(weight)
+        if bias is not None:
+            new.bias.copy_(bias)
+    return new.train(conv.training)
+
+
+def prune_bn(bn, idx):
+    new = nn.BatchNorm2d(len(idx), bn.eps, bn.momentum, bn.affine, bn.track_running_stats).to(bn.weight.device)
+    with torch.no_grad():
+        for name in ('weight', 'bias', 'running_mean', 'running_var'):
+            if getattr(bn, name) is not None:
+                getattr(new, name).copy_(getattr(bn, name)[idx])
+        if bn.track_running_stats:
+            new.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new.train(bn.training)
+
+
+def prune_linear(linear, in_idx):
+    new = nn.Linear(len(in_idx), linear.out_features, bias=linear.bias is not None).to(linear.weight.device)
+    with torch.no_grad():
+        new.weight.copy_(linear.weight[:, in_idx])
+        if linear.bias is not None:
+            new.bias.copy_(linear.bias)
+    return new.train(linear.training)
+
+
+def prune_fca_module(m, idx):
+    """
+    Keep the channels idx of an FCAModule. spectrum_mean rolls the input channels of the cov weights by half the
+    channel number, so the weights are unrolled, pruned and rolled by half the new channel number, which keeps the
+    outputs of the kept channels.
+    """
+    c, n = m.cov.in_channels, len(idx)
+    cov = prune_conv(m.cov, idx, idx)
+    with torch.no_grad():
+        unrolled = torch.roll(m.cov.weight.detach(), -(c // 2), 1)[idx][:, idx]
+        cov.weight.copy_(torch.roll(unrolled, n // 2, 1))
+    m.cov = cov
+    m.cov2 = prune_conv(m.cov2, in_idx=idx)
+    m.cov2back = prune_conv(m.cov2back, out_idx=idx)
+    m.input_channels = n
+
+
+def prune_coord_attention(cab, idx):
+    cab.conv1 = prune_conv(cab.conv1, in_idx=idx)
+    cab.conv_h = prune_conv(cab.conv_h, out_idx=idx)
+    cab.conv_w = prune_conv(cab.conv_w, out_idx=idx)
+    cab.input_channels = len(idx)
+
+
+def prune_block(block, idx):
+    """Keep the channels idx of the FCABlocks of a stage, the blocks repeated in the Sequential are pruned once."""
+    for b in {id(b): b for b in block}.values():
+        b.c0 = prune_conv(b.c0, idx, idx)
+        prune_fca_module(b.fca, idx)
+        if b.batch_norm:
+            b.bn = prune_bn(b.bn, idx)
+        b.input_channels = len(idx)
+
+
+def stages(level):
+    """(cov, cab, block) of the four stages of an FCAResNetBackbone."""
+    return [(getattr(level, 'cov{}'.format(k)), getattr(level, 'cab{}'.format(k + 1)),
+             getattr(level, 'block{}'.format(k + 1))) for k in range(4)]
+
+
+def bn_importance(level):
+    """|BN scale| of the FCABlocks of each stage, the network slimming criterion."""
+    out = []
+    for _, _, block in stages(level):
+        bn = getattr(block[-1], 'bn', None)
+        out.append(bn.weight.detach().abs() if bn is not None else torch.ones(block[-1].input_channels))
+    return out
+
+
+def activation_importance(model, levels, batches):
+    """Mean |output| of each channel of each stage of the levels over the batches (tuples of model inputs)."""
+    sums, outputs, hooks = {}, {}, []
+
+    def record_cov(module, args, out):
+        outputs[module] = gelu(out)
+
+    def record_block(level, cov):
+        def hook(module, args, out):
+            stage = out + outputs.pop(cov) if level.skip_connection else out
+            sums[cov] = sums.get(cov, 0) + stage.detach().abs().float().mean(dim=(0, 2, 3))
+        return hook
+
+    for level in levels:
+        for cov, _, block in stages(level):
+            hooks.append(cov.register_forward_hook(record_cov))
+            hooks.append(block.register_forward_hook(record_block(level, cov)))
+    try:
+        with torch.no_grad():
+            for inputs in batches:
+                model(*inputs)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return [[sums[cov] for cov, _, _ in stages(level)] for level in levels]
+
+
+def prune_level(level, ratio, importance):
+    """
+    Remove the fraction ratio of the channels of each stage of an FCAResNetC1A1Cs / FCAResNetB2A2, the least
+    important first, and rebuild the convs, attention modules, BNs and dense1 with the kept channels.
+    """
+    for k, score in enumerate(importance):
+        cov, cab, block = stages(level)[k]
+        if not isinstance(cov, nn.Conv2d) or cov.groups != 1:
+            raise ValueError('Pruning needs the dense convs, not {}'.format(cov))
+        c = cov.out_channels
+        n = max(1, int(round(c * (1 - ratio))))
+        idx = torch.sort(torch.topk(score, n).indices).values.to(cov.weight.device)
+        setattr(level, 'cov{}'.format(k), prune_conv(cov, out_idx=idx))
+        prune_coord_attention(cab, idx)
+        prune_block(block, idx)
+        if k < 3:
+            setattr(level, 'cov{}'.format(k + 1), prune_conv(getattr(level, 'cov{}'.format(k + 1)), in_idx=idx))
+        else:  # the flattened features are channel major, the level 1 outputs come last in FCAResNetB2A2
+            linear = level.dense1.down if isinstance(level.dense1, LowRankLinear) else level.dense1
+            extra = 3 if isinstance(level, FCAResNetB2A2) else 0
+            pixels = (linear.in_features - extra) // c
+            columns = (idx[:, None] * pixels + torch.arange(pixels, device=idx.device)).flatten()
+            columns = torch.cat([columns, torch.arange(c * pixels, c * pixels + extra, device=idx.device)])
+            if isinstance(level.dense1, LowRankLinear):
+                level.dense1.down = prune_linear(linear, columns)
+            else:
+                level.dense1 = prune_linear(linear, columns)
+    return level
+
+
+def prune_model(model, ratio, criterion='bn', batches=()):
+    """
+    A pruned copy of a TwoLevelTemplated, with the fraction ratio of the channels of every stage of both levels
+    removed. criterion: 'bn' ranks the channels by the BN scale of the FCABlocks, 'activation' by their mean
+    |output| over the batches (tuples of model inputs), which also counts the skip connection.
+    """
+    if criterion not in CRITERIA:
+        raise ValueError('Unknown criterion {}, one of {}'.format(criterion, CRITERIA))
+    model = deepcopy(model).float().eval().to(memory_format=torch.contiguous_format)
+    levels = [model.firstmodel, model.secondmodel]
+    if criterion == 'bn':
+        importance = [bn_importance(level) for level in levels]
+    else:
+        importance = activation_importance(model, levels, batches)
+    for level, score in zip(levels, importance):
+        prune_level(level, ratio, score)
+    return model
+
+
+def evaluate(model, loader, timing_inputs, n_iter=10):
+    """Per-coefficient MAE to the targets, latency of one batch and weights size of a model."""
+    model = model.float().eval().to(memory_format=torch.contiguous_format)
+    pred, target = predict(model, loader)
+    with torch.inference_mode():
+        latency = summarize(time_step(lambda: model(*timing_inputs), n_iter))
+    mae = (pred - target).abs().mean(0)
+    return {'mae': dict(zip(CARTESIAN_KEYS, mae.tolist())), 'mean_mae': mae.mean().item(), 'latency': latency,
+            'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+            'weights_mb': state_dict_bytes(model) / 2 ** 20}
+
+
+def pruning_frontier(savepath, data_path, ratios=(0.25, 0.5, 0.75), criterion='activation', dataset_name=
+                     'TwoLevelDataset', checkpoint='model_bestepoch.tar', finetune=None, device='cpu',
+                     n_calibration=64, n_eval=256, batchsize=8, seed=0):
+    """
+    Prune the EMA model of a training folder at each ratio, fine-tune it with TwoLevelTrainer into
+    savepath/pruned{ratio}/ and evaluate it before and after the fine-tuning on a held-out subset of the dataset.
+    finetune: overrides of the training hyperdict for the fine-tuning, e.g. {'epochs': 5, 'lr0': 1e-4}, or False to
+        skip it
+    Returns: dict ratio: {'pruned': ..., 'finetuned': ...}, each with the per-coefficient MAE, the latency of one
+        batch on the CPU, the parameters and the weights size; ratio 0 is the unpruned model
+    """
+    hyperdict, hyperdict1, hyperdict2 = load_hyperdicts(savepath)
+    ckpt = torch.load(os.path.join(savepath, checkpoint), map_location='cpu', weights_only=False)
+    model = load_model(savepath, checkpoint, 'cpu', ema=True)
+    dataset = eval(dataset_name)(data_path, hyperdict1, hyperdict2)
+    indices = list(range(len(dataset)))
+    random.Random(seed).shuffle(indices)
+    calibration = [inputs for inputs, _ in DataLoader(Subset(dataset, indices[:n_calibration]),
+                                                      batch_size=batchsize)]
+    evaluation = DataLoader(Subset(dataset, indices[n_calibration:n_calibration + n_eval]), batch_size=batchsize)
+    timing_inputs = next(iter(evaluation))[0]
+
+    report = {0.0: {'pruned': evaluate(model, evaluation, timing_inputs)}}
+    for ratio in ratios:
+        pruned = prune_model(model, ratio, criterion, calibration)
+        report[ratio] = {'pruned': evaluate(pruned, evaluation, timing_inputs)}
+        if finetune is not False:
+            folder = os.path.join(savepath, 'pruned{}'.format(ratio), '')
+            os.makedirs(folder, exist_ok=True)
+            trainer = TwoLevelTrainer(dataset_name, 'TwoLevelTemplated', data_path, device,
+                                      dict(hyperdict, **(finetune or {})), folder, 1)
+            trainer.train(hyperdict1, hyperdict2, ckpt.get('loss_alpha', 0.5), ckpt.get('loss_beta', 1.0),
+                          model=pruned)
+            report[ratio]['finetuned'] = evaluate(deepcopy(trainer.ema.ema).cpu(), evaluation, timing_inputs)
+        print(format_frontier({ratio: report[ratio]}, header=False))
+    return report
+
+
+def format_frontier(report, header=True):
+    """One line per ratio: parameters, latency and mean MAE before and after the fine-tuning."""
+    lines = ['ratio   params M   weights MB   ms/batch   MAE pruned   MAE finetuned'] if header else []
+    for ratio, r in report.items():
+        p = r['pruned']
+        lines.append('{:<8.2f}{:>8.2f}{:>13.2f}{:>11.1f}{:>13.3e}{:>16}'.format(
+            float(ratio), p['params_m'], p['weights_mb'], p['latency']['median_ms'], p['mean_mae'],
+            '{:.3e}'.format(r['finetuned']['mean_mae']) if 'finetuned' in r else '-'))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Structured channel pruning of a trained TwoLevelTemplated')
+    parser.add_argument('savepath', help='training folder with the checkpoint and the hyperdicts')
+    parser.add_argument('data_path', help='dataset folder for the ranking, the fine-tuning and the evaluation')
+    parser.add_argument('--ratios', nargs='+', type=float, default=[0.25, 0.5, 0.75])
+    parser.add_argument('--criterion', default='activation', choices=CRITERIA)
+    parser.add_argument('--dataset', default='TwoLevelDataset')
+    parser.add_argument('--checkpoint', default='model_bestepoch.tar')
+    parser.add_argument('--finetune', default='{}',
+                        help="overrides of the training hyperdict for the fine-tuning, e.g. \"{'epochs': 5}\"")
+    parser.add_argument('--no_finetune', action='store_true')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--n_calibration', type=int, default=64)
+    parser.add_argument('--n_eval', type=int, default=256)
+    parser.add_argument('--batchsize', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    finetune = False if args.no_finetune else ast.literal_eval(args.finetune)  # a dict literal, not any expression
+    report = pruning_frontier(args.savepath, args.data_path, args.ratios, args.criterion, args.dataset,
+                              args.checkpoint, finetune, args.device, args.n_calibration, args.n_eval, args.batchsize)
+    print(format_frontier(report))
+    with open(os.path.join(args.savepath, 'pruning.json'), 'w') as fp:
+        json.dump({str(k): v for k, v in report.items()}, fp, indent=1)
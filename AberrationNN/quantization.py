@@ -0,0 +1,161 @@
+import io
+import json
+import os
+import random
+from copy import deepcopy
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+from torch.utils.data import DataLoader, Subset
+
+from AberrationNN.FCAResNet import FCAModule
+from AberrationNN.profiling import time_step, summarize, allocated_bytes
+from AberrationNN.dataset import *
+from AberrationNN.inference import load_model, load_hyperdicts, CARTESIAN_KEYS
+
+VARIANTS = ('fp32', 'dynamic', 'static', 'static+dynamic')
+
+
+def quantize_linear_dynamic(model):
+    """int8 weights for all the Linear layers (dense1-3 of each level), the activations are quantized on the fly."""
+    return tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def wrap_convs(model):
+    """
+    Put each 3x3 conv of the backbones (cov0-cov3, FCABlock.c0) between a quantize and a dequantize stub, with the
+    static int8 qconfig of the current quantized engine. The 1x1 convs of the attention modules stay in float, the
+    FCAModule uses the weights of cov directly and their inputs are single pixels.
+    Returns: the number of wrapped convs
+    """
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    wrapped = 0
+    for parent in list(model.modules()):
+        if isinstance(parent, FCAModule):
+            continue
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.Conv2d) and child.kernel_size != (1, 1):
+                if child.padding == 'same':  # the quantized conv only takes explicit padding, the kernels are odd
+                    child.padding = tuple(k // 2 for k in child.kernel_size)
+                child = tq.QuantWrapper(child)
+                child.qconfig = qconfig
+                setattr(parent, name, child)
+                wrapped += 1
+    return wrapped
+
+
+def quantize_conv_static(model, batches):
+    """
+    Static int8 quantization of the 3x3 convs: observers are inserted, the activation ranges are calibrated on the
+    batches (tuples of model inputs) and the convs are converted. The rest of the network stays in float.
+    """
+    wrap_convs(model)
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        for inputs in batches:
+            model(*inputs)
+    return tq.convert(model, inplace=True)
+
+
+def quantize(model, variant, batches=()):
+    """A quantized copy of model in eval mode, variant one of VARIANTS."""
+    model = deepcopy(model).float().eval().to(memory_format=torch.contiguous_format)
+    if 'static' in variant:
+        model = quantize_conv_static(model, batches)
+    if 'dynamic' in variant:
+        model = quantize_linear_dynamic(model)
+    return model
+
+
+def state_dict_bytes(model):
+    """Size of the serialized state_dict, the weights on disk."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def predict(model, loader):
+    """Predictions and targets (N, 7) of model over a DataLoader of ((image1, image2), target)."""
+    preds, targets = [], []
+    with torch.inference_mode():
+        for inputs, target in loader:
+            preds.append(model(*inputs).float())
+            targets.append(target)
+    return torch.cat(preds), torch.cat(targets)
+
+
+def quantization_report(model, dataset, n_calibration=64, n_eval=256, batchsize=8, variants=VARIANTS, n_iter=10,
+                        seed=0):
+    """
+    Post-training quantization of a TwoLevelTemplated, against its fp32 outputs.
+    The calibration and evaluation samples are disjoint random subsets of dataset (TwoLevelDataset).
+    Returns: dict per variant with the per-coefficient MAE to the targets and its change to fp32, the max abs
+    difference to the fp32 outputs, the latency of one batch, the weights size and the bytes allocated by a forward
+    """
+    indices = list(range(len(dataset)))
+    random.Random(seed).shuffle(indices)
+    calibration = DataLoader(Subset(dataset, indices[:n_calibration]), batch_size=batchsize)
+    evaluation = DataLoader(Subset(dataset, indices[n_calibration:n_calibration + n_eval]), batch_size=batchsize)
+    calibration_inputs = [inputs for inputs, _ in calibration]
+    timing_inputs = next(iter(evaluation))[0]
+
+    report = {}
+    for variant in variants:
+        qmodel = quantize(model, variant, calibration_inputs)
+        pred, target = predict(qmodel, evaluation)
+        if variant == 'fp32':
+            reference = pred
+        mae = (pred - target).abs().mean(0)
+        with torch.inference_mode():
+            latency = summarize(time_step(lambda: qmodel(*timing_inputs), n_iter))
+            alloc = allocated_bytes(lambda: qmodel(*timing_inputs))
+        report[variant] = {'mae': dict(zip(CARTESIAN_KEYS, mae.tolist())),
+                           'max_abs_diff_fp32': (pred - reference).abs().max().item(),
+                           'latency': latency, 'weights_mb': state_dict_bytes(qmodel) / 2 ** 20,
+                           'forward_alloc_mb': alloc / 2 ** 20}
+    for variant in variants:
+        report[variant]['mae_delta'] = {k: report[variant]['mae'][k] - report['fp32']['mae'][k]
+                                        for k in CARTESIAN_KEYS}
+    return report
+
+
+def format_report(report):
+    """Table of the per-coefficient MAE change and the latency and memory of each variant."""
+    lines = ['{:<22}'.format('') + ''.join('{:>10}'.format(k) for k in CARTESIAN_KEYS) +
+             '{:>12}{:>12}{:>12}'.format('ms/batch', 'weights MB', 'alloc MB')]
+    for variant, r in report.items():
+        values = r['mae'] if variant == 'fp32' else r['mae_delta']
+        lines.append('{:<22}'.format(variant + (' MAE' if variant == 'fp32' else ' dMAE')) +
+                     ''.join('{:>10.2e}'.format(values[k]) for k in CARTESIAN_KEYS) +
+                     '{:>12.1f}{:>12.2f}{:>12.1f}'.format(r['latency']['median_ms'], r['weights_mb'],
+                                                          r['forward_alloc_mb']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of a trained TwoLevelTemplated')
+    parser.add_argument('savepath', help='training folder with the checkpoint and the hyperdicts')
+    parser.add_argument('data_path', help='dataset folder for the calibration and the evaluation')
+    parser.add_argument('--dataset', default='TwoLevelDataset')
+    parser.add_argument('--checkpoint', default='model_bestepoch.tar')
+    parser.add_argument('--n_calibration', type=int, default=64)
+    parser.add_argument('--n_eval', type=int, default=256)
+    parser.add_argument('--batchsize', type=int, default=8)
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=VARIANTS)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--out', default=None, help='json file for the report, savepath/quantization.json by default')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    _, hyperdict1, hyperdict2 = load_hyperdicts(args.savepath)
+    dataset = eval(args.dataset)(args.data_path, hyperdict1, hyperdict2)
+    model = load_model(args.savepath, args.checkpoint, 'cpu', ema=True)
+    variants = ['fp32'] + [v for v in args.variants if v != 'fp32']
+    report = quantization_report(model, dataset, args.n_calibration, args.n_eval, args.batchsize, variants)
+    print(format_report(report))
+    with open(args.out or os.path.join(args.savepath, 'quantization.json'), 'w') as fp:
+        json.dump(report, fp, indent=1)
@@ -0,0 +1,118 @@
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import torch
+
+MB = 2 ** 20
+_PAGE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _statm(pid):
+    """Resident and resident shared memory in bytes of a process, from /proc/pid/statm."""
+    with open('/proc/{}/statm'.format(pid)) as f:
+        fields = f.read().split()
+    return int(fields[1]) * _PAGE, int(fields[2]) * _PAGE
+
+
+def child_pids(pid=None):
+    """Direct children of a process, e.g. the DataLoader workers of the training process."""
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+            return [int(c) for c in f.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+def process_tree_rss(pid=None):
+    """Resident memory in bytes of a process and all its children (the DataLoader workers)."""
+    pids, rss = [os.getpid() if pid is None else pid], 0
+    while pids:
+        p = pids.pop()
+        try:
+            rss += _statm(p)[0]
+        except (OSError, ValueError):
+            continue
+        pids.extend(child_pids(p))
+    return rss
+
+
+def shm_usage():
+    """Used bytes of /dev/shm, where the DataLoader workers put the batches they hand to the training process."""
+    try:
+        st = os.statvfs('/dev/shm')
+    except (OSError, AttributeError):
+        return 0
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+class MemoryMonitor:
+    """
+    In-process memory telemetry, replacing the nvidia-smi calls: the allocator statistics of the device, the RSS of
+    the training process and of each DataLoader worker, and the shared memory in use. A sample only reads a few
+    /proc files and the allocator counters, so it is cheap enough to take every few iterations.
+    Without /proc (macOS, Windows) the process RSS falls back to the peak RSS and the workers are not reported.
+    Example:
+        monitor = MemoryMonitor(device)
+        sample = monitor.sample()  # {'rss_mb': ..., 'workers_rss_mb': ..., 'cuda_allocated_mb': ..., ...}
+        print(monitor.format(sample))
+    """
+
+    def __init__(self, device='cpu'):
+        self.device = torch.device(device)
+        self.has_proc = os.path.exists('/proc/self/statm')
+
+    def sample(self):
+        """Memory usage in MiB, the peak allocator values are the peaks since the previous sample."""
+        out = {}
+        if self.has_proc:
+            rss, shared = _statm(os.getpid())
+            out['rss_mb'] = rss / MB
+            out['rss_shared_mb'] = shared / MB
+            workers = []
+            for pid in child_pids():
+                try:
+                    workers.append(process_tree_rss(pid) / MB)
+                except (OSError, ValueError):  # the worker exited in between
+                    continue
+            out['workers'] = len(workers)
+            out['workers_rss_mb'] = sum(workers)
+            out['worker_max_rss_mb'] = max(workers, default=0.)
+            out['shm_mb'] = shm_usage() / MB
+        elif resource is not None:  # ru_maxrss is in KiB on Linux and in bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            out['rss_mb'] = maxrss / (MB if sys.platform == 'darwin' else 1024)
+
+        if self.device.type == 'cuda':
+            out['cuda_allocated_mb'] = torch.cuda.memory_allocated(self.device) / MB
+            out['cuda_reserved_mb'] = torch.cuda.memory_reserved(self.device) / MB
+            out['cuda_peak_allocated_mb'] = torch.cuda.max_memory_allocated(self.device) / MB
+            free, total = torch.cuda.mem_get_info(self.device)
+            out['cuda_used_mb'], out['cuda_total_mb'] = (total - free) / MB, total / MB
+            torch.cuda.reset_peak_memory_stats(self.device)
+        elif self.device.type == 'mps':
+            out['mps_allocated_mb'] = torch.mps.current_allocated_memory() / MB
+            out['mps_driver_mb'] = torch.mps.driver_allocated_memory() / MB
+        return out
+
+    @staticmethod
+    def format(sample):
+        """One line for the training log."""
+        line = 'Memory: RSS {:.0f} MiB'.format(sample.get('rss_mb', 0))
+        if sample.get('workers'):
+            line += ', {} workers {:.0f} MiB (max {:.0f})'.format(sample['workers'], sample['workers_rss_mb'],
+                                                                 sample['worker_max_rss_mb'])
+        if 'shm_mb' in sample:
+            line += ', shm {:.0f} MiB'.format(sample['shm_mb'])
+        if 'cuda_allocated_mb' in sample:
+            line += ', CUDA allocated {:.0f} (peak {:.0f}) reserved {:.0f}, used {:.0f}/{:.0f} MiB'.format(
+                sample['cuda_allocated_mb'], sample['cuda_peak_allocated_mb'], sample['cuda_reserved_mb'],
+                sample['cuda_used_mb'], sample['cuda_total_mb'])
+        if 'mps_allocated_mb' in sample:
+            line += ', MPS allocated {:.0f} MiB'.format(sample['mps_allocated_mb'])
+        return line
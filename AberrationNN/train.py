@@ -5,8 +5,8 @@ from AberrationNN.architecture import CombinedNN
 import torch.utils.data as data
 from AberrationNN.dataset import Ronchi2fftDatasetAll, Augmentation
 from AberrationNN.customloss import LossDataWithChi
+from AberrationNN.loader_utils import loader_kwargs
 import torch.utils.data as data
-import multiprocessing
 
 # example
 hyperdict = {'loss': ['SmoothL1Loss', 'SmoothL1Loss', 'SmoothL1Loss', 'SmoothL1Loss'],# MAPE
@@ -212,13 +212,12 @@ def AlternateTraining(data_path, device, hyperdict, savepath):
                                             indices[:-int(0.4 * len(repeat_dataset))])  # swing back to 0.3
     dataset_test = torch.utils.data.Subset(repeat_dataset, indices[-int(0.4 * len(repeat_dataset)):])
 
-    pool = multiprocessing.Pool()
     # define training and validation data loaders
     d_train = torch.utils.data.DataLoader(
-        dataset_train, batch_size=pms.batchsize, shuffle=True, pin_memory=True, num_workers=int(pool._processes / 2))
+        dataset_train, batch_size=pms.batchsize, shuffle=True, **loader_kwargs(device, pms, loader_index=0))
 
     d_test = torch.utils.data.DataLoader(
-        dataset_test, batch_size=pms.batchsize, shuffle=False, pin_memory=True, num_workers=int(pool._processes / 2))
+        dataset_test, batch_size=pms.batchsize, shuffle=False, **loader_kwargs(device, pms, loader_index=1))
 
     print('##############################START TRAINING STEP ONE######################################')
     trainloss, testloss, trained_model1st = train_and_test(1, 2, wholemodel, optimizer, d_train, d_test, device,
@@ -5,15 +5,18 @@ import os
 import re
 import time
 import random
+import threading
 from copy import deepcopy
 import torch
+import torch.distributed as dist
 from scipy.interpolate import CubicSpline
 import matplotlib.pyplot as plt
 import numpy as np
 from torch import nn
 from torch.nn import Conv2d, ConvTranspose2d
-import subprocess
 from typing import List, Union
+from AberrationNN.loader_utils import local_cpus
+from AberrationNN.metrics import MetricLog
 
 
 def init_seeds(seed=0, deterministic=True):
@@ -36,11 +39,149 @@ def init_seeds(seed=0, deterministic=True):
     else:
         torch.use_deterministic_algorithms(False)
         torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True  # let cudnn pick the fastest, possibly non-deterministic, kernels
+
+
+# settings of the CPU performance profile, keys given in the hyperdict take precedence
+CPU_PROFILE = {'amp_dtype': 'bfloat16', 'channels_last': True, 'deterministic': False, 'inter_op_threads': 1}
+
+
+def configure_performance(pms, device, num_workers=0, apply_threads=True):
+    """
+    Resolve the performance settings of a run from the optional hyperdict keys and apply the torch thread settings
+    (unless apply_threads is False, at inference where the thread pools belong to the calling application).
+        cpu_profile: preset for CPU-only nodes, see CPU_PROFILE
+        amp: fp16 autocast with GradScaler on CUDA, as before. On CPU, autocast needs amp_dtype.
+        amp_dtype: 'float16' or 'bfloat16', enables autocast on any device ('bfloat16' on CPU)
+        channels_last: keep the model weights and the images in NHWC memory format
+        deterministic: torch.use_deterministic_algorithms, default True
+        intra_op_threads, inter_op_threads: torch thread pools. With cpu_profile, intra_op_threads defaults to the
+            cores of this rank left by the num_workers workers of each of the two DataLoaders.
+    Args:
+        pms: Parameters or dict of the training hyperparameters
+        device: the training or inference device
+        num_workers: DataLoader workers per loader, 0 for inference
+        apply_threads: set the intra_op_threads and inter_op_threads of the hyperdict
+    Returns: Parameters with autocast, amp_dtype (torch.dtype), scaler (GradScaler needed), channels_last, deterministic
+    """
+    get = pms.get
+    profile = CPU_PROFILE if get('cpu_profile', False) else {}
+    option = lambda k, d: get(k, profile.get(k, d))
+    device = torch.device(device)
+
+    amp_dtype = option('amp_dtype', None)
+    if amp_dtype is None:
+        autocast = bool(get('amp', False)) and device.type == 'cuda'
+        amp_dtype = torch.float16
+    else:
+        autocast = True
+        amp_dtype = getattr(torch, amp_dtype)
+
+    intra = option('intra_op_threads', max(len(local_cpus()) - 2 * num_workers, 1) if profile else None)
+    inter = option('inter_op_threads', None)
+    if intra is not None and apply_threads:
+        torch.set_num_threads(intra)
+    if inter is not None and apply_threads:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError:  # only possible before the first inter-op parallel work of the process
+            pass
+
+    return Parameters(autocast=autocast, amp_dtype=amp_dtype, scaler=autocast and amp_dtype == torch.float16,
+                      channels_last=option('channels_last', False), deterministic=option('deterministic', True))
+
+
+def compile_model(model, mode=None, fullgraph=True, cache_dir=None):
+    """
+    torch.compile a model for training or inference. The FCAResNet family compiles to a single graph, so fullgraph
+    makes a graph break introduced into a forward an error instead of a silent slowdown (DDP splits the graph at
+    the gradient buckets, so it needs fullgraph=False).
+    With cache_dir, the inductor kernels and FX graphs are cached there, and the next run with the same model and
+    input shapes skips most of the compilation.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, 'fx_graph_cache'):
+            inductor_config.fx_graph_cache = True
+    return torch.compile(model, mode=mode, fullgraph=fullgraph)
+
 
 def de_parallel(model):
     """De-parallelize a model: returns single-GPU model if model is of type DP or DDP."""
     return model.module if isinstance(model, (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)) else model
 
+def init_distributed(backend=None):
+    """
+    Initialize the default process group from the environment variables set by torchrun
+    (RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Without them, it is a single process run.
+    Args:
+        backend: 'nccl' or 'gloo'. Default: nccl if CUDA is available, otherwise gloo (CPU).
+    Returns: (rank, local_rank, world_size)
+    """
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        return 0, 0, 1
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    world_size = int(os.environ['WORLD_SIZE'])
+    if world_size > 1 and not dist.is_initialized():
+        if backend is None:
+            backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        if backend == 'nccl':
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    return rank, local_rank, world_size
+
+
+def is_distributed():
+    """True if running with an initialized process group of more than one process."""
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main_process():
+    """True on rank 0 or in a single process run. Only the main process writes files and keeps the EMA."""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def reduce_mean(value: float, device) -> float:
+    """Average a python scalar over all ranks so that every rank makes the same decision from it."""
+    if not is_distributed():
+        return value
+    t = torch.tensor([value], dtype=torch.float64, device=device)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.item() / dist.get_world_size()
+
+
+def broadcast_flag(flag: bool, device, src=0) -> bool:
+    """Broadcast a boolean from rank src, e.g. the early stopping decision."""
+    if not is_distributed():
+        return flag
+    t = torch.tensor([int(flag)], dtype=torch.int32, device=device)
+    dist.broadcast(t, src=src)
+    return bool(t.item())
+
+
+def check_gradients(model, low=1e-5, high=1e5):
+    """
+    Print the gradient of the first weight with an element above high in magnitude or with all its elements below
+    low. The parameters without a gradient in this step (the unused attention layers, e.g. with DDP
+    find_unused_parameters) are skipped.
+    """
+    for n, p in model.named_parameters():
+        if n[-6:] == 'weight' and p.grad is not None:
+            g = p.grad.abs()
+            if (g > high).any() or (g < low).all():
+                print('===========\ngradient:{}\n----------\n{}'.format(n, p.grad))
+                break
+
+
+def cleanup_distributed():
+    """Destroy the default process group at the end of a torchrun script."""
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
 def copy_attr(a, b, include=(), exclude=()):
     """Copies attributes from object 'b' to object 'a', with options to include/exclude certain attributes."""
     for k, v in b.__dict__.items():
@@ -54,29 +195,52 @@ class ModelEMA:
     Keeps a moving average of everything in the model state_dict (parameters and buffers)
     For EMA details see https://www.tensorflow.org/api_docs/python/tf/train/ExponentialMovingAverage
     To disable EMA set the `enabled` attribute to `False`.
+    The floating point tensors are collected once and updated with fused torch._foreach ops.
+    every: update the EMA every k optimizer steps, with the decays of the skipped steps multiplied in, so the
+        average follows the same schedule as with every=1.
+    device, dtype: keep the EMA copy elsewhere, e.g. device='cpu' to save accelerator memory. Note that a bfloat16 or
+        float16 EMA loses the small updates of decays close to 1.
     """
 
-    def __init__(self, model, decay=0.9999, tau=2000, updates=0):
+    def __init__(self, model, decay=0.9999, tau=2000, updates=0, every=1, device=None, dtype=None):
         """Create EMA."""
         self.ema = deepcopy(de_parallel(model)).eval()  # FP32 EMA
+        if device is not None or dtype is not None:
+            self.ema.to(device=device, dtype=dtype)  # dtype only casts the floating point tensors
         self.updates = updates  # number of EMA updates
         self.decay = lambda x: decay * (1 - math.exp(-x / tau))  # decay exponential ramp (to help early epochs)
         for p in self.ema.parameters():
             p.requires_grad_(False)
         self.enabled = True
+        self.every = every
+        self.pending_decay = 1.  # product of the decays of the steps since the last update
+        self.keys = [k for k, v in self.ema.state_dict().items() if v.dtype.is_floating_point]
+        self.ema_tensors = [self.ema.state_dict()[k] for k in self.keys]
+        self.source, self.model_tensors = None, None
+        self.cast = False
+
+    def collect(self, model):
+        """The floating point parameters and buffers of model, in the order of the EMA tensors."""
+        msd = de_parallel(model).state_dict(keep_vars=True)
+        self.source, self.model_tensors = model, [msd[k] for k in self.keys]
+        self.cast = any(v.device != e.device or v.dtype != e.dtype for v, e in zip(self.model_tensors, self.ema_tensors))
 
     def update(self, model):
         """Update EMA parameters."""
         if self.enabled:
             self.updates += 1
-            d = self.decay(self.updates)
-
-            msd = de_parallel(model).state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:  # true for FP16 and FP32
-                    v *= d
-                    v += (1 - d) * msd[k].detach()
-                    # assert v.dtype == msd[k].dtype == torch.float32, f'{k}: EMA {v.dtype},  model {msd[k].dtype}'
+            self.pending_decay *= self.decay(self.updates)
+            if self.updates % self.every:
+                return
+            d, self.pending_decay = self.pending_decay, 1.
+
+            if model is not self.source:
+                self.collect(model)
+            with torch.no_grad():
+                msd = self.model_tensors
+                if self.cast:
+                    msd = [v.to(e.device, e.dtype, non_blocking=True) for v, e in zip(msd, self.ema_tensors)]
+                torch._foreach_lerp_(self.ema_tensors, msd, 1 - d)  # ema = d * ema + (1 - d) * model
 
     def update_attr(self, model, include=(), exclude=("process_group", "reducer")):
         """Updates attributes and saves stripped model with optimizer removed."""
@@ -129,28 +293,191 @@ class EarlyStopping:
         return stop
 
 
+def snapshot_state(obj):
+    """
+    Copy a checkpoint state (nested dict/list of tensors, modules and python objects) to CPU memory, so that it can
+    be pickled by another thread while the training keeps changing the original tensors.
+    Modules keep their type, only their parameters and buffers are replaced by CPU copies.
+    """
+    if isinstance(obj, nn.Module):
+        memo = {}
+        for p in obj.parameters():
+            memo[id(p)] = nn.Parameter(p.detach().to('cpu', copy=True), requires_grad=p.requires_grad)
+        for b in obj.buffers():
+            memo[id(b)] = b.detach().to('cpu', copy=True)
+        return deepcopy(obj, memo)
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_state(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return deepcopy(obj)
+
+
+def refresh_snapshot(buffer, obj):
+    """
+    snapshot_state of obj that reuses the CPU tensors of buffer, a snapshot of an earlier state of the same structure,
+    by copying into them. Falls back to a new snapshot where the structure, shapes or dtypes differ.
+    """
+    if isinstance(obj, nn.Module):
+        if type(buffer) is not type(obj):
+            return snapshot_state(obj)
+        src = list(obj.parameters()) + list(obj.buffers())
+        dst = list(buffer.parameters()) + list(buffer.buffers())
+        if len(src) != len(dst) or any(d.shape != t.shape or d.dtype != t.dtype for d, t in zip(dst, src)):
+            return snapshot_state(obj)
+        with torch.no_grad():
+            for d, t in zip(dst, src):
+                d.copy_(t)
+        return buffer
+    if torch.is_tensor(obj):
+        if torch.is_tensor(buffer) and buffer.shape == obj.shape and buffer.dtype == obj.dtype:
+            return buffer.copy_(obj.detach())
+        return snapshot_state(obj)
+    if isinstance(obj, dict):
+        buffer = buffer if isinstance(buffer, dict) else {}
+        return {k: refresh_snapshot(buffer.get(k), v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        buffer = buffer if isinstance(buffer, type(obj)) and len(buffer) == len(obj) else [None] * len(obj)
+        return type(obj)(refresh_snapshot(b, v) for b, v in zip(buffer, obj))
+    return snapshot_state(obj)
+
+
+def atomic_save(state, path):
+    """torch.save into a temporary file next to path, then rename it, so path is never a truncated file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints from a background thread.
+    save() only snapshots the state to CPU and returns, the pickling and disk write happen in the writer thread
+    through atomic_save. Throttled saves (the best model, which can change almost every iteration early in the
+    training) are written at most once every min_interval seconds per file: a throttled state that is not due is
+    copied into the dirty buffer of its file, which is reused by the following bests, and queued by poll() or
+    close() once due. The file always holds the weights of the iteration it was saved at.
+    """
+
+    def __init__(self, min_interval=10.0):
+        self.min_interval = min_interval
+        self._pending = {}  # path: snapshotted state, only the latest state of every file is kept
+        self._dirty = {}  # path: snapshot of the latest throttled state not queued yet
+        self._last_write = {}  # path: time of the last queued throttled state
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+        self._thread.start()
+
+    def save(self, state, path, throttle=False):
+        """Snapshot state and queue it to be written to path, or keep it as the dirty state of path if not due."""
+        self._raise_error()
+        if throttle and not self._due(path):
+            self._dirty[path] = refresh_snapshot(self._dirty.get(path), state)
+            return
+        self._dirty.pop(path, None)
+        self._queue(path, snapshot_state(state), throttle)
+
+    def poll(self):
+        """Queue the dirty throttled states that are due, called by the training loop on every iteration."""
+        for path in [path for path in self._dirty if self._due(path)]:
+            self._queue(path, self._dirty.pop(path), True)
+
+    def close(self):
+        """Write all dirty and pending checkpoints and stop the thread."""
+        for path in list(self._dirty):
+            self._queue(path, self._dirty.pop(path), True)
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._raise_error()
+
+    def _due(self, path):
+        return time.time() - self._last_write.get(path, -math.inf) >= self.min_interval
+
+    def _queue(self, path, state, throttle):
+        if throttle:
+            self._last_write[path] = time.time()
+        with self._cond:
+            self._pending[path] = state
+            self._cond.notify()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Background checkpoint write failed') from error
+
+    def _next(self):
+        """Block until a checkpoint is pending, return (path, state) or None once closed and flushed."""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            path = next(iter(self._pending))
+            return path, self._pending.pop(path)
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            try:
+                atomic_save(item[1], item[0])
+            except Exception as e:  # reported to the training thread at the next save() or close()
+                self._error = e
+
+
+def capture_rng_state():
+    """RNG states of python, numpy and torch for resuming a training."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
 def weights_init(module):
     imodules = (Conv2d, ConvTranspose2d)
     if isinstance(module, imodules):
         torch.nn.init.xavier_uniform_(module.weight.data)
-        torch.nn.init.zeros_(module.bias)
+        if module.bias is not None:  # the depthwise convs of SeparableConv2d have none
+            torch.nn.init.zeros_(module.bias)
 
 
-def plot_losses(step, train_loss, test_loss, savepath) -> None:
+def plot_losses(metrics_path, savepath, step=None) -> None:
 
     """
-    Plots train and test losses
+    Plots train and test losses from the metric log written by the trainers (see metrics.MetricLog)
     """
     print('Plotting training history')
+    losses = MetricLog.read(metrics_path, names=('train_loss', 'test_loss'))
 
     fig, ax = plt.subplots(1, 1, figsize=(6, 6))
-    ax.plot(train_loss, label='Train')
-    ax.plot(test_loss, label='Test')
+    if 'train_loss' in losses:
+        ax.plot(*losses['train_loss'], label='Train')
+    if 'test_loss' in losses:
+        ax.plot(*losses['test_loss'], label='Test')
     ax.set_xlabel('Epoch')
     ax.set_ylabel('Loss')
     ax.legend()
     # plt.show()
-    plt.savefig(savepath+'/step'+str(step) + 'history.png')
+    plt.savefig(os.path.join(savepath, 'history.png' if step is None else 'step' + str(step) + 'history.png'))
+    plt.close(fig)
 
 
 # def plot_losses(step, train_loss, test_loss, savepath) -> None:
@@ -176,18 +503,13 @@ def plot_losses(step, train_loss, test_loss, savepath) -> None:
 
 def get_gpu_info(cuda_device: int) -> int:
     """
-    Get the current GPU memory usage
-    Adapted with changes from
-    https://discuss.pytorch.org/t/access-gpu-memory-usage-in-pytorch/3192/4
+    Get the current GPU memory usage [used, total] in MiB, from the CUDA driver instead of spawning nvidia-smi.
+    Returns [0, 0] without a GPU.
     """
-    result = subprocess.check_output(
-        [
-            'nvidia-smi', '--id=' + str(cuda_device),
-            '--query-gpu=memory.used,memory.total,utilization.gpu',
-            '--format=csv,nounits,noheader'
-        ], encoding='utf-8')
-    gpu_usage = [int(y) for y in result.split(',')]
-    return gpu_usage[0:2]
+    if not torch.cuda.is_available():
+        return [0, 0]
+    free, total = torch.cuda.mem_get_info(cuda_device)
+    return [(total - free) // 2 ** 20, total // 2 ** 20]
 
 from types import SimpleNamespace
 class Parameters(SimpleNamespace):